@@ -284,7 +284,12 @@ struct Task {
   String taskname;
   String cron;
   CronPattern cp;
+  uint32_t ver; // 该槽位最后一次变化时的任务表版本
 } tasklist[TASK_N];
+// 任务表版本，任务增加、执行、终止时递增；bot据此只请求变化的任务
+uint32_t task_ver = 0;
+// 任务表纪元，每次启动随机生成，重启后bot持有的版本失效
+uint32_t task_epoch = 0;
 // 执行队列
 #define EXEC_Q_N 16
 struct Task* exec_queue[EXEC_Q_N];
@@ -296,8 +301,21 @@ NTPClient timeClient(ntpUDP);
 
 WiFiClient wc;
 PubSubClient pc(wc);
-// 收发json消息
-StaticJsonDocument<1536> doc, rdoc;
+// 收发json消息，doc需容纳最多8条命令的批量帧
+StaticJsonDocument<3072> doc;
+StaticJsonDocument<1536> rdoc;
+// 回复中声明的设备能力，bot据此决定是否发送批量帧
+#define DEVICE_CAPS "batch,rid,delta"
+// 批量帧回复中最多记录的状态数，超出时回复truncated=true
+#define BATCH_RESULT_N 12
+bool batch_mode = false;
+int batch_index = 0, batch_ok = 0, batch_n = 0;
+JsonArray batch_results;
+// 最近收到的命令为MessagePack格式时，回复也使用MessagePack
+bool reply_msgpack = false;
+uint8_t pub_buf[1536];
+// 正在处理的命令的关联ID，回复中原样带回，bot据此匹配请求并统计往返时延；0表示没有
+uint32_t cur_rid = 0;
 
 size_t last_check;
 unsigned long start_time_millis; // 记录系统启动时间
@@ -543,11 +561,34 @@ void itv() { // 0.5s
 
 
 void msg_pub_print(int code, uint64_t uid, const String& msg, int reset) {
+  if (batch_mode) { // 批量帧中只记录每条命令的状态，全部执行完后统一回复
+    batch_n++;
+    if (code == 200) batch_ok++;
+    if ((int)batch_results.size() < BATCH_RESULT_N) {
+      JsonObject r = batch_results.createNestedObject();
+      r["i"] = batch_index;
+      r["code"] = code;
+      r["msg"] = msg;
+    } else {
+      rdoc["truncated"] = true;
+    }
+    return ;
+  }
   if (!(WiFi.status()==WL_CONNECTED && pc.connected())) return ;
   if (reset) rdoc.clear();
   rdoc["chat_id"] = uid;
   rdoc["code"] = code;
   rdoc["message"] = String(config[DEVICE_NAME]) + ": " + msg + " [RunTime: " + formatUptime() + "]";
+  rdoc["caps"] = DEVICE_CAPS;
+  if (cur_rid) rdoc["rid"] = cur_rid;
+  else rdoc.remove("rid"); // 录制完成等主动上报不属于任何请求
+  if (reply_msgpack) {
+    size_t n = serializeMsgPack(rdoc, pub_buf, sizeof(pub_buf));
+    pc.publish(config[MQTT_PUBTOPIC], pub_buf, n);
+    serializeJson(rdoc, Serial);
+    Serial.println();
+    return ;
+  }
   String result;
   serializeJson(rdoc, result);
   pc.publish(config[MQTT_PUBTOPIC], result.c_str());
@@ -555,17 +596,9 @@ void msg_pub_print(int code, uint64_t uid, const String& msg, int reset) {
 }
 
  
-int solve_msg(String Msg) {
-  doc.clear();
-  rdoc.clear();
-  DeserializationError error = deserializeJson(doc, Msg);
-  if (error) {
-    Serial.print("JSON parse error: ");
-    Serial.println(error.c_str());
-    return -1;
-  }
-  String cmd = doc["cmd"];
-  uint64_t uid = doc["chat_id"];
+// 处理单条命令，d为命令对象（单条消息本身或批量帧中的一项）
+void solve_cmd(JsonVariant d, uint64_t uid) {
+  String cmd = d["cmd"];
 
   if (cmd == "taskidlist") {
     for (int i=0,j=0; i<TASK_N; i++) {
@@ -578,7 +611,7 @@ int solve_msg(String Msg) {
   }
 
   if (cmd == "task") {
-    int id = doc["id"];
+    int id = d["id"];
     if (0 <= id && id < TASK_N && tasklist[id].remain>0) {
       rdoc["task"]["remain"] = tasklist[id].remain;
       rdoc["task"]["start"] = tasklist[id].start;
@@ -595,19 +628,33 @@ int solve_msg(String Msg) {
   }
 
   if (cmd == "tasklist") {
-    for (int i=0,j=0; i<TASK_N; i++) {
+    // 纪元一致且since不超过当前版本时只回复since之后变化的任务，否则回复完整任务表
+    uint32_t since = d["since"].as<uint32_t>();
+    bool delta = since > 0 && since <= task_ver && d["epoch"].as<uint32_t>() == task_epoch;
+    JsonArray tasks = rdoc.createNestedArray(delta ? "tasks_delta" : "tasks");
+    JsonArray removed;
+    if (delta) {
+      removed = rdoc.createNestedArray("removed");
+      rdoc["base"] = since;
+    }
+    for (int i=0; i<TASK_N; i++) {
+      if (delta && tasklist[i].ver <= since) continue;
       if (tasklist[i].remain>0) {
-        rdoc["tasks"][j]["remain"] = tasklist[i].remain;
-        rdoc["tasks"][j]["start"] = tasklist[i].start;
-        rdoc["tasks"][j]["freq"] = tasklist[i].freq;
-        rdoc["tasks"][j]["cmd"] = tasklist[i].cmd;
-        rdoc["tasks"][j]["xid"] = tasklist[i].xid;
-        rdoc["tasks"][j]["cron"] = tasklist[i].cron;
-        rdoc["tasks"][j]["taskname"] = tasklist[i].taskname;
-        rdoc["tasks"][j]["taskid"] = i;
-        j++;
+        JsonObject t = tasks.createNestedObject();
+        t["remain"] = tasklist[i].remain;
+        t["start"] = tasklist[i].start;
+        t["freq"] = tasklist[i].freq;
+        t["cmd"] = tasklist[i].cmd;
+        t["xid"] = tasklist[i].xid;
+        t["cron"] = tasklist[i].cron;
+        t["taskname"] = tasklist[i].taskname;
+        t["taskid"] = i;
+      } else if (delta) {
+        removed.add(i);
       }
     }
+    rdoc["ver"] = task_ver;
+    rdoc["epoch"] = task_epoch;
     msg_pub_print(200, uid, "get tasklist ok", false);
   }
 
@@ -622,7 +669,7 @@ int solve_msg(String Msg) {
   }
 
   if (cmd == "terminate") { // 支持非数字字符分割的taskid 2,4 1
-    String cmds = doc["taskid"];
+    String cmds = d["taskid"];
     int cmds_len = cmds.length();
     for (int i=0, j; (j=i)<cmds_len; i=j) {
       while (j<cmds_len && !('0' <= cmds.charAt(j) && cmds.charAt(j) <= '9') ) j++;
@@ -631,6 +678,7 @@ int solve_msg(String Msg) {
       while (j<cmds_len && ('0' <= cmds.charAt(j) && cmds.charAt(j) <= '9') ) id = id*10+cmds.charAt(j++)-'0';
       if (i<j && 0 <= id && id < TASK_N && tasklist[id].remain>0) {
         tasklist[id].remain = 0;
+        tasklist[id].ver = ++task_ver;
         msg_pub_print(200, uid, "terminate task "+cmds.substring(i,j)+" ok", false);
       } else {
         msg_pub_print(400, uid, "illegal task id", false);
@@ -640,7 +688,7 @@ int solve_msg(String Msg) {
   }
 
   if (cmd == "terminatename") { // 支持非数字字符分割的taskid 2,4 1
-    String cmds = doc["taskname"];
+    String cmds = d["taskname"];
     int cmds_len = cmds.length();
     for (int i=0, j; (j=i)<cmds_len; i=j) {
       while (j<cmds_len && !(33 <= cmds.charAt(j) && cmds.charAt(j) <= 126) ) j++; // 跳过不可见字符
@@ -651,6 +699,7 @@ int solve_msg(String Msg) {
         for (int id=0; id<TASK_N; id++) {
           if (tasklist[id].remain>0 && tasklist[id].taskname == taskname) {
             tasklist[id].remain = 0;
+            tasklist[id].ver = ++task_ver;
             msg_pub_print(200, uid, "terminate task "+cmds.substring(i,j)+" ok", false);
           }
         }
@@ -662,19 +711,19 @@ int solve_msg(String Msg) {
   }
 
   if (cmd == "exec") {                            // exec cmd
-    String cmds = doc["name"];
+    String cmds = d["name"];
     // Serial.println(cmds);
     int cmds_len = cmds.length();
     for (int i=0, t=0, j; (j=i)<cmds_len; t++, i=j+1) { // 以逗号分割命令
       while (j<cmds_len && cmds.charAt(j) != ',') j++;
       
       String name = cmds.substring(i,j);
-      uint64_t start = doc["start"]; 
-      uint64_t freq = doc["freq"];
-      uint64_t remain = doc["remain"];
-      uint64_t delay = doc["delay"];
-      String cron = doc["cron"];
-      String taskname = doc["taskname"];
+      uint64_t start = d["start"]; 
+      uint64_t freq = d["freq"];
+      uint64_t remain = d["remain"];
+      uint64_t delay = d["delay"];
+      String cron = d["cron"];
+      String taskname = d["taskname"];
       // Serial.println(name+" "+start+" "+freq);
       int xid = 0;
       for (; xid<COPY_N; xid++) {
@@ -709,14 +758,15 @@ int solve_msg(String Msg) {
       tasklist[task_id].uid = uid;
       tasklist[task_id].cron = cron;
       tasklist[task_id].taskname = taskname;
+      tasklist[task_id].ver = ++task_ver;
       msg_pub_print(200, uid, "add "+name+" to tasklist", false);
     }
     
   }
 
   if (cmd == "copy") {                   // copy cmd 
-    String name = doc["name"];
-    String old = doc["old"];
+    String name = d["name"];
+    String old = d["old"];
     Serial.println(name+" "+old);
     // check old exist
     int i = 0;
@@ -730,7 +780,7 @@ int solve_msg(String Msg) {
       // not exist
       if (i == COPY_N) {
         msg_pub_print(400, uid, "copy failure: old name ["+old+"] not exist!", false);
-        return 0;
+        return;
       }
     } else { // no old
       // check update
@@ -751,18 +801,54 @@ int solve_msg(String Msg) {
     copy_mode = 1;
     msg_pub_print(200, uid, "copy start ok", false);
   }
+}
+
+// 首字节为'{'时按JSON解析，否则按MessagePack解析
+int solve_msg(const char* payload, size_t length) {
+  doc.clear();
+  rdoc.clear();
+  reply_msgpack = length > 0 && payload[0] != '{';
+  DeserializationError error = reply_msgpack ? deserializeMsgPack(doc, payload, length)
+                                             : deserializeJson(doc, payload, length);
+  if (error) {
+    Serial.print("JSON parse error: ");
+    Serial.println(error.c_str());
+    return -1;
+  }
+  String cmd = doc["cmd"];
+  uint64_t uid = doc["chat_id"];
+  cur_rid = doc["rid"] | 0;
+
+  if (cmd == "batch") { // 批量帧，协议见 BATCH_PROTOCOL.md
+    JsonArray items = doc["items"];
+    batch_results = rdoc.createNestedArray("results");
+    batch_mode = true;
+    batch_ok = batch_n = 0;
+    for (batch_index = 0; batch_index < (int)items.size(); batch_index++) {
+      solve_cmd(items[batch_index], uid);
+    }
+    batch_mode = false;
+    msg_pub_print(batch_ok == batch_n ? 200 : 400, uid, String("batch ")+batch_ok+"/"+batch_n+" ok", false);
+    cur_rid = 0;
+    return 0;
+  }
+
+  solve_cmd(doc.as<JsonVariant>(), uid);
+  cur_rid = 0;
   return 0;
 }
 
+int solve_msg(const String& Msg) {
+  return solve_msg(Msg.c_str(), Msg.length());
+}
+
 void sub_msg_hander(char* topic, byte* payload,unsigned int length){
   Serial.printf("MQTT subscribe data from topic: %s\r\n",topic);
   for(unsigned int i=0;i<length;++i){
     Serial.print((char)payload[i]);
   }
   Serial.println();
-  payload[length] = 0;
-  String Msg = String((char*)payload);
-  solve_msg(Msg);
+  solve_msg((const char*)payload, length);
 }
 
 // 持久化学到的红外信号
@@ -811,6 +897,8 @@ void record_copy(String& sc) {
 void setup() {
   // 记录启动时间
   start_time_millis = millis();
+  // 任务表纪元非0，bot未持有纪元时不会误匹配
+  task_epoch = ESP.random() | 1;
 
   // led builtin
   pinMode(LED_BUILTIN, OUTPUT);
@@ -895,11 +983,13 @@ void loop() {
           exec_queue[eqsz++] = &tasklist[i];
           tasklist[i].start = last_check;
           if (--tasklist[i].remain == 0) tasklist[i].cron = ""; // 消除影响后续任务
+          tasklist[i].ver = ++task_ver;
         }
       } else if (tasklist[i].start <= last_check) {
         exec_queue[eqsz++] = &tasklist[i];
         tasklist[i].start += tasklist[i].freq;
         tasklist[i].remain--;
+        tasklist[i].ver = ++task_ver;
       }
     }
     if (eqsz == EXEC_Q_N) break;
@@ -0,0 +1,95 @@
+#!/usr/bin/python3
+# 主要功能：比较MQTT消息各编码方式的编解码耗时与消息大小
+# 用法: python test/bench_codec.py [-n 次数]
+import argparse
+import ast
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "tg"))
+import codec  # noqa: E402
+
+
+# bot -> 设备: 典型的exec命令
+EXEC_MSG = {
+    "cmd": "exec", "name": "ac_on", "start": 0, "delay": 3600, "freq": 86400,
+    "cron": "", "remain": 30, "taskname": "morning", "chat_id": 1234567890,
+}
+
+# 设备 -> bot: 满载(TASK_N=16)的tasklist回复
+TASKS_MSG = {
+    "chat_id": 1234567890,
+    "code": 200,
+    "message": "home: get tasklist ok [RunTime: 3d04h05m06s]",
+    "tasks": [
+        {
+            "remain": 10 + i, "start": 1760000000 + i * 60, "freq": 3600,
+            "cmd": f"cmd{i}", "xid": i % 12, "cron": "0 8 * * 1-5" if i % 2 else "",
+            "taskname": f"task{i}", "taskid": i,
+        }
+        for i in range(16)
+    ],
+}
+
+
+class ReprCodec(codec.Codec):
+    """旧实现：str(data)，设备端宽松解析"""
+    name = "repr"
+    
+    def encode(self, data):
+        return str(data).encode("utf-8")
+    
+    def decode(self, payload):
+        return ast.literal_eval(payload.decode("utf-8"))
+
+
+class StdJsonCodec(codec.Codec):
+    """标准库json"""
+    name = "json(stdlib)"
+    
+    def encode(self, data):
+        return json.dumps(data, separators=(",", ":")).encode("utf-8")
+    
+    def decode(self, payload):
+        return json.loads(payload)
+
+
+def candidates():
+    result = [ReprCodec(), StdJsonCodec()]
+    if codec.orjson is not None:
+        result.append(codec.JsonCodec())
+    else:
+        print("未安装orjson，跳过orjson")
+    if codec.msgpack is not None:
+        result.append(codec.MsgPackCodec())
+    else:
+        print("未安装msgpack，跳过msgpack")
+    return result
+
+
+def bench(c, msg, n):
+    payload = c.encode(msg)
+    assert c.decode(payload) == msg, c.name
+    enc = timeit.timeit(lambda: c.encode(msg), number=n) / n * 1e6
+    dec = timeit.timeit(lambda: c.decode(payload), number=n) / n * 1e6
+    return len(payload), enc, dec
+
+
+def main():
+    parser = argparse.ArgumentParser(description="MQTT消息编解码基准测试")
+    parser.add_argument("-n", type=int, default=20000, help="每项测量的循环次数")
+    args = parser.parse_args()
+    
+    codecs = candidates()
+    for title, msg in (("exec命令", EXEC_MSG), ("tasklist回复(16个任务)", TASKS_MSG)):
+        print(f"\n== {title} ==")
+        print(f"{'codec':<14}{'bytes':>8}{'encode(us)':>12}{'decode(us)':>12}")
+        for c in codecs:
+            size, enc, dec = bench(c, msg, args.n)
+            print(f"{c.name:<14}{size:>8}{enc:>12.2f}{dec:>12.2f}")
+
+
+if __name__ == "__main__":
+    main()
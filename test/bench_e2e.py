@@ -0,0 +1,425 @@
+#!/usr/bin/python3
+# 主要功能：端到端基准测试，测量bot在真实main.py装配下的吞吐量与时延
+#
+# 在本机启动：
+#   - MQTT服务器（amqtt，也可用--mqtt-host/--mqtt-port指定已有的服务器）
+#   - 模拟Telegram Bot API的HTTP服务器（getUpdates长轮询、sendMessage等）
+#   - esp_simulator.py中的模拟设备
+# 然后以子进程运行tg/main.py（或--program async_main.py），通过ir_api_url指向模拟的Bot API。
+# 若干模拟用户闭环发送/exec、/tasklist与别名执行（alias_exc回调），统计：
+#   - 每秒完成的命令数
+#   - 命令→MQTT发布（用户更新进入getUpdates到设备收到命令）的p50/p99
+#   - 设备回复→sendMessage（设备发布回复到bot调用sendMessage）的p50/p99
+#   - 命令→回复到达用户的端到端p50/p99
+#   - bot进程的CPU占用与最大RSS
+# 结果写入JSON文件，便于比较多次运行。
+#
+# 用法:
+#   pip install amqtt   # 未指定--mqtt-host时需要
+#   python test/bench_e2e.py --users 20 --duration 30 --out bench_e2e.json
+import argparse
+import asyncio
+import json
+import os
+import random
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.parse
+from typing import Any, Dict, List, Tuple
+from aiohttp import web
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import esp_simulator  # noqa: E402
+
+try:
+    import psutil
+except ImportError:  # 未安装时从/proc读取
+    psutil = None
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TOKEN = "123456:bench"
+ADMIN = 1
+USER_BASE = 10_000_000
+ALIAS = "bench"
+ALIAS_COMMANDS = ["exec tv", "exec ac"]
+
+
+def percentiles(samples: List[float]) -> Dict[str, float]:
+    """计算分位数（毫秒）"""
+    if not samples:
+        return {"n": 0, "p50": 0.0, "p99": 0.0, "max": 0.0}
+    s = sorted(samples)
+    pick = lambda p: s[min(len(s) - 1, int(len(s) * p))] * 1000
+    return {"n": len(s), "p50": round(pick(0.50), 3), "p99": round(pick(0.99), 3), "max": round(s[-1] * 1000, 3)}
+
+
+class Recorder:
+    """记录各阶段的时间戳并计算时延"""
+    
+    def __init__(self):
+        self.recording = False
+        self.command_sent: Dict[int, float] = {}          # chat_id -> 用户发出命令的时间
+        self.reply_sent: Dict[Tuple[int, str], List[float]] = {}  # (chat_id, 设备消息) -> 设备发布时间
+        self.waiters: Dict[int, asyncio.Future] = {}
+        self.command_to_publish: List[float] = []
+        self.reply_to_send: List[float] = []
+        self.end_to_end: List[float] = []
+        self.completed = 0
+        self.cached = 0
+        self.timeouts = 0
+    
+    def on_command(self, chat_id: int) -> None:
+        started = self.command_sent.pop(chat_id, None)
+        if started is not None and self.recording:
+            self.command_to_publish.append(time.perf_counter() - started)
+    
+    def on_reply(self, chat_id: int, message: str) -> None:
+        self.reply_sent.setdefault((chat_id, message), []).append(time.perf_counter())
+    
+    def on_send_message(self, chat_id: int, text: str) -> None:
+        now = time.perf_counter()
+        done = False
+        for line in text.split("\n"):
+            sent = self.reply_sent.get((chat_id, line))
+            if sent:
+                if self.recording:
+                    self.reply_to_send.append(now - sent.pop(0))
+                else:
+                    sent.pop(0)
+                done = True
+            elif "(cached " in line:
+                self.cached += self.recording
+                done = True
+        waiter = self.waiters.get(chat_id)
+        if done and waiter is not None and not waiter.done():
+            waiter.set_result(now)
+
+
+class BenchSimulator(esp_simulator.Simulator):
+    """记录设备收到命令与发布回复时间的模拟器"""
+    
+    def __init__(self, recorder: Recorder, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.recorder = recorder
+    
+    def on_command(self, device, doc):
+        self.recorder.on_command(doc.get("chat_id", 0))
+    
+    def on_reply(self, device, reply):
+        self.recorder.on_reply(reply.get("chat_id", 0), reply.get("message", ""))
+
+
+class FakeBotAPI:
+    """模拟Telegram Bot API，getUpdates返回模拟用户的更新，记录sendMessage"""
+    
+    def __init__(self, recorder: Recorder):
+        self.recorder = recorder
+        self.updates: List[Dict[str, Any]] = []
+        self.update_id = 0
+        self.message_id = 0
+        self.calls: Dict[str, int] = {}
+        self.polled = asyncio.Event()
+        self._arrived = asyncio.Event()
+    
+    def push(self, update: Dict[str, Any]) -> None:
+        self.update_id += 1
+        update["update_id"] = self.update_id
+        self.updates.append(update)
+        self._arrived.set()
+    
+    def message(self, chat_id: int, text: str = "") -> Dict[str, Any]:
+        self.message_id += 1
+        return {
+            "message_id": self.message_id, "date": int(time.time()), "text": text,
+            "from": {"id": 1, "is_bot": True, "first_name": "bench_bot"},
+            "chat": {"id": chat_id, "type": "private"},
+        }
+    
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        self.calls[method] = self.calls.get(method, 0) + 1
+        params = await self.params(request)
+        
+        if method == "getUpdates":
+            result = await self.get_updates(int(params.get("offset", 0) or 0), float(params.get("timeout", 0) or 0))
+        elif method == "sendMessage":
+            chat_id, text = int(params["chat_id"]), str(params.get("text", ""))
+            self.recorder.on_send_message(chat_id, text)
+            result = self.message(chat_id, text)
+        elif method.startswith(("send", "edit")):
+            result = self.message(int(params.get("chat_id", 0) or 0))
+        elif method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "bench_bot", "username": "bench_bot"}
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+    
+    @staticmethod
+    async def params(request: web.Request) -> Dict[str, Any]:
+        """读取请求参数；AsyncTeleBot以GET请求携带表单请求体，需自行解析"""
+        params: Dict[str, Any] = dict(request.query)
+        if request.content_type == "application/json":
+            params.update(await request.json())
+        elif request.content_type == "multipart/form-data":
+            async for part in await request.multipart():
+                params[part.name] = (await part.read()).decode("utf-8")
+        elif request.body_exists:
+            params.update(urllib.parse.parse_qsl(await request.text()))
+        return params
+    
+    async def get_updates(self, offset: int, timeout: float) -> List[Dict[str, Any]]:
+        self.polled.set()
+        self.updates = [u for u in self.updates if u["update_id"] >= offset]
+        if not self.updates and timeout > 0:
+            self._arrived.clear()
+            try:
+                await asyncio.wait_for(self._arrived.wait(), min(timeout, 5))
+            except asyncio.TimeoutError:
+                pass
+        return self.updates[:100]
+
+
+class User:
+    """闭环的模拟用户：发出一条命令，等待设备回复到达后再发下一条"""
+    
+    def __init__(self, index: int, api: FakeBotAPI, recorder: Recorder, mix: List[Tuple[str, int]], timeout: float):
+        self.chat_id = USER_BASE + index
+        self.api = api
+        self.recorder = recorder
+        self.actions = [name for name, _ in mix]
+        self.weights = [weight for _, weight in mix]
+        self.timeout = timeout
+    
+    def update(self, action: str) -> Dict[str, Any]:
+        sender = {"id": self.chat_id, "is_bot": False, "first_name": "bench", "last_name": str(self.chat_id)}
+        if action == "alias":
+            message = self.api.message(self.chat_id, "alias")
+            return {"callback_query": {
+                "id": str(self.api.update_id + 1), "from": sender, "message": message,
+                "chat_instance": str(self.chat_id), "data": f"alias_exc_{ALIAS}",
+            }}
+        text = {"exec": "/exec tv", "tasklist": "/tasklist"}[action]
+        message = self.api.message(self.chat_id, text)
+        message["from"] = sender
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return {"message": message}
+    
+    async def run(self, deadline: float) -> None:
+        loop = asyncio.get_running_loop()
+        while time.perf_counter() < deadline:
+            action = random.choices(self.actions, self.weights)[0]
+            waiter = self.recorder.waiters[self.chat_id] = loop.create_future()
+            started = time.perf_counter()
+            self.recorder.command_sent[self.chat_id] = started
+            self.api.push(self.update(action))
+            try:
+                finished = await asyncio.wait_for(waiter, self.timeout)
+            except asyncio.TimeoutError:
+                self.recorder.timeouts += self.recorder.recording
+                continue
+            if self.recorder.recording:
+                self.recorder.completed += 1
+                self.recorder.end_to_end.append(finished - started)
+
+
+class ProcessSampler:
+    """采样bot进程的CPU时间与RSS"""
+    
+    def __init__(self, pid: int):
+        self.pid = pid
+        self.rss_max = 0
+        self.cpu_start = self.cpu_time()
+        self.wall_start = time.perf_counter()
+    
+    def cpu_time(self) -> float:
+        if psutil is not None:
+            t = psutil.Process(self.pid).cpu_times()
+            return t.user + t.system
+        with open(f"/proc/{self.pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    
+    def rss(self) -> int:
+        if psutil is not None:
+            return psutil.Process(self.pid).memory_info().rss
+        with open(f"/proc/{self.pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+        return 0
+    
+    def reset(self) -> None:
+        self.cpu_start = self.cpu_time()
+        self.wall_start = time.perf_counter()
+    
+    async def run(self) -> None:
+        while True:
+            try:
+                self.rss_max = max(self.rss_max, self.rss())
+            except (OSError, ProcessLookupError):
+                return
+            await asyncio.sleep(0.5)
+    
+    def result(self) -> Dict[str, float]:
+        wall = time.perf_counter() - self.wall_start
+        return {
+            "cpu_percent": round((self.cpu_time() - self.cpu_start) / wall * 100, 1),
+            "rss_max_mb": round(self.rss_max / 2 ** 20, 1),
+        }
+
+
+def write_config(workdir: str, args, devices: List[esp_simulator.SimulatedDevice], users: int) -> None:
+    """生成bot的env.json与db.json"""
+    device_configs = [
+        {
+            "name": d.name, "ir_mqtthost": args.mqtt_host, "ir_mqttport": args.mqtt_port,
+            "ir_username": "", "ir_password": "", "ir_codec": args.codec,
+            "ir_sub_topic": d.pub_topic, "ir_pub_topic": d.sub_topic,
+        }
+        for d in devices
+    ]
+    env = {
+        "ir_bot_token": TOKEN,
+        "ir_admin_chat_id": ADMIN,
+        "ir_api_url": f"http://127.0.0.1:{args.api_port}",
+        "ir_shadow_ttl": args.shadow_ttl,
+        "device": device_configs,
+    }
+    db = {
+        "device": device_configs[0],
+        "user": [ADMIN] + [USER_BASE + i for i in range(users)],
+        "preference": {devices[0].name: {ALIAS: ALIAS_COMMANDS}},
+    }
+    with open(os.path.join(workdir, "env.json"), "w") as f:
+        json.dump(env, f, indent=2)
+    with open(os.path.join(workdir, "db.json"), "w") as f:
+        json.dump(db, f, indent=2)
+
+
+async def start_broker(port: int):
+    from amqtt.broker import Broker
+    broker = Broker({"listeners": {"default": {"type": "tcp", "bind": f"127.0.0.1:{port}"}}})
+    await broker.start()
+    return broker
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+async def bench(args) -> Dict[str, Any]:
+    recorder = Recorder()
+    broker = None
+    if args.spawn_broker:
+        broker = await start_broker(args.mqtt_port)
+    
+    api = FakeBotAPI(recorder)
+    app = web.Application()
+    app.router.add_route("*", "/bot{token}/{method}", api.handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", args.api_port).start()
+    
+    devices = [
+        esp_simulator.SimulatedDevice(f"bench{i}", f"bench{i}/cmd", f"bench{i}/reply", cmds=["tv", "ac", "light"])
+        for i in range(args.devices)
+    ]
+    faults = esp_simulator.Faults(args.device_latency, args.device_jitter)
+    simulator = BenchSimulator(recorder, args.mqtt_host, args.mqtt_port, devices, faults)
+    sim_task = asyncio.create_task(simulator.run())
+    
+    workdir = tempfile.mkdtemp(prefix="bench_e2e_")
+    write_config(workdir, args, devices, args.users)
+    program = os.path.join(ROOT, "tg", args.program)
+    log = open(os.path.join(workdir, "bot.out"), "w")
+    proc = await asyncio.create_subprocess_exec(sys.executable, program, cwd=workdir, stdout=log, stderr=log)
+    sampler = ProcessSampler(proc.pid)
+    sampler_task = asyncio.create_task(sampler.run())
+    
+    try:
+        await asyncio.wait_for(api.polled.wait(), 30)
+        mix = [(name, int(weight)) for name, weight in (item.split("=") for item in args.mix.split(","))]
+        users = [User(i, api, recorder, mix, args.timeout) for i in range(args.users)]
+        
+        start = time.perf_counter()
+        deadline = start + args.warmup + args.duration
+        user_tasks = [asyncio.create_task(user.run(deadline)) for user in users]
+        await asyncio.sleep(args.warmup)
+        recorder.recording = True
+        sampler.reset()
+        measured = time.perf_counter()
+        await asyncio.gather(*user_tasks)
+        elapsed = time.perf_counter() - measured
+        recorder.recording = False
+        process = sampler.result()
+    finally:
+        if proc.returncode is None:
+            proc.send_signal(signal.SIGINT)
+            try:
+                await asyncio.wait_for(proc.wait(), 10)
+            except asyncio.TimeoutError:
+                proc.kill()
+        log.close()
+        sampler_task.cancel()
+        sim_task.cancel()
+        await runner.cleanup()
+        if broker is not None:
+            await broker.shutdown()
+    
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "git": git_revision(),
+        "config": vars(args),
+        "duration": round(elapsed, 3),
+        "completed": recorder.completed,
+        "cached": recorder.cached,
+        "timeouts": recorder.timeouts,
+        "commands_per_sec": round(recorder.completed / elapsed, 2),
+        "latency_ms": {
+            "command_to_publish": percentiles(recorder.command_to_publish),
+            "reply_to_send": percentiles(recorder.reply_to_send),
+            "end_to_end": percentiles(recorder.end_to_end),
+        },
+        "bot_process": process,
+        "api_calls": api.calls,
+        "bot_output": os.path.join(workdir, "bot.out"),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="bot端到端吞吐量与时延基准测试")
+    parser.add_argument("--users", type=int, default=10, help="模拟用户数")
+    parser.add_argument("--devices", type=int, default=1, help="模拟设备数（命令发往第一台）")
+    parser.add_argument("--duration", type=float, default=20, help="测量时长（秒）")
+    parser.add_argument("--warmup", type=float, default=3, help="预热时长（秒），不计入结果")
+    parser.add_argument("--mix", default="exec=5,tasklist=3,alias=2", help="各操作的权重")
+    parser.add_argument("--timeout", type=float, default=10, help="单条命令等待回复的超时（秒）")
+    parser.add_argument("--program", default="main.py", help="tg目录下的入口，main.py或async_main.py")
+    parser.add_argument("--codec", default="json", help="设备的ir_codec")
+    parser.add_argument("--shadow-ttl", type=float, default=30, help="bot的ir_shadow_ttl")
+    parser.add_argument("--device-latency", type=float, default=0.0, help="模拟设备的回复延迟（秒）")
+    parser.add_argument("--device-jitter", type=float, default=0.0, help="模拟设备的回复延迟抖动（秒）")
+    parser.add_argument("--mqtt-host", default="127.0.0.1")
+    parser.add_argument("--mqtt-port", type=int, default=18830)
+    parser.add_argument("--no-broker", dest="spawn_broker", action="store_false",
+                        help="不启动本地amqtt服务器，使用--mqtt-host/--mqtt-port指定的服务器")
+    parser.add_argument("--api-port", type=int, default=18081, help="模拟Bot API的端口")
+    parser.add_argument("--out", default="bench_e2e.json", help="结果文件")
+    args = parser.parse_args()
+    
+    result = asyncio.run(bench(args))
+    with open(args.out, "w") as f:
+        json.dump(result, f, indent=2, ensure_ascii=False)
+    print(json.dumps({k: result[k] for k in ("commands_per_sec", "completed", "timeouts", "latency_ms", "bot_process")}, indent=2))
+    print(f"结果已写入 {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,539 @@
+#!/usr/bin/python3
+# 主要功能：模拟运行esp/IR.ino的ESP8266设备，用于在没有足够实体设备时对bot做负载测试
+#
+# 一个进程内可运行任意多台模拟设备，共用一个MQTT连接。每台设备实现IR.ino中
+# solve_msg的协议：copy（COPY_N个槽位轮换覆盖）、exec（start/delay/freq/cron/remain）、
+# TASK_N与EXEC_Q_N限制、task、tasklist、taskidlist、cmdlist、terminate、terminatename、
+# 批量帧、rid回传与任务表增量；回复的JSON结构与tg/handlers.py中各处理器所需一致。
+#
+# 用法:
+#   python test/esp_simulator.py -n 50 --cmds tv,ac --latency 0.05 --jitter 0.02 --drop 0.01
+#   python test/esp_simulator.py -n 50 --env-out devices.json   # 生成bot的设备配置
+import argparse
+import asyncio
+import json
+import random
+import time
+from typing import Any, Dict, List, Optional, Tuple
+import aiomqtt
+
+try:
+    import msgpack
+except ImportError:  # 未安装时只支持JSON
+    msgpack = None
+
+
+COPY_N = 12
+TASK_N = 16
+EXEC_Q_N = 16
+BATCH_RESULT_N = 12
+DEVICE_CAPS = "batch,rid,delta"
+TIMEZONE_OFFSET = 8 * 3600
+
+
+# ============ cron，与IR.ino中parse_cron/match_cron一致 ============
+
+def parse_range(field: str, min_val: int, max_val: int) -> Optional[int]:
+    """解析cron的一个字段，返回位掩码，没有任何取值时返回None"""
+    mask, count = 0, 0
+    for token in field.split(","):
+        if token.startswith("*"):
+            step = int(token[2:]) if token[1:2] == "/" and token[2:].isdigit() else 1
+            values = range(min_val, max_val + 1, max(step, 1))
+        elif "-" in token:
+            start, _, end = token.partition("-")
+            end, _, step = end.partition("/")
+            start, end = max(_atoi(start), min_val), min(_atoi(end), max_val)
+            values = range(start, end + 1, max(_atoi(step), 1))
+        else:
+            num = _atoi(token)
+            values = [num] if min_val <= num <= max_val else []
+        for v in values:
+            mask |= 1 << v
+            count += 1
+    return mask if count else None
+
+
+def _atoi(s: str) -> int:
+    digits = ""
+    for ch in s.strip():
+        if not ch.isdigit():
+            break
+        digits += ch
+    return int(digits) if digits else 0
+
+
+def parse_cron(expr: str) -> Optional[Tuple[int, ...]]:
+    """解析5字段或6字段cron表达式，返回(秒, 分, 时, 日, 月, 星期)位掩码"""
+    fields = expr.split()
+    if len(fields) == 5:
+        fields = ["0"] + fields
+    if len(fields) != 6:
+        return None
+    bounds = ((0, 59), (0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+    masks = [parse_range(f, lo, hi) for f, (lo, hi) in zip(fields, bounds)]
+    if None in masks:
+        return None
+    if masks[5] & 0x81:  # 星期0和7都表示周日
+        masks[5] |= 0x81
+    return tuple(masks)
+
+
+def match_cron(timestamp: int, pattern: Tuple[int, ...]) -> bool:
+    t = time.gmtime(timestamp + TIMEZONE_OFFSET)
+    values = (t.tm_sec, t.tm_min, t.tm_hour, t.tm_mday, t.tm_mon, (t.tm_wday + 1) % 7)
+    return all(mask >> v & 1 for mask, v in zip(pattern, values))
+
+
+# ============ 设备 ============
+
+def split_names(text: str) -> List[str]:
+    """按逗号分割exec的命令名称，与IR.ino一致：空串没有名称，末尾的逗号不产生空名称"""
+    names, i = [], 0
+    while i < len(text):
+        j = text.find(",", i)
+        j = len(text) if j < 0 else j
+        names.append(text[i:j])
+        i = j + 1
+    return names
+
+
+class Task:
+    def __init__(self):
+        self.xid = 0
+        self.remain = 0
+        self.start = 0
+        self.freq = 0
+        self.uid = 0
+        self.cmd = ""
+        self.taskname = ""
+        self.cron = ""
+        self.cp: Optional[Tuple[int, ...]] = None
+        self.ver = 0
+
+
+class SimulatedDevice:
+    """一台模拟设备，只实现协议状态机，不涉及网络"""
+    
+    def __init__(self, name: str, sub_topic: str, pub_topic: str,
+                 cmds: Optional[List[str]] = None, capture_delay: float = 2.0, admin_uid: int = 0):
+        """
+        Args:
+            name: 设备名称
+            sub_topic: 设备订阅的主题（bot的ir_pub_topic）
+            pub_topic: 设备发布的主题（bot的ir_sub_topic）
+            cmds: 预置的已学习命令
+            capture_delay: copy后模拟收到红外信号的秒数，为0时不自动完成录制
+            admin_uid: 管理员聊天ID，任务积压时通知
+        """
+        self.name = name
+        self.sub_topic = sub_topic
+        self.pub_topic = pub_topic
+        self.capture_delay = capture_delay
+        self.admin_uid = admin_uid
+        self.started = time.monotonic()
+        
+        self.copy_name = [""] * COPY_N
+        self.copy_length = [0] * COPY_N
+        self.copy_cover = 0
+        self.copy_mode = False
+        self.comming_copy_name = ""
+        self.copy_uid = 0
+        self.copy_deadline = 0.0
+        for i, cmd in enumerate((cmds or [])[:COPY_N]):
+            self.copy_name[i] = cmd
+            self.copy_length[i] = 100
+        
+        self.tasklist = [Task() for _ in range(TASK_N)]
+        self.task_ver = 0
+        self.task_epoch = random.getrandbits(32) | 1
+        self.last_check = int(time.time())
+        
+        self.rdoc: Dict[str, Any] = {}
+        self.rid = 0
+        self.batch_results: Optional[List[Dict[str, Any]]] = None
+        self.batch_index = self.batch_ok = self.batch_n = 0
+        self.outbox: List[Dict[str, Any]] = []
+    
+    def format_uptime(self) -> str:
+        s = int(time.monotonic() - self.started)
+        text = f"{s // 86400}d{s % 86400 // 3600}h{s % 3600 // 60}m{s % 60}s"
+        return text.lstrip("0dhm") or "0s"
+    
+    def msg_pub_print(self, code: int, uid: int, msg: str, reset: bool) -> None:
+        if self.batch_results is not None:
+            self.batch_n += 1
+            if code == 200:
+                self.batch_ok += 1
+            if len(self.batch_results) < BATCH_RESULT_N:
+                self.batch_results.append({"i": self.batch_index, "code": code, "msg": msg})
+            else:
+                self.rdoc["truncated"] = True
+            return
+        if reset:
+            self.rdoc = {}
+        self.rdoc["chat_id"] = uid
+        self.rdoc["code"] = code
+        self.rdoc["message"] = f"{self.name}: {msg} [RunTime: {self.format_uptime()}]"
+        self.rdoc["caps"] = DEVICE_CAPS
+        if self.rid:
+            self.rdoc["rid"] = self.rid
+        else:
+            self.rdoc.pop("rid", None)
+        self.outbox.append(json.loads(json.dumps(self.rdoc)))
+    
+    def solve_msg(self, doc: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """处理一条命令，返回产生的回复"""
+        self.rdoc = {}
+        uid = doc.get("chat_id", 0)
+        self.rid = doc.get("rid") or 0
+        if doc.get("cmd") == "batch":
+            self.batch_results = self.rdoc["results"] = []
+            self.batch_ok = self.batch_n = 0
+            for self.batch_index, item in enumerate(doc.get("items", [])):
+                self.solve_cmd(item, uid)
+            self.batch_results = None
+            self.msg_pub_print(200 if self.batch_ok == self.batch_n else 400, uid,
+                               f"batch {self.batch_ok}/{self.batch_n} ok", False)
+        else:
+            self.solve_cmd(doc, uid)
+        self.rid = 0
+        return self.take()
+    
+    def solve_cmd(self, d: Dict[str, Any], uid: int) -> None:
+        cmd = d.get("cmd")
+        if cmd == "taskidlist":
+            self.rdoc["taskids"] = [i for i, t in enumerate(self.tasklist) if t.remain > 0]
+            self.msg_pub_print(200, uid, "get taskidlist ok", False)
+        elif cmd == "task":
+            i = int(d.get("id", 0))
+            if 0 <= i < TASK_N and self.tasklist[i].remain > 0:
+                self.rdoc["task"] = self.task_dict(i)
+                self.msg_pub_print(200, uid, "get task ok", False)
+            else:
+                self.msg_pub_print(400, uid, "illegal task id", False)
+        elif cmd == "tasklist":
+            since = int(d.get("since", 0))
+            if 0 < since <= self.task_ver and d.get("epoch") == self.task_epoch:
+                changed = [i for i, t in enumerate(self.tasklist) if t.ver > since]
+                self.rdoc["tasks_delta"] = [self.task_dict(i) for i in changed if self.tasklist[i].remain > 0]
+                self.rdoc["removed"] = [i for i in changed if self.tasklist[i].remain <= 0]
+                self.rdoc["base"] = since
+            else:
+                self.rdoc["tasks"] = [self.task_dict(i) for i, t in enumerate(self.tasklist) if t.remain > 0]
+            self.rdoc["ver"] = self.task_ver
+            self.rdoc["epoch"] = self.task_epoch
+            self.msg_pub_print(200, uid, "get tasklist ok", False)
+        elif cmd == "cmdlist":
+            self.rdoc["cmds"] = [n for n in self.copy_name if n]
+            self.msg_pub_print(200, uid, "get cmdlist ok", False)
+        elif cmd == "terminate":
+            self.terminate(str(d.get("taskid", "")), uid)
+        elif cmd == "terminatename":
+            self.terminatename(str(d.get("taskname", "")), uid)
+        elif cmd == "exec":
+            self.exec(d, uid)
+        elif cmd == "copy":
+            self.copy(str(d.get("name", "")), str(d.get("old", "")), uid)
+    
+    def task_dict(self, i: int) -> Dict[str, Any]:
+        t = self.tasklist[i]
+        return {
+            "remain": t.remain, "start": t.start, "freq": t.freq, "cmd": t.cmd,
+            "xid": t.xid, "cron": t.cron, "taskname": t.taskname, "taskid": i,
+        }
+    
+    def touch(self, task: Task) -> None:
+        """任务变化，递增任务表版本"""
+        self.task_ver += 1
+        task.ver = self.task_ver
+    
+    def terminate(self, ids: str, uid: int) -> None:
+        i, n = 0, len(ids)
+        while i < n:
+            while i < n and not ids[i].isdigit():
+                i += 1
+            j = i
+            while j < n and ids[j].isdigit():
+                j += 1
+            if i < j and int(ids[i:j]) < TASK_N and self.tasklist[int(ids[i:j])].remain > 0:
+                self.tasklist[int(ids[i:j])].remain = 0
+                self.touch(self.tasklist[int(ids[i:j])])
+                self.msg_pub_print(200, uid, f"terminate task {ids[i:j]} ok", False)
+            else:
+                self.msg_pub_print(400, uid, "illegal task id", False)
+            i = j
+    
+    def terminatename(self, names: str, uid: int) -> None:
+        i, n = 0, len(names)
+        while i < n:
+            while i < n and not 33 <= ord(names[i]) <= 126:
+                i += 1
+            j = i
+            while j < n and 33 <= ord(names[j]) <= 126:
+                j += 1
+            if i < j:
+                for t in self.tasklist:
+                    if t.remain > 0 and t.taskname == names[i:j]:
+                        t.remain = 0
+                        self.touch(t)
+                        self.msg_pub_print(200, uid, f"terminate task {names[i:j]} ok", False)
+            else:
+                self.msg_pub_print(400, uid, "illegal taskname", False)
+            i = j
+    
+    def exec(self, d: Dict[str, Any], uid: int) -> None:
+        cron = str(d.get("cron", ""))
+        for t, name in enumerate(split_names(str(d.get("name", "")))):
+            if name not in self.copy_name:
+                self.msg_pub_print(400, uid, f"exec failure, cmd name [{name}] not exist!", False)
+                continue
+            task_id = next((i for i, task in enumerate(self.tasklist) if task.remain <= 0), TASK_N)
+            if task_id == TASK_N:
+                self.msg_pub_print(400, uid, f"exec failure, tasklist is full, max is {TASK_N}", False)
+                continue
+            cp = parse_cron(cron) if cron else None
+            if cron and cp is None:
+                self.msg_pub_print(400, uid, f"exec failure, cron expr [{name}] error!", False)
+                continue
+            task = self.tasklist[task_id]
+            task.remain = int(d.get("remain", 0))
+            task.freq = int(d.get("freq", 0))
+            start = int(d.get("start", 0))
+            task.start = (start if start else int(time.time()) + int(d.get("delay", 0))) + t
+            task.cmd = name
+            task.xid = self.copy_name.index(name)
+            task.uid = uid
+            task.cron = cron
+            task.cp = cp
+            task.taskname = str(d.get("taskname", ""))
+            self.touch(task)
+            self.msg_pub_print(200, uid, f"add {name} to tasklist", False)
+    
+    def copy(self, name: str, old: str, uid: int) -> None:
+        if old:
+            if old not in self.copy_name:
+                self.msg_pub_print(400, uid, f"copy failure: old name [{old}] not exist!", False)
+                return
+            self.copy_cover = self.copy_name.index(old)
+        elif name in self.copy_name:
+            self.copy_cover = self.copy_name.index(name)
+        else:
+            for _ in range(COPY_N):
+                if self.copy_length[self.copy_cover] == 0:
+                    break
+                self.copy_cover = (self.copy_cover + 1) % COPY_N
+        self.comming_copy_name = name
+        self.copy_mode = True
+        self.copy_uid = uid
+        self.copy_deadline = time.monotonic() + self.capture_delay
+        self.msg_pub_print(200, uid, "copy start ok", False)
+    
+    def save_copy(self) -> None:
+        """模拟收到红外信号，完成录制"""
+        prename = self.copy_name[self.copy_cover]
+        self.copy_name[self.copy_cover] = self.comming_copy_name
+        self.copy_length[self.copy_cover] = 100
+        self.copy_cover = (self.copy_cover + 1) % COPY_N
+        self.copy_mode = False
+        self.msg_pub_print(200, self.copy_uid,
+                           f"copy [{self.comming_copy_name}] success, repalce [{prename}]", False)
+    
+    def tick(self) -> List[Dict[str, Any]]:
+        """对应IR.ino的loop()：按秒检查任务并执行，返回产生的通知"""
+        if self.copy_mode and self.capture_delay > 0 and time.monotonic() >= self.copy_deadline:
+            self.save_copy()
+        cur_check = int(time.time())
+        if cur_check > self.last_check + 2 and self.admin_uid:
+            self.msg_pub_print(400, self.admin_uid,
+                               f"task backlog time slice [{self.last_check},{cur_check}] "
+                               f"total {cur_check - self.last_check} seconds", True)
+        exec_queue: List[Task] = []
+        while self.last_check < cur_check and len(exec_queue) < EXEC_Q_N:
+            for task in self.tasklist:
+                if len(exec_queue) == EXEC_Q_N:
+                    break
+                if task.remain <= 0:
+                    continue
+                if task.cron:
+                    if task.start == self.last_check:
+                        continue
+                    if match_cron(self.last_check, task.cp):
+                        exec_queue.append(task)
+                        task.start = self.last_check
+                        task.remain -= 1
+                        if task.remain == 0:
+                            task.cron = ""
+                        self.touch(task)
+                elif task.start <= self.last_check:
+                    exec_queue.append(task)
+                    task.start += task.freq
+                    task.remain -= 1
+                    self.touch(task)
+            if len(exec_queue) < EXEC_Q_N:
+                self.last_check += 1
+        for task in exec_queue:
+            self.msg_pub_print(200, task.uid, f"exec {self.copy_name[task.xid]} success", True)
+        return self.take()
+    
+    def take(self) -> List[Dict[str, Any]]:
+        replies, self.outbox = self.outbox, []
+        return replies
+
+
+# ============ MQTT ============
+
+class Faults:
+    """故障注入配置"""
+    
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, drop: float = 0.0,
+                 duplicate: float = 0.0, garbage: float = 0.0):
+        """
+        Args:
+            latency: 回复的平均延迟（秒）
+            jitter: 延迟的随机抖动范围（秒）
+            drop: 丢弃回复的概率
+            duplicate: 重复发送回复的概率
+            garbage: 回复内容损坏（无法解析）的概率
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.drop = drop
+        self.duplicate = duplicate
+        self.garbage = garbage
+    
+    def delay(self) -> float:
+        return max(0.0, self.latency + random.uniform(-self.jitter, self.jitter))
+
+
+class Simulator:
+    """在一个MQTT连接上运行多台模拟设备"""
+    
+    def __init__(self, host: str, port: int, devices: List[SimulatedDevice], faults: Faults,
+                 username: str = "", password: str = ""):
+        self.host = host
+        self.port = port
+        self.username = username or None
+        self.password = password or None
+        self.devices = {device.sub_topic: device for device in devices}
+        self.faults = faults
+        self.received = 0
+        self.published = 0
+    
+    def encode(self, reply: Dict[str, Any], binary: bool) -> bytes:
+        if random.random() < self.faults.garbage:
+            return b"\xff{garbage"
+        if binary:
+            return msgpack.packb(reply, use_bin_type=True)
+        return json.dumps(reply, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    
+    async def send(self, client, device: SimulatedDevice, replies: List[Dict[str, Any]], binary: bool) -> None:
+        if not replies or random.random() < self.faults.drop:
+            return
+        delay = self.faults.delay()
+        if delay:
+            await asyncio.sleep(delay)
+        copies = 2 if random.random() < self.faults.duplicate else 1
+        for reply in replies:
+            for _ in range(copies):
+                self.on_reply(device, reply)
+                await client.publish(device.pub_topic, self.encode(reply, binary))
+                self.published += 1
+    
+    def on_command(self, device: SimulatedDevice, doc: Dict[str, Any]) -> None:
+        """设备收到命令时调用，供基准测试等记录时间"""
+    
+    def on_reply(self, device: SimulatedDevice, reply: Dict[str, Any]) -> None:
+        """设备发布回复前调用，供基准测试等记录时间"""
+    
+    async def ticker(self, client) -> None:
+        while True:
+            await asyncio.sleep(1)
+            for device in self.devices.values():
+                asyncio.create_task(self.send(client, device, device.tick(), False))
+    
+    async def reporter(self, interval: float = 10) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            print(f"devices={len(self.devices)} received={self.received} published={self.published}")
+    
+    async def run(self) -> None:
+        async with aiomqtt.Client(self.host, self.port, username=self.username, password=self.password) as client:
+            for topic in self.devices:
+                await client.subscribe(topic)
+            print(f"{len(self.devices)} simulated devices connected to {self.host}:{self.port}")
+            tasks = [asyncio.create_task(self.ticker(client)), asyncio.create_task(self.reporter())]
+            try:
+                async for message in client.messages:
+                    device = self.devices.get(message.topic.value)
+                    if device is None:
+                        continue
+                    self.received += 1
+                    payload = bytes(message.payload)
+                    binary = payload[:1] != b"{"
+                    try:
+                        doc = msgpack.unpackb(payload, raw=False) if binary else json.loads(payload)
+                    except Exception as e:
+                        print(f"{device.name}: parse error: {e}")
+                        continue
+                    self.on_command(device, doc)
+                    asyncio.create_task(self.send(client, device, device.solve_msg(doc), binary and msgpack is not None))
+            finally:
+                for task in tasks:
+                    task.cancel()
+
+
+def build_devices(args) -> List[SimulatedDevice]:
+    cmds = [c for c in args.cmds.split(",") if c]
+    return [
+        SimulatedDevice(
+            f"{args.prefix}{i}", f"{args.prefix}{i}/cmd", f"{args.prefix}{i}/reply",
+            cmds=cmds, capture_delay=args.capture_delay, admin_uid=args.admin
+        )
+        for i in range(args.n)
+    ]
+
+
+def env_devices(args, devices: List[SimulatedDevice]) -> List[Dict[str, Any]]:
+    """bot端env.json中的device配置"""
+    return [
+        {
+            "name": d.name, "ir_mqtthost": args.host, "ir_mqttport": args.port,
+            "ir_username": args.username, "ir_password": args.password,
+            "ir_sub_topic": d.pub_topic, "ir_pub_topic": d.sub_topic,
+        }
+        for d in devices
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ESP8266红外设备模拟器")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=1883)
+    parser.add_argument("--username", default="")
+    parser.add_argument("--password", default="")
+    parser.add_argument("-n", type=int, default=1, help="模拟设备数")
+    parser.add_argument("--prefix", default="sim", help="设备名称与主题前缀")
+    parser.add_argument("--cmds", default="tv,ac,light", help="预置的已学习命令，逗号分隔")
+    parser.add_argument("--capture-delay", type=float, default=2.0, help="copy后自动完成录制的秒数，0为不完成")
+    parser.add_argument("--admin", type=int, default=0, help="管理员聊天ID")
+    parser.add_argument("--latency", type=float, default=0.0, help="回复平均延迟（秒）")
+    parser.add_argument("--jitter", type=float, default=0.0, help="回复延迟抖动（秒）")
+    parser.add_argument("--drop", type=float, default=0.0, help="丢弃回复的概率")
+    parser.add_argument("--duplicate", type=float, default=0.0, help="重复回复的概率")
+    parser.add_argument("--garbage", type=float, default=0.0, help="回复损坏的概率")
+    parser.add_argument("--env-out", help="将bot端的设备配置写入此文件后退出")
+    args = parser.parse_args()
+    
+    devices = build_devices(args)
+    if args.env_out:
+        with open(args.env_out, "w") as f:
+            json.dump({"device": env_devices(args, devices)}, f, indent=2)
+        print(f"wrote {len(devices)} devices to {args.env_out}")
+        return
+    faults = Faults(args.latency, args.jitter, args.drop, args.duplicate, args.garbage)
+    asyncio.run(Simulator(args.host, args.port, devices, faults, args.username, args.password).run())
+
+
+if __name__ == "__main__":
+    main()
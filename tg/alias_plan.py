@@ -0,0 +1,163 @@
+"""别名执行计划模块
+
+别名的每行命令在保存时解析为执行计划并缓存，执行别名只需填入chat_id，
+无需再次解析。启动时编译所有设备的别名；之后ConfigManager保存、更新或删除别名时
+通知缓存重新编译受影响的别名，编译错误返回给保存别名的用户。缓存记录编译时的
+ConfigManager.preferences_version，未经通知的变化会使整个缓存重新编译。
+"""
+
+import logging
+import threading
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+import parsers
+
+
+logger = logging.getLogger(__name__)
+
+# 执行步骤类型
+STEP_PUBLISH = "publish"  # 发布预解析的MQTT命令
+STEP_CALL = "call"        # 调用服务方法（如device），不生成MQTT命令
+STEP_ERROR = "error"      # 解析失败或命令不存在，执行时只提示错误
+
+
+@dataclass
+class AliasStep:
+    """别名中的一行命令"""
+    kind: str
+    cmd: str
+    text: str
+    payload: Optional[Dict[str, Any]] = None  # STEP_PUBLISH: 不含chat_id的命令数据
+    error: str = ""                          # STEP_ERROR: 错误提示
+    
+    def build(self, chat_id: int) -> Dict[str, Any]:
+        """填入chat_id生成要发布的命令数据"""
+        data = dict(self.payload)
+        data["chat_id"] = chat_id
+        return data
+
+
+@dataclass
+class AliasPlan:
+    """别名的执行计划"""
+    alias: str
+    steps: List[AliasStep] = field(default_factory=list)
+
+
+class AliasPlanCache:
+    """别名执行计划缓存"""
+    
+    def __init__(self, config_manager, service):
+        """
+        初始化缓存
+        
+        Args:
+            config_manager: 配置管理器，提供当前设备的别名与preferences_version
+            service: 机器人服务实例，用于判断非MQTT命令是否存在
+        """
+        self.config = config_manager
+        self.service = service
+        # (设备名称, 别名) -> 执行计划
+        self._plans: Dict[Tuple[str, str], AliasPlan] = {}
+        self._version = -1
+        self._lock = threading.Lock()
+        config_manager.preferences_listeners.append(self.on_preferences_changed)
+        for error in self.compile_all():
+            logger.warning("别名编译错误: %s", error)
+    
+    def compile_all(self) -> List[str]:
+        """
+        编译所有设备的别名，替换整个缓存
+        
+        Returns:
+            编译错误
+        """
+        with self._lock:
+            self._version = self.config.preferences_version
+            self._plans.clear()
+            errors = []
+            for device_name, preferences in list(self.config.db.preference.items()):
+                errors.extend(self._compile_into(device_name, preferences.items()))
+        logger.info("别名执行计划已编译: 别名数=%d, 错误数=%d", len(self._plans), len(errors))
+        return errors
+    
+    def on_preferences_changed(self, device_name: str, alias: Optional[str]) -> List[str]:
+        """
+        别名配置变化时重新编译（由ConfigManager调用）
+        
+        Args:
+            device_name: 设备名称
+            alias: 变化的别名，为None时重新编译该设备的全部别名
+        
+        Returns:
+            编译错误
+        """
+        preferences = self.config.db.preference.get(device_name, {})
+        with self._lock:
+            if alias is None:
+                for key in [key for key in self._plans if key[0] == device_name]:
+                    del self._plans[key]
+                changed = list(preferences.items())
+            else:
+                self._plans.pop((device_name, alias), None)
+                changed = [(alias, preferences[alias])] if alias in preferences else []
+            errors = self._compile_into(device_name, changed)
+            self._version = self.config.preferences_version
+        return errors
+    
+    def _compile_into(self, device_name: str, aliases: Iterable[Tuple[str, List[str]]]) -> List[str]:
+        errors = []
+        for alias, commands in aliases:
+            plan = self._plans[(device_name, alias)] = self.compile(alias, commands)
+            errors.extend(f"{alias}: {step.error}" for step in plan.steps if step.kind == STEP_ERROR)
+        return errors
+    
+    def get(self, alias: str) -> Optional[AliasPlan]:
+        """
+        获取当前设备中别名的执行计划
+        
+        Returns:
+            执行计划，别名不存在时返回None
+        """
+        if self._version != self.config.preferences_version:
+            self.compile_all()
+        device_name = self.config.get_current_device().name
+        with self._lock:
+            return self._plans.get((device_name, alias))
+    
+    def compile(self, alias: str, commands: List[str]) -> AliasPlan:
+        """
+        将别名的命令列表编译为执行计划
+        
+        Args:
+            alias: 别名
+            commands: 命令列表，每行格式同对应的机器人命令（不含/）
+        """
+        plan = AliasPlan(alias)
+        for seq in commands:
+            cmd_parts = [i for i in seq.split(" ") if i]
+            if len(cmd_parts) == 0:
+                continue
+            
+            cmd = cmd_parts[0]
+            parser = parsers.COMMAND_PARSERS.get(cmd)
+            if parser is not None:
+                try:
+                    payload = parser(seq, 0)
+                except ValueError as e:
+                    plan.steps.append(AliasStep(STEP_ERROR, cmd, seq, error=f"{seq}: {e}"))
+                    continue
+                payload.pop("chat_id", None)
+                plan.steps.append(AliasStep(STEP_PUBLISH, cmd, seq, payload=payload))
+            elif callable(getattr(self.service, cmd, None)) and not cmd.startswith("_"):
+                plan.steps.append(AliasStep(STEP_CALL, cmd, seq))
+            else:
+                plan.steps.append(AliasStep(STEP_ERROR, cmd, seq, error=f"command {cmd} not found"))
+        
+        logger.debug("编译别名执行计划: %s, 步骤数=%s", alias, len(plan.steps))
+        return plan
+
+
+def alias_errors_text(errors: List[str]) -> str:
+    """保存别名时编译错误的提示文本"""
+    return "alias saved, but these commands will fail:\n" + "\n".join(errors)
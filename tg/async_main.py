@@ -0,0 +1,333 @@
+"""Telegram机器人主文件（asyncio版）
+
+与main.py功能相同，但Telegram轮询、命令处理和所有设备的MQTT连接
+都运行在同一个asyncio事件循环中，I/O以await方式等待而不是阻塞线程。
+
+启动方式: python async_main.py
+"""
+
+import asyncio
+import logging
+from telebot import asyncio_helper
+from telebot.async_telebot import AsyncTeleBot
+import parsers
+import metrics
+import tracing
+from logging_config import setup_logging
+from config import load_config
+from service import AsyncBotService
+from async_mqtt_client import AsyncMQTTClientManager
+from inbound import AsyncInboundWorkerPool
+from decorators import create_async_permission_decorator
+from alias_plan import alias_errors_text
+from callbacks import AsyncTaskCallbackHandler, AsyncAliasCallbackHandler, AsyncPageCallbackHandler
+from dispatcher import AsyncDispatcher
+from outbox import AsyncOutboundDispatcher
+
+
+# 初始化日志
+setup_logging()
+logger = logging.getLogger(__name__)
+
+
+# 加载配置
+config_manager = load_config()
+setup_logging(config_manager.env.ir_log_format, config_manager.env.ir_log_rate_limits)
+tracing.TRACER.configure(config_manager.env.ir_trace_file, config_manager.env.ir_trace_format)
+
+# 初始化Bot
+if config_manager.env.ir_api_url:
+    asyncio_helper.API_URL = config_manager.env.ir_api_url.rstrip("/") + "/bot{0}/{1}"
+bot = AsyncTeleBot(config_manager.env.ir_bot_token)
+
+# 所有发往Telegram的消息经过出站调度器限速、合并（调度任务在事件循环启动后运行）
+outbox = AsyncOutboundDispatcher(bot)
+
+# 入站消息由有界工作池的消费任务处理，连接的接收循环不等待处理与发送
+inbound_pool = AsyncInboundWorkerPool(
+    workers=config_manager.env.ir_inbound_workers,
+    queue_size=config_manager.env.ir_inbound_queue_size,
+    overflow=config_manager.env.ir_inbound_overflow
+)
+# 初始化MQTT客户端管理器（连接在事件循环启动后建立）
+mqtt_manager = AsyncMQTTClientManager(
+    config_manager.devices, outbox, inbound_pool,
+    shadow_ttl=config_manager.env.ir_shadow_ttl,
+    request_timeout=config_manager.env.ir_request_timeout,
+    scheduler_mode=config_manager.env.ir_scheduler,
+    scheduler_max_tasks=config_manager.env.ir_scheduler_max_tasks,
+    storage=config_manager.storage
+)
+
+# 初始化服务
+service = AsyncBotService(outbox, config_manager, mqtt_manager)
+
+
+async def current_mqtt_publish(data):
+    """发布MQTT消息到当前设备"""
+    current_device = config_manager.get_current_device()
+    await mqtt_manager.publish_to_device(current_device.name, data)
+
+
+async def current_mqtt_publish_batch(items):
+    """发布多条MQTT消息到当前设备，设备支持时合并为批量帧"""
+    current_device = config_manager.get_current_device()
+    await mqtt_manager.publish_batch(current_device.name, items)
+
+
+# 创建权限装饰器
+permission = create_async_permission_decorator(
+    outbox,
+    config_manager.auth,
+    current_mqtt_publish
+)
+
+# 初始化回调处理器
+task_callback_handler = AsyncTaskCallbackHandler(
+    outbox, config_manager, service, current_mqtt_publish,
+    registry=mqtt_manager.message_router.live
+)
+alias_callback_handler = AsyncAliasCallbackHandler(
+    outbox, config_manager, service, current_mqtt_publish,
+    batch_publisher=current_mqtt_publish_batch
+)
+page_callback_handler = AsyncPageCallbackHandler(outbox, mqtt_manager.message_router.pages)
+
+
+# ============= 命令处理器 =============
+
+# 命令与回调按名称/前缀索引分发，向bot只注册一个消息处理器和一个回调处理器
+dispatcher = AsyncDispatcher()
+
+
+# 等待输入别名内容的聊天优先处理（替代同步版的next_step_handler）
+@bot.message_handler(func=lambda message: message.chat.id in alias_callback_handler.pending_add)
+async def bot_pending_alias(message):
+    """处理别名添加的后续输入"""
+    await alias_callback_handler.handle_pending_add(message)
+
+
+@dispatcher.command('copy')
+@permission.require_auth
+def bot_copy(message):
+    """处理copy命令"""
+    return service.copy(message)
+
+
+@dispatcher.command('exec')
+@permission.require_auth
+def bot_exec(message):
+    """处理exec命令"""
+    return service.exec(message)
+
+
+@dispatcher.command('terminate')
+@permission.require_auth
+def bot_terminate(message):
+    """处理terminate命令"""
+    return service.terminate(message)
+
+
+@dispatcher.command('terminatename')
+@permission.require_auth
+def bot_terminatename(message):
+    """处理terminatename命令"""
+    return service.terminatename(message)
+
+
+@dispatcher.command('cmdlist')
+@permission.require_auth
+def bot_cmdlist(message):
+    """处理cmdlist命令"""
+    return service.cmdlist(message)
+
+
+@dispatcher.command('taskidlist')
+@permission.require_auth
+def bot_taskidlist(message):
+    """处理taskidlist命令"""
+    return service.taskidlist(message)
+
+
+@dispatcher.command('tasklist')
+@permission.require_auth
+def bot_tasklist(message):
+    """处理tasklist命令"""
+    return service.tasklist(message)
+
+
+@dispatcher.command('task')
+@permission.require_auth
+def bot_task(message):
+    """处理task命令"""
+    return service.task(message)
+
+
+@dispatcher.command('device')
+@permission.require_auth
+async def bot_device(message):
+    """处理device命令"""
+    await service.device(message)
+
+
+@dispatcher.command('usermod')
+@permission.require_auth
+async def bot_usermod(message):
+    """处理usermod命令"""
+    await service.usermod(message)
+
+
+@dispatcher.command('rtt')
+@permission.require_auth
+async def bot_rtt(message):
+    """处理rtt命令"""
+    await service.rtt(message)
+
+
+@dispatcher.command('trace')
+@permission.require_auth
+async def bot_trace(message):
+    """处理trace命令"""
+    await service.trace(message)
+
+
+@dispatcher.command('profile')
+@permission.require_auth
+async def bot_profile(message):
+    """处理profile命令"""
+    await service.profile(message)
+
+
+@dispatcher.command('preference')
+@permission.require_auth
+async def bot_preference(message):
+    """处理preference命令"""
+    logger.info("执行preference命令: user_id=%s", message.from_user.id)
+    
+    preferences = config_manager.get_current_preferences()
+    aliases = parsers.PreferenceParser.apply(message.text, preferences)
+    
+    errors = config_manager.update_preferences(preferences)
+    logger.info("preference配置更新完成，当前别名数量: %s", len(preferences))
+    
+    # 返回别名列表
+    await outbox.reply_to(message, parsers.PreferenceParser.format(preferences))
+    if errors:
+        await outbox.reply_to(message, alias_errors_text(errors))
+    
+    # 执行别名
+    for alias in aliases:
+        await alias_callback_handler._exec_alias(alias, message)
+
+
+@dispatcher.command('alias')
+@permission.require_auth
+async def bot_alias(message):
+    """处理alias命令"""
+    await alias_callback_handler.show_alias_menu(message)
+
+
+@dispatcher.command('auth')
+@permission.no_auth_required
+async def bot_auth(message):
+    """处理auth命令"""
+    await service.auth(message)
+
+
+@dispatcher.command('start')
+@permission.no_auth_required
+async def bot_start(message):
+    """处理start命令"""
+    await service.start(message)
+
+
+@dispatcher.command('help')
+@permission.no_auth_required
+async def bot_help(message):
+    """处理help命令"""
+    await service.help(message)
+
+
+# ============= 回调查询处理器 =============
+
+@dispatcher.callback(prefix="taskid_")
+@permission.require_callback_auth
+async def callback_taskid(call):
+    """处理任务ID终止回调"""
+    await task_callback_handler.handle_taskid(call)
+
+
+@dispatcher.callback(prefix="taskname_")
+@permission.require_callback_auth
+async def callback_taskname(call):
+    """处理任务名称终止回调"""
+    await task_callback_handler.handle_taskname(call)
+
+
+@dispatcher.callback(prefix="page_")
+@permission.require_callback_auth
+async def callback_page(call):
+    """处理列表翻页回调"""
+    await page_callback_handler.handle_page(call)
+
+
+@dispatcher.callback(prefix="alias_exc_")
+@permission.require_callback_auth
+async def callback_alias_exec(call):
+    """处理别名执行回调"""
+    await alias_callback_handler.handle_exec(call)
+
+
+@dispatcher.callback(prefix="alias_del_")
+@permission.require_callback_auth
+async def callback_alias_delete(call):
+    """处理别名删除回调"""
+    await alias_callback_handler.handle_delete(call)
+
+
+@dispatcher.callback("alias_add")
+@permission.require_callback_auth
+async def callback_alias_add(call):
+    """处理别名添加回调"""
+    await alias_callback_handler.handle_add(call)
+
+
+@dispatcher.callback("alias_del", "alias_exc", "alias_cancel")
+@permission.require_callback_auth
+async def callback_alias_menu(call):
+    """处理别名菜单切换回调"""
+    await alias_callback_handler.handle_menu_switch(call)
+
+
+dispatcher.install(bot)
+
+
+# ============= 主函数 =============
+
+async def run() -> None:
+    """在同一个事件循环中启动MQTT连接与Telegram轮询"""
+    outbox.start()
+    mqtt_manager.start_all()
+    try:
+        await bot.infinity_polling()
+    finally:
+        await mqtt_manager.disconnect_all()
+        await outbox.stop()
+        await bot.close_session()
+        config_manager.close()
+
+
+if __name__ == "__main__":
+    logger.info("TG Bot启动（asyncio）")
+    logger.info("当前设备: %s", config_manager.get_current_device().name)
+    logger.info("授权用户数: %s", len(config_manager.auth))
+    if config_manager.env.ir_metrics_port:
+        metrics.start_http_server(config_manager.env.ir_metrics_port, config_manager.env.ir_metrics_host)
+    
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        logger.info("收到停止信号，正在关闭...")
+    except Exception as e:
+        logger.critical("TG Bot运行异常: %s", e, exc_info=True)
+        raise
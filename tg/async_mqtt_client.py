@@ -0,0 +1,401 @@
+"""异步MQTT客户端管理模块
+
+基于aiomqtt，所有设备的MQTT连接运行在同一个asyncio事件循环中，
+不再为每个设备启动独立的网络线程。
+连接到同一MQTT服务器的设备共享一个连接，按订阅主题分发消息。
+"""
+
+import asyncio
+import logging
+import time
+import uuid
+from typing import Dict, List, Optional, Tuple
+import aiomqtt
+from config import DeviceConfig
+import batch
+from shadow import DeviceShadow
+import correlation
+import metrics
+import tracing
+import delta
+from correlation import RequestTracker
+import scheduler
+from scheduler import AsyncTaskScheduler
+from storage import StorageBackend
+from codec import Codec, get_codec
+from handlers import AsyncMessageRouter
+from inbound import AsyncInboundWorkerPool
+from mqtt_client import broker_key, connection_states, STATE_CONNECTING, STATE_CONNECTED, STATE_UNAVAILABLE
+
+
+logger = logging.getLogger(__name__)
+
+# 断线重连的初始与最大等待时间（秒）
+RECONNECT_MIN_DELAY = 1
+RECONNECT_MAX_DELAY = 60
+
+
+class AsyncMQTTClient:
+    """单个异步MQTT服务器连接封装，可被多个设备共享"""
+    
+    def __init__(self, devices: List[DeviceConfig], message_router: AsyncMessageRouter,
+                 inbound: AsyncInboundWorkerPool):
+        """
+        初始化异步MQTT客户端
+        
+        Args:
+            devices: 共享此连接的设备配置，须具有相同的broker_key
+            message_router: 异步消息路由器
+            inbound: 入站消息工作池
+        """
+        self.devices = devices
+        self.host, self.port, self.username, self.password = broker_key(devices[0])
+        self.message_router = message_router
+        self.inbound = inbound
+        self.client: Optional[aiomqtt.Client] = None
+        self.logger = logging.getLogger(f"{__name__}.{self.host}:{self.port}")
+        self._task: Optional[asyncio.Task] = None
+        self.state = STATE_CONNECTING
+        self.connect_latency: Optional[float] = None
+        
+        # 订阅主题 -> 设备名称，多个设备使用相同订阅主题时只分发给第一个
+        self.topics: Dict[str, str] = {}
+        for device in devices:
+            self.topics.setdefault(device.ir_sub_topic, device.name)
+        # 发布主题 -> 设备名称，用于按设备统计发出的消息
+        self.pub_topics: Dict[str, str] = {device.ir_pub_topic: device.name for device in devices}
+        
+        # 设备名称 -> 编解码器
+        self.codecs: Dict[str, Codec] = {device.name: get_codec(device.ir_codec) for device in devices}
+    
+    def start(self) -> None:
+        """在当前事件循环中启动连接任务"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(), name=f"mqtt-{self.host}:{self.port}")
+    
+    async def _run(self) -> None:
+        """连接、订阅并持续接收消息，断线后指数退避重连"""
+        delay = RECONNECT_MIN_DELAY
+        
+        while True:
+            self.logger.info(
+                "初始化MQTT连接: host=%s, port=%s, user=%s, devices=%s, sub_topics=%s",
+                self.host, self.port, self.username, [device.name for device in self.devices], list(self.topics)
+            )
+            started = time.monotonic()
+            try:
+                async with aiomqtt.Client(
+                    self.host,
+                    self.port,
+                    username=self.username,
+                    password=self.password,
+                    identifier=str(uuid.uuid4()),
+                    keepalive=60
+                ) as client:
+                    self.client = client
+                    self.connect_latency = time.monotonic() - started
+                    self.state = STATE_CONNECTED
+                    await client.subscribe([(topic, 0) for topic in self.topics])
+                    self.logger.info(
+                        "MQTT客户端启动成功: %s:%s, 耗时: %.0fms",
+                        self.host, self.port, self.connect_latency * 1000
+                    )
+                    delay = RECONNECT_MIN_DELAY
+                    
+                    async for msg in client.messages:
+                        await self._on_message(msg)
+            except asyncio.CancelledError:
+                raise
+            except aiomqtt.MqttError as e:
+                self.logger.error("MQTT连接断开: %s，%s秒后重连", e, delay)
+            except Exception as e:
+                self.logger.error("MQTT客户端异常: %s，%s秒后重连", e, delay, exc_info=True)
+            finally:
+                self.client = None
+                self.state = STATE_CONNECTING
+            
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, RECONNECT_MAX_DELAY)
+    
+    async def _on_message(self, msg: aiomqtt.Message) -> None:
+        """
+        MQTT消息接收处理（运行在连接的接收循环中）
+        
+        按主题找到对应设备后放入入站队列，具体处理由工作池的消费任务完成，
+        接收循环不等待消息处理与Telegram发送。
+        
+        Args:
+            msg: 消息对象
+        """
+        device_name = self._device_for_topic(msg.topic)
+        if device_name is None:
+            self.logger.warning("收到未知主题的MQTT消息: topic='%s'", msg.topic)
+            return
+        await self.inbound.submit(device_name, self._handle_message, device_name, msg)
+    
+    async def _handle_message(self, device_name: str, msg: aiomqtt.Message) -> None:
+        """
+        处理MQTT消息（运行在入站工作池的消费任务中）
+        
+        Args:
+            device_name: 消息所属设备名称
+            msg: 消息对象
+        """
+        try:
+            message = self.codecs[device_name].decode(msg.payload)
+            metrics.MQTT_MESSAGES.labels(device_name, "in").inc()
+            self.logger.info("接收MQTT消息: device=%s, topic='%s', qos=%s", device_name, msg.topic, msg.qos)
+            self.logger.debug("MQTT消息内容: %s", message)
+            
+            await self.message_router.route(message, device_name)
+        
+        except ValueError as e:
+            self.logger.error("消息解析失败: %s", e)
+        except Exception as e:
+            self.logger.error("处理MQTT消息时发生错误: %s", e, exc_info=True)
+    
+    def _device_for_topic(self, topic: aiomqtt.Topic) -> Optional[str]:
+        """
+        根据消息主题查找设备名称，支持通配符订阅
+        
+        Args:
+            topic: 消息主题
+        """
+        device_name = self.topics.get(topic.value)
+        if device_name is not None:
+            return device_name
+        for sub, name in self.topics.items():
+            if topic.matches(sub):
+                return name
+        return None
+    
+    async def publish(self, topic: str, payload: bytes, qos: int = 0) -> None:
+        """
+        发布MQTT消息
+        
+        Args:
+            topic: 主题
+            payload: 消息内容
+            qos: 服务质量等级
+        """
+        if self.client is None:
+            self.logger.warning("MQTT未连接，丢弃消息: topic=%s", topic)
+            return
+        await self.client.publish(topic, payload, qos)
+        metrics.MQTT_MESSAGES.labels(self.pub_topics.get(topic, topic), "out").inc()
+        self.logger.debug("发布MQTT消息: topic=%s, payload=%s", topic, payload)
+    
+    async def disconnect(self) -> None:
+        """断开MQTT连接"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+            self.logger.info("MQTT客户端已断开")
+
+
+class AsyncMQTTClientManager:
+    """异步MQTT客户端管理器"""
+    
+    def __init__(self, devices: Dict[str, DeviceConfig], bot,
+                 inbound: Optional[AsyncInboundWorkerPool] = None, shadow_ttl: float = 30,
+                 request_timeout: float = 10, scheduler_mode: str = scheduler.MODE_DEVICE,
+                 scheduler_max_tasks: int = 10000, storage: Optional[StorageBackend] = None):
+        """
+        初始化异步MQTT客户端管理器
+        
+        Args:
+            devices: 设备配置字典
+            bot: AsyncOutboundDispatcher实例
+            inbound: 入站消息工作池，为None时使用默认配置创建
+            shadow_ttl: 设备影子缓存有效期（秒），为0时列表查询总是发往设备
+            request_timeout: 命令等待设备回复的超时时间（秒），超时后通知发出命令的聊天
+            scheduler_mode: 任务调度模式，见scheduler.SCHEDULER_MODES
+            scheduler_max_tasks: 服务端调度时每个设备最多保存的任务数
+            storage: 服务端调度时保存任务的存储后端，bot重启后恢复
+        """
+        if scheduler_mode not in scheduler.SCHEDULER_MODES:
+            raise ValueError(f"未知的任务调度模式: {scheduler_mode}")
+        
+        self.devices = devices
+        self.bot = bot
+        self.logger = logging.getLogger(__name__)
+        
+        # 设备影子缓存列表类回复，请求跟踪器按rid匹配回复，创建消息路由器
+        self.shadow = DeviceShadow(shadow_ttl)
+        self.requests = RequestTracker(request_timeout)
+        self._sweeper: Optional[asyncio.Task] = None
+        self.message_router = AsyncMessageRouter(bot, self.shadow, self.requests)
+        
+        # 入站消息由工作池的消费任务处理，不占用连接的接收循环
+        self.inbound = inbound or AsyncInboundWorkerPool()
+        
+        # 服务端调度模式下，延期执行的任务保存在bot端，到期后发往设备
+        self.scheduler: Optional[AsyncTaskScheduler] = None
+        self._scheduler_task: Optional[asyncio.Task] = None
+        if scheduler_mode == scheduler.MODE_SERVER:
+            self.scheduler = AsyncTaskScheduler(
+                self.publish_to_device, scheduler_max_tasks, storage, self.shadow.known_commands
+            )
+        
+        # 按MQTT服务器分组，同一服务器的设备共享一个连接
+        groups: Dict[Tuple[str, int, str, str], List[DeviceConfig]] = {}
+        for device in devices.values():
+            groups.setdefault(broker_key(device), []).append(device)
+        
+        # 设备名称 -> 所用连接；服务器标识 -> 连接
+        self.clients: Dict[str, AsyncMQTTClient] = {}
+        self.connections: Dict[Tuple[str, int, str, str], AsyncMQTTClient] = {}
+        for key, group in groups.items():
+            client = AsyncMQTTClient(group, self.message_router, self.inbound)
+            self.connections[key] = client
+            for device in group:
+                self.clients[device.name] = client
+        metrics.MQTT_CONNECTION_STATE.set_callback(lambda: connection_states(self.connections.values()))
+    
+    def start_all(self) -> None:
+        """启动入站消费任务、所有MQTT服务器的连接任务、超时检查任务与调度任务（需在事件循环中调用）"""
+        self.inbound.start()
+        for client in self.connections.values():
+            client.start()
+        self._sweeper = asyncio.create_task(self._sweep_requests())
+        if self.scheduler is not None:
+            self._scheduler_task = asyncio.create_task(self.scheduler.run())
+    
+    async def _sweep_requests(self) -> None:
+        """每秒检查一次待回复表，通知超时的命令"""
+        while True:
+            await asyncio.sleep(1)
+            for request in self.requests.expire():
+                self.logger.warning("命令回复超时: %s", request)
+                try:
+                    # 只排队不等待发送，多条超时通知之间互不阻塞
+                    self.bot.send_message(request.chat_id, RequestTracker.timeout_text(request))
+                except Exception as e:
+                    self.logger.error("发送超时通知失败: %s", e)
+    
+    def get(self, device_name: str) -> Optional[AsyncMQTTClient]:
+        """
+        获取指定设备的MQTT客户端
+        
+        Args:
+            device_name: 设备名称
+        
+        Returns:
+            MQTT客户端，如果不存在则返回None
+        """
+        client = self.clients.get(device_name)
+        if client is None:
+            self.logger.warning("未找到MQTT客户端: %s", device_name)
+        return client
+    
+    def get_state(self, device_name: str) -> str:
+        """
+        获取设备的连接状态
+        
+        Args:
+            device_name: 设备名称
+        
+        Returns:
+            连接状态，客户端不存在时为STATE_UNAVAILABLE
+        """
+        client = self.clients.get(device_name)
+        return client.state if client else STATE_UNAVAILABLE
+    
+    async def publish_to_device(self, device_name: str, data: Dict) -> None:
+        """
+        向指定设备发布消息
+        
+        Args:
+            device_name: 设备名称
+            data: 消息数据
+        """
+        if await self._schedule(device_name, data):
+            return
+        
+        # 有效期内的列表查询直接用设备影子回复
+        cached = self.shadow.lookup(device_name, data)
+        if cached is not None:
+            await self.message_router.route(cached)
+            return
+        
+        client = self.get(device_name)
+        if client:
+            self.shadow.note_publish(device_name, data)
+            data = {**self.shadow.strip(data), correlation.RID_KEY: self.requests.next_rid()}
+            # 已有任务表副本时只请求副本版本之后的变化
+            if data.get("cmd") == "tasklist" and self.message_router.supports(device_name, delta.CAP_DELTA):
+                data.update(self.message_router.replica.request_fields(device_name))
+            if self.message_router.supports(device_name, correlation.CAP_RID):
+                self.requests.register(device_name, data)
+            device = self.devices[device_name]
+            with tracing.span("mqtt.publish", device=device_name, cmd=data.get("cmd"), rid=data[correlation.RID_KEY]):
+                # 设备回复带回rid，据此把device.reply挂在本span下
+                tracing.TRACER.link(device_name, data[correlation.RID_KEY])
+                payload = client.codecs[device_name].encode(data)
+                await client.publish(device.ir_pub_topic, payload, 0)
+    
+    async def _schedule(self, device_name: str, data: Dict) -> bool:
+        """
+        服务端调度模式下由调度器处理任务相关的命令
+        
+        Returns:
+            命令已由调度器处理（无需发往设备）时返回True
+        """
+        if self.scheduler is None:
+            return False
+        replies = self.scheduler.handle(device_name, data)
+        if replies is None:
+            return False
+        for reply in replies:
+            await self.message_router.route(reply)
+        return True
+    
+    async def publish_batch(self, device_name: str, items: List[Dict]) -> None:
+        """
+        向指定设备发布多条命令
+        
+        设备声明支持批量帧时，可批量的命令合并为批量帧发送（保持原有顺序），
+        否则逐条发送。
+        
+        Args:
+            device_name: 设备名称
+            items: 命令数据列表
+        """
+        items = [data for data in items if not await self._schedule(device_name, data)]
+        if not self.message_router.supports(device_name, batch.CAP_BATCH):
+            for data in items:
+                await self.publish_to_device(device_name, data)
+            return
+        
+        # 相邻的可批量命令合并为一组，不可批量的命令单独发送
+        run: List[Dict] = []
+        for data in items + [None]:
+            if data is not None and batch.is_batchable(data):
+                run.append(data)
+                continue
+            if len(run) == 1:
+                await self.publish_to_device(device_name, run[0])
+            elif run:
+                device = self.devices[device_name]
+                frames = batch.encode_batch(run, run[0]["chat_id"], get_codec(device.ir_codec), device.ir_pub_topic)
+                for frame in frames:
+                    await self.publish_to_device(device_name, frame)
+            run = []
+            if data is not None:
+                await self.publish_to_device(device_name, data)
+    
+    async def disconnect_all(self) -> None:
+        """断开所有MQTT客户端"""
+        for task in (self._sweeper, self._scheduler_task):
+            if task is not None:
+                task.cancel()
+        for (host, port, _, _), client in self.connections.items():
+            try:
+                await client.disconnect()
+            except Exception as e:
+                self.logger.error("断开MQTT服务器 %s:%s 的连接失败: %s", host, port, e)
+        await self.inbound.stop()
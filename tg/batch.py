@@ -0,0 +1,134 @@
+"""批量命令帧模块
+
+将多条命令合并为一个MQTT消息发往设备，设备依次执行并在一条回复中
+返回每条命令的状态。协议说明见 esp/BATCH_PROTOCOL.md。
+
+设备在回复中携带 "caps": "batch" 表示支持批量帧；未声明该能力的设备
+仍逐条发送。
+"""
+
+import logging
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional
+from codec import Codec, JsonCodec
+
+
+logger = logging.getLogger(__name__)
+
+
+BATCH_CMD = "batch"
+CAP_BATCH = "batch"
+
+# 单帧最多携带的命令数，受设备端JSON缓冲区大小限制
+MAX_BATCH_ITEMS = 8
+
+# 设备固件PubSubClient的MQTT_MAX_PACKET_SIZE，超过的消息被设备静默丢弃
+MAX_PACKET_SIZE = 1536
+# MQTT固定报头（1字节类型 + 最多4字节剩余长度）与主题长度字段
+PACKET_HEADER_SIZE = 7
+# 为发布时附加的rid字段预留的字节数
+RID_RESERVE = 24
+
+# 可以放入批量帧的命令；查询类命令的回复携带列表数据，仍需单独发送
+BATCHABLE_COMMANDS = ("exec", "terminate", "terminatename")
+
+# 设备端缺省值与之相同的字段，编码时省略以缩小帧长度
+OPTIONAL_DEFAULTS = {"start": 0, "delay": 0, "freq": 0, "cron": "", "taskname": ""}
+
+
+@dataclass
+class BatchResult:
+    """批量帧中单条命令的执行状态"""
+    index: int
+    code: int
+    message: str
+    
+    @property
+    def ok(self) -> bool:
+        return self.code == 200
+
+
+def parse_caps(message: Dict[str, Any]) -> List[str]:
+    """
+    解析设备回复中声明的能力
+    
+    Args:
+        message: 设备回复
+    """
+    caps = message.get("caps", "")
+    if isinstance(caps, str):
+        return [cap for cap in caps.split(",") if cap]
+    return [str(cap) for cap in caps]
+
+
+def is_batchable(data: Dict[str, Any]) -> bool:
+    """判断命令是否可以放入批量帧"""
+    return data.get("cmd") in BATCHABLE_COMMANDS
+
+
+def encode_item(data: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    编码批量帧中的单条命令（去掉chat_id与缺省字段）
+    
+    Args:
+        data: 单条命令数据
+    """
+    return {
+        k: v for k, v in data.items()
+        if k != "chat_id" and not (k in OPTIONAL_DEFAULTS and v == OPTIONAL_DEFAULTS[k])
+    }
+
+
+def payload_budget(topic: str) -> int:
+    """发往topic的一帧编码后（不含rid）允许的最大字节数"""
+    return MAX_PACKET_SIZE - PACKET_HEADER_SIZE - len(topic.encode("utf-8")) - RID_RESERVE
+
+
+def encode_batch(items: List[Dict[str, Any]], chat_id: int, codec: Optional[Codec] = None,
+                 topic: str = "") -> List[Dict[str, Any]]:
+    """
+    将多条命令编码为批量帧
+    
+    Args:
+        items: 命令数据列表，均需满足is_batchable
+        chat_id: 回复发往的聊天ID
+        codec: 设备的编解码器，用于计算帧的编码长度，默认JSON
+        topic: 发布主题，计入MQTT包长度
+    
+    Returns:
+        批量帧列表，每帧最多MAX_BATCH_ITEMS条命令，且编码后不超过设备的MQTT包大小限制
+    """
+    codec = codec or JsonCodec()
+    budget = payload_budget(topic)
+    frames: List[Dict[str, Any]] = []
+    frame: Optional[Dict[str, Any]] = None
+    for item in items:
+        encoded = encode_item(item)
+        if frame is not None and len(frame["items"]) < MAX_BATCH_ITEMS:
+            frame["items"].append(encoded)
+            if len(codec.encode(frame)) <= budget:
+                continue
+            frame["items"].pop()
+        frame = {"cmd": BATCH_CMD, "chat_id": chat_id, "items": [encoded]}
+        frames.append(frame)
+        size = len(codec.encode(frame))
+        if size > budget:
+            logger.warning("批量帧中的单条命令超过设备MQTT包大小限制: cmd=%s, %d字节，上限%d字节",
+                           encoded.get("cmd"), size, budget)
+    return frames
+
+
+def decode_batch_reply(message: Dict[str, Any]) -> List[BatchResult]:
+    """
+    解析设备对批量帧的回复
+    
+    Args:
+        message: 包含results字段的设备回复
+    
+    Returns:
+        各条命令的执行状态（同一条命令可能有多个状态，如exec多个名称）
+    """
+    return [
+        BatchResult(int(r.get("i", 0)), int(r.get("code", 0)), str(r.get("msg", "")))
+        for r in message.get("results", [])
+    ]
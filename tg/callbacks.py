@@ -4,9 +4,13 @@
 """
 
 import logging
-from typing import Callable
+import inspect
+from typing import Callable, List, Optional
 from telebot import types
-import util
+from alias_plan import AliasPlanCache, STEP_PUBLISH, STEP_CALL, alias_errors_text
+import pagination
+from pagination import PageCache
+from live_messages import MessageRegistry
 
 
 logger = logging.getLogger(__name__)
@@ -35,6 +39,17 @@ class CallbackHandler:
 class TaskCallbackHandler(CallbackHandler):
     """任务相关回调处理器"""
     
+    def __init__(self, bot, config_manager, service, mqtt_publisher: Callable,
+                 registry: Optional[MessageRegistry] = None):
+        """
+        初始化任务回调处理器
+        
+        Args:
+            registry: 消息登记表，刷新后的任务列表编辑被点击的消息；为None时发送新消息
+        """
+        super().__init__(bot, config_manager, service, mqtt_publisher)
+        self.registry = registry
+    
     def handle_taskid(self, call) -> None:
         """
         处理任务ID终止回调
@@ -43,29 +58,9 @@ class TaskCallbackHandler(CallbackHandler):
             call: 回调查询对象
         """
         taskid = call.data[7:]  # 移除 "taskid_" 前缀
+        shown = call.message.text
         call.message.text = f"terminate {taskid}"
-        
-        try:
-            data = self.service.terminate(call.message)
-            if data:
-                self.mqtt_publisher(data)
-                data['chat_id'] %= 100000
-                self.bot.send_message(
-                    call.message.chat.id,
-                    f"{str(data)} is transmitted"
-                )
-        except Exception as e:
-            self.logger.error(f"终止任务失败: {e}")
-            self.bot.answer_callback_query(call.id, "操作失败")
-            return
-        
-        self.bot.answer_callback_query(call.id)
-        
-        # 刷新任务列表
-        call.message.text = "tasklist"
-        data = self.service.tasklist(call.message)
-        if data:
-            self.mqtt_publisher(data)
+        self._terminate_and_refresh(call, self.service.terminate, shown)
     
     def handle_taskname(self, call) -> None:
         """
@@ -75,34 +70,113 @@ class TaskCallbackHandler(CallbackHandler):
             call: 回调查询对象
         """
         taskname = call.data[9:]  # 移除 "taskname_" 前缀
+        shown = call.message.text
         call.message.text = f"terminatename {taskname}"
+        self._terminate_and_refresh(call, self.service.terminatename, shown)
+    
+    def _terminate_and_refresh(self, call, terminate: Callable, shown: str) -> None:
+        """
+        发送终止命令并刷新任务列表
+        
+        确认信息以回调提示显示，刷新后的任务列表编辑被点击的消息。
         
+        Args:
+            call: 回调查询对象
+            terminate: 生成终止命令数据的服务方法
+            shown: 被点击的任务列表消息当前的文本
+        """
+        command = call.message.text
         try:
-            data = self.service.terminatename(call.message)
+            data = terminate(call.message)
             if data:
                 self.mqtt_publisher(data)
-                data['chat_id'] %= 100000
-                self.bot.send_message(
-                    call.message.chat.id,
-                    f"{str(data)} is transmitted"
-                )
         except Exception as e:
-            self.logger.error(f"终止任务失败: {e}")
+            self.logger.error("终止任务失败: %s", e)
             self.bot.answer_callback_query(call.id, "操作失败")
             return
         
-        self.bot.answer_callback_query(call.id)
+        self.bot.answer_callback_query(call.id, f"{command} is transmitted")
         
-        # 刷新任务列表
-        call.message.text = "tasklist"
-        data = self.service.tasklist(call.message)
+        data = self._prepare_refresh(call, shown)
         if data:
             self.mqtt_publisher(data)
+    
+    def _prepare_refresh(self, call, shown: str) -> Optional[dict]:
+        """登记等待刷新的消息并生成tasklist命令数据"""
+        if self.registry is not None:
+            self.registry.expect_refresh(
+                call.message.chat.id, "tasks", call.message.message_id, shown, call.message.reply_markup
+            )
+        call.message.text = "tasklist"
+        return self.service.tasklist(call.message)
+
+
+class PageCallbackHandler:
+    """列表翻页回调处理器，从翻页缓存中取出页面并编辑原消息"""
+    
+    def __init__(self, bot, pages: PageCache):
+        """
+        初始化翻页回调处理器
+        
+        Args:
+            bot: Telegram bot实例
+            pages: 翻页缓存
+        """
+        self.bot = bot
+        self.pages = pages
+        self.logger = logging.getLogger(self.__class__.__name__)
+    
+    def _lookup(self, call) -> Optional[dict]:
+        """获取回调对应页面的编辑参数，列表已过期时返回None"""
+        parsed = pagination.parse_callback(call.data)
+        found = self.pages.get(*parsed) if parsed else None
+        if found is None:
+            return None
+        page, count = found
+        return {
+            "chat_id": call.message.chat.id,
+            "message_id": call.message.message_id,
+            **PageCache.page_kwargs(page, parsed[0], parsed[1], count),
+        }
+    
+    def handle_page(self, call) -> None:
+        """
+        处理翻页回调
+        
+        Args:
+            call: 回调查询对象
+        """
+        if call.data == pagination.PAGE_NOOP:
+            self.bot.answer_callback_query(call.id)
+            return
+        kwargs = self._lookup(call)
+        if kwargs is None:
+            self.bot.answer_callback_query(call.id, "列表已过期，请重新查询")
+            return
+        try:
+            self.bot.edit_message_text(**kwargs)
+        except Exception as e:
+            # 原消息可能已被删除
+            self.logger.debug("翻页失败: %s", e)
+        self.bot.answer_callback_query(call.id)
 
 
 class AliasCallbackHandler(CallbackHandler):
     """别名相关回调处理器"""
     
+    def __init__(self, bot, config_manager, service, mqtt_publisher: Callable,
+                 batch_publisher: Optional[Callable] = None):
+        """
+        初始化别名回调处理器
+        
+        Args:
+            batch_publisher: 批量发布函数，参数为命令数据列表；为None时逐条调用mqtt_publisher
+        """
+        super().__init__(bot, config_manager, service, mqtt_publisher)
+        self.batch_publisher = batch_publisher
+        # 别名执行计划缓存，别名配置变化时自动失效
+        self.plans = AliasPlanCache(config_manager, service)
+    
     def handle_exec(self, call) -> None:
         """
         处理别名执行回调
@@ -122,11 +196,7 @@ class AliasCallbackHandler(CallbackHandler):
             call: 回调查询对象
         """
         alias = call.data[10:]  # 移除 "alias_del_" 前缀
-        preferences = self.config.get_current_preferences()
-        
-        if alias in preferences:
-            del preferences[alias]
-            self.config.update_preferences(preferences)
+        self._delete_alias(alias)
         
         self.bot.answer_callback_query(call.id)
         self._show_delete_menu(call.message)
@@ -138,27 +208,42 @@ class AliasCallbackHandler(CallbackHandler):
         Args:
             call: 回调查询对象
         """
-        msg = self.bot.send_message(
+        self.bot.send_message(
             call.message.chat.id,
             "first input alias name, then input commands. e.g.\n"
             "myalias\nmycommand arg1 arg2"
         )
         
         def add_command(message):
-            lines = [i.strip() for i in message.text.split('\n') if i and i.strip()]
-            if len(lines) < 2:
+            errors = self._save_alias(message.text)
+            if errors is None:
                 self.bot.send_message(message.chat.id, "invalid format")
                 return
-            
-            alias = lines[0]
-            preferences = self.config.get_current_preferences()
-            preferences[alias] = lines[1:]
-            self.config.update_preferences(preferences)
+            if errors:
+                self.bot.send_message(message.chat.id, alias_errors_text(errors))
             
             self.bot.answer_callback_query(call.id)
             self._show_main_menu(call.message, send=True)
         
-        self.bot.register_next_step_handler(msg, add_command)
+        # 消息经出站队列异步发送，按聊天ID注册后续处理器
+        self.bot.register_next_step_handler_by_chat_id(call.message.chat.id, add_command)
+    
+    def _save_alias(self, text: str) -> Optional[List[str]]:
+        """
+        保存用户输入的别名（首行为别名，其余行为命令）
+        
+        Returns:
+            别名编译错误（为空时全部有效），格式无效时返回None
+        """
+        lines = [i.strip() for i in text.split('\n') if i and i.strip()]
+        if len(lines) < 2:
+            return None
+        
+        return self.config.set_alias(lines[0], lines[1:])
+    
+    def _delete_alias(self, alias: str) -> None:
+        """删除别名"""
+        self.config.delete_alias(alias)
     
     def handle_menu_switch(self, call) -> None:
         """
@@ -177,83 +262,77 @@ class AliasCallbackHandler(CallbackHandler):
             self._show_main_menu(call.message)
     
     def _exec_alias(self, alias: str, message) -> None:
-        """执行别名"""
-        preferences = self.config.get_current_preferences()
+        """
+        执行别名
         
-        if alias not in preferences:
+        按执行计划依次发布MQTT命令，最后合并发送一条确认消息
+        """
+        plan = self.plans.get(alias)
+        if plan is None:
             self.bot.send_message(message.chat.id, f"alias {alias} not found")
             return
         
-        for seq in preferences[alias]:
-            cmd_parts = [i for i in seq.split(" ") if i]
-            if len(cmd_parts) == 0:
-                continue
-            
-            cmd = cmd_parts[0]
-            message.text = seq
-            
-            try:
-                data = util.dynamic_call(self.service, cmd, message)
-                if data:
-                    self.logger.info(f"命令执行成功: {cmd}, data={str(data)}")
-                    self.mqtt_publisher(data)
-                    data['chat_id'] %= 100000
-                    self.bot.send_message(
-                        message.chat.id,
-                        f"{str(data)} is transmitted"
-                    )
-            except AttributeError:
-                self.logger.error(f"命令不存在: {cmd}")
-                self.bot.send_message(message.chat.id, f"command {cmd} not found")
+        lines, pending = [], []
+        for step in plan.steps:
+            if step.kind == STEP_PUBLISH:
+                data = step.build(message.chat.id)
+                pending.append(data)
+                lines.append(self._transmitted_line(data))
+            elif step.kind == STEP_CALL:
+                # 服务方法可能切换当前设备，先发出之前的命令
+                self._publish_pending(pending)
+                message.text = step.text
+                getattr(self.service, step.cmd)(message)
+            else:
+                lines.append(step.error)
+        self._publish_pending(pending)
+        
+        self.logger.info("别名执行完成: %s, 步骤数=%s", alias, len(plan.steps))
+        if lines:
+            self.bot.send_message(message.chat.id, "\n".join(lines))
     
-    def _show_alias_list(self, message, markup, text: str, send: bool = False) -> None:
-        """显示别名列表"""
+    def _publish_pending(self, pending: list) -> None:
+        """发布并清空待发送的命令"""
+        if not pending:
+            return
+        if self.batch_publisher is not None and len(pending) > 1:
+            self.batch_publisher(list(pending))
+        else:
+            for data in pending:
+                self.mqtt_publisher(data)
+        pending.clear()
+    
+    @staticmethod
+    def _transmitted_line(data) -> str:
+        """构建单条命令的确认文本（隐藏完整chat_id）"""
+        data = dict(data)
+        data['chat_id'] %= 100000
+        return f"{str(data)} is transmitted"
+    
+    def _alias_list_text(self, text: str) -> str:
+        """构建别名列表文本"""
         preferences = self.config.get_current_preferences()
         preference_msg = "\n".join([
             f"+{k}\n{chr(10).join('    ' + line for line in v)}"
             for k, v in preferences.items()
         ])
         
-        full_text = f"alias list:\n{preference_msg}\n\n{text}"
-        
-        if send:
-            self.bot.send_message(message.chat.id, full_text, reply_markup=markup)
-        else:
-            self.bot.edit_message_text(
-                full_text,
-                chat_id=message.chat.id,
-                message_id=message.message_id,
-                reply_markup=markup
-            )
+        return f"alias list:\n{preference_msg}\n\n{text}"
     
-    def _show_delete_menu(self, message, send: bool = False) -> None:
-        """显示删除菜单"""
-        preferences = self.config.get_current_preferences()
-        markup = types.InlineKeyboardMarkup()
-        
-        for alias in preferences:
-            btn = types.InlineKeyboardButton(
-                alias,
-                callback_data=f"alias_del_{alias}"
-            )
-            markup.add(btn)
-        
-        markup.add(types.InlineKeyboardButton(
-            "⬅ back to alias list",
-            callback_data="alias_cancel"
-        ))
+    def _alias_markup(self, prefix: str) -> types.InlineKeyboardMarkup:
+        """
+        构建别名选择键盘
         
-        self._show_alias_list(message, markup, "which alias del", send)
-    
-    def _show_exec_menu(self, message, send: bool = False) -> None:
-        """显示执行菜单"""
+        Args:
+            prefix: 回调数据前缀，如 "alias_del_"
+        """
         preferences = self.config.get_current_preferences()
         markup = types.InlineKeyboardMarkup()
         
         for alias in preferences:
             btn = types.InlineKeyboardButton(
                 alias,
-                callback_data=f"alias_exc_{alias}"
+                callback_data=f"{prefix}{alias}"
             )
             markup.add(btn)
         
@@ -261,11 +340,11 @@ class AliasCallbackHandler(CallbackHandler):
             "⬅ back to alias list",
             callback_data="alias_cancel"
         ))
-        
-        self._show_alias_list(message, markup, "which alias exc", send)
+        return markup
     
-    def _show_main_menu(self, message, send: bool = False) -> None:
-        """显示主菜单"""
+    @staticmethod
+    def _main_markup() -> types.InlineKeyboardMarkup:
+        """构建别名主菜单键盘"""
         markup = types.InlineKeyboardMarkup()
         buttons = [
             types.InlineKeyboardButton("exc", callback_data="alias_exc"),
@@ -273,10 +352,279 @@ class AliasCallbackHandler(CallbackHandler):
             types.InlineKeyboardButton("del", callback_data="alias_del")
         ]
         markup.add(*buttons)
+        return markup
+    
+    def _show_alias_list(self, message, markup, text: str, send: bool = False) -> None:
+        """显示别名列表"""
+        full_text = self._alias_list_text(text)
         
-        self._show_alias_list(message, markup, "which alias option", send)
+        if send:
+            self.bot.send_message(message.chat.id, full_text, reply_markup=markup)
+        else:
+            self.bot.edit_message_text(
+                full_text,
+                chat_id=message.chat.id,
+                message_id=message.message_id,
+                reply_markup=markup
+            )
+    
+    def _show_delete_menu(self, message, send: bool = False) -> None:
+        """显示删除菜单"""
+        self._show_alias_list(message, self._alias_markup("alias_del_"), "which alias del", send)
+    
+    def _show_exec_menu(self, message, send: bool = False) -> None:
+        """显示执行菜单"""
+        self._show_alias_list(message, self._alias_markup("alias_exc_"), "which alias exc", send)
+    
+    def _show_main_menu(self, message, send: bool = False) -> None:
+        """显示主菜单"""
+        self._show_alias_list(message, self._main_markup(), "which alias option", send)
     
     def show_alias_menu(self, message) -> None:
         """显示别名主菜单（公共方法）"""
-        self.logger.info(f"显示别名菜单: user_id={message.from_user.id}")
+        self.logger.info("显示别名菜单: user_id=%s", message.from_user.id)
         self._show_main_menu(message, send=True)
+
+
+class AsyncTaskCallbackHandler(TaskCallbackHandler):
+    """异步任务相关回调处理器，mqtt_publisher需为协程函数"""
+    
+    async def handle_taskid(self, call) -> None:
+        """
+        处理任务ID终止回调
+        
+        Args:
+            call: 回调查询对象
+        """
+        taskid = call.data[7:]  # 移除 "taskid_" 前缀
+        shown = call.message.text
+        call.message.text = f"terminate {taskid}"
+        await self._terminate_and_refresh(call, self.service.terminate, shown)
+    
+    async def handle_taskname(self, call) -> None:
+        """
+        处理任务名称终止回调
+        
+        Args:
+            call: 回调查询对象
+        """
+        taskname = call.data[9:]  # 移除 "taskname_" 前缀
+        shown = call.message.text
+        call.message.text = f"terminatename {taskname}"
+        await self._terminate_and_refresh(call, self.service.terminatename, shown)
+    
+    async def _terminate_and_refresh(self, call, terminate: Callable, shown: str) -> None:
+        """
+        发送终止命令并刷新任务列表
+        
+        Args:
+            call: 回调查询对象
+            terminate: 生成终止命令数据的服务方法
+            shown: 被点击的任务列表消息当前的文本
+        """
+        command = call.message.text
+        try:
+            data = terminate(call.message)
+            if data:
+                await self.mqtt_publisher(data)
+        except Exception as e:
+            self.logger.error("终止任务失败: %s", e)
+            await self.bot.answer_callback_query(call.id, "操作失败")
+            return
+        
+        await self.bot.answer_callback_query(call.id, f"{command} is transmitted")
+        
+        data = self._prepare_refresh(call, shown)
+        if data:
+            await self.mqtt_publisher(data)
+
+
+class AsyncPageCallbackHandler(PageCallbackHandler):
+    """异步列表翻页回调处理器"""
+    
+    async def handle_page(self, call) -> None:
+        """
+        处理翻页回调
+        
+        Args:
+            call: 回调查询对象
+        """
+        if call.data == pagination.PAGE_NOOP:
+            await self.bot.answer_callback_query(call.id)
+            return
+        kwargs = self._lookup(call)
+        if kwargs is None:
+            await self.bot.answer_callback_query(call.id, "列表已过期，请重新查询")
+            return
+        try:
+            await self.bot.edit_message_text(**kwargs)
+        except Exception as e:
+            # 原消息可能已被删除
+            self.logger.debug("翻页失败: %s", e)
+        await self.bot.answer_callback_query(call.id)
+
+
+class AsyncAliasCallbackHandler(AliasCallbackHandler):
+    """异步别名相关回调处理器，mqtt_publisher需为协程函数"""
+    
+    def __init__(self, bot, config_manager, service, mqtt_publisher: Callable,
+                 batch_publisher: Optional[Callable] = None):
+        super().__init__(bot, config_manager, service, mqtt_publisher, batch_publisher)
+        # chat_id -> 等待用户输入别名内容的回调
+        self.pending_add = {}
+    
+    async def handle_exec(self, call) -> None:
+        """
+        处理别名执行回调
+        
+        Args:
+            call: 回调查询对象
+        """
+        alias = call.data[10:]  # 移除 "alias_exc_" 前缀
+        await self._exec_alias(alias, call.message)
+        await self.bot.answer_callback_query(call.id)
+    
+    async def handle_delete(self, call) -> None:
+        """
+        处理别名删除回调
+        
+        Args:
+            call: 回调查询对象
+        """
+        alias = call.data[10:]  # 移除 "alias_del_" 前缀
+        self._delete_alias(alias)
+        
+        await self.bot.answer_callback_query(call.id)
+        await self._show_delete_menu(call.message)
+    
+    async def handle_add(self, call) -> None:
+        """
+        处理别名添加回调
+        
+        Args:
+            call: 回调查询对象
+        """
+        msg = await self.bot.send_message(
+            call.message.chat.id,
+            "first input alias name, then input commands. e.g.\n"
+            "myalias\nmycommand arg1 arg2"
+        )
+        
+        async def add_command(message):
+            errors = self._save_alias(message.text)
+            if errors is None:
+                await self.bot.send_message(message.chat.id, "invalid format")
+                return
+            if errors:
+                await self.bot.send_message(message.chat.id, alias_errors_text(errors))
+            
+            await self.bot.answer_callback_query(call.id)
+            await self._show_main_menu(call.message, send=True)
+        
+        # AsyncTeleBot没有next_step机制，使用一次性的消息处理器代替
+        self.pending_add[msg.chat.id] = add_command
+    
+    async def handle_pending_add(self, message) -> bool:
+        """
+        处理等待中的别名添加输入
+        
+        Args:
+            message: 用户输入的消息
+            
+        Returns:
+            是否消费了该消息
+        """
+        add_command = self.pending_add.pop(message.chat.id, None)
+        if add_command is None:
+            return False
+        await add_command(message)
+        return True
+    
+    async def handle_menu_switch(self, call) -> None:
+        """
+        处理菜单切换回调
+        
+        Args:
+            call: 回调查询对象
+        """
+        await self.bot.answer_callback_query(call.id)
+        
+        if call.data == "alias_del":
+            await self._show_delete_menu(call.message)
+        elif call.data == "alias_exc":
+            await self._show_exec_menu(call.message)
+        elif call.data == "alias_cancel":
+            await self._show_main_menu(call.message)
+    
+    async def _exec_alias(self, alias: str, message) -> None:
+        """
+        执行别名
+        
+        按执行计划依次发布MQTT命令，最后合并发送一条确认消息
+        """
+        plan = self.plans.get(alias)
+        if plan is None:
+            await self.bot.send_message(message.chat.id, f"alias {alias} not found")
+            return
+        
+        lines, pending = [], []
+        for step in plan.steps:
+            if step.kind == STEP_PUBLISH:
+                data = step.build(message.chat.id)
+                pending.append(data)
+                lines.append(self._transmitted_line(data))
+            elif step.kind == STEP_CALL:
+                await self._publish_pending(pending)
+                message.text = step.text
+                result = getattr(self.service, step.cmd)(message)
+                if inspect.isawaitable(result):
+                    await result
+            else:
+                lines.append(step.error)
+        await self._publish_pending(pending)
+        
+        self.logger.info("别名执行完成: %s, 步骤数=%s", alias, len(plan.steps))
+        if lines:
+            await self.bot.send_message(message.chat.id, "\n".join(lines))
+    
+    async def _publish_pending(self, pending: list) -> None:
+        """发布并清空待发送的命令"""
+        if not pending:
+            return
+        if self.batch_publisher is not None and len(pending) > 1:
+            await self.batch_publisher(list(pending))
+        else:
+            for data in pending:
+                await self.mqtt_publisher(data)
+        pending.clear()
+    
+    async def _show_alias_list(self, message, markup, text: str, send: bool = False) -> None:
+        """显示别名列表"""
+        full_text = self._alias_list_text(text)
+        
+        if send:
+            await self.bot.send_message(message.chat.id, full_text, reply_markup=markup)
+        else:
+            await self.bot.edit_message_text(
+                full_text,
+                chat_id=message.chat.id,
+                message_id=message.message_id,
+                reply_markup=markup
+            )
+    
+    async def _show_delete_menu(self, message, send: bool = False) -> None:
+        """显示删除菜单"""
+        await self._show_alias_list(message, self._alias_markup("alias_del_"), "which alias del", send)
+    
+    async def _show_exec_menu(self, message, send: bool = False) -> None:
+        """显示执行菜单"""
+        await self._show_alias_list(message, self._alias_markup("alias_exc_"), "which alias exc", send)
+    
+    async def _show_main_menu(self, message, send: bool = False) -> None:
+        """显示主菜单"""
+        await self._show_alias_list(message, self._main_markup(), "which alias option", send)
+    
+    async def show_alias_menu(self, message) -> None:
+        """显示别名主菜单（公共方法）"""
+        self.logger.info("显示别名菜单: user_id=%s", message.from_user.id)
+        await self._show_main_menu(message, send=True)
@@ -0,0 +1,105 @@
+"""MQTT消息编解码模块
+
+每个设备通过DeviceConfig.ir_codec选择编解码器：
+
+- json: 标准JSON（安装了orjson时使用orjson，否则使用标准库json）
+- msgpack: MessagePack二进制格式，体积更小，需要安装msgpack，
+  设备端ArduinoJson可直接解析
+
+设备回复使用与收到的命令相同的格式，但定时任务等主动上报的消息可能仍为JSON，
+因此二进制编解码器解码时遇到以"{"开头的消息会按JSON解析。
+"""
+
+import json
+from typing import Any, Dict, Type
+
+try:
+    import orjson
+except ImportError:  # orjson为可选依赖
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # msgpack为可选依赖
+    msgpack = None
+
+
+class Codec:
+    """编解码器基类"""
+    
+    name = ""
+    
+    def encode(self, data: Any) -> bytes:
+        """编码为MQTT消息内容"""
+        raise NotImplementedError
+    
+    def decode(self, payload: bytes) -> Any:
+        """
+        解码MQTT消息内容
+        
+        Raises:
+            ValueError: 消息格式错误时
+        """
+        raise NotImplementedError
+
+
+class JsonCodec(Codec):
+    """JSON编解码器"""
+    
+    name = "json"
+    
+    def encode(self, data: Any) -> bytes:
+        if orjson is not None:
+            return orjson.dumps(data)
+        return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    
+    def decode(self, payload: bytes) -> Any:
+        if orjson is not None:
+            return orjson.loads(payload)
+        return json.loads(payload.decode("utf-8"))
+
+
+class MsgPackCodec(Codec):
+    """MessagePack编解码器"""
+    
+    name = "msgpack"
+    
+    def __init__(self):
+        if msgpack is None:
+            raise ValueError("使用msgpack编解码器需要安装msgpack: pip install msgpack")
+        self._json = JsonCodec()
+    
+    def encode(self, data: Any) -> bytes:
+        return msgpack.packb(data, use_bin_type=True)
+    
+    def decode(self, payload: bytes) -> Any:
+        if payload[:1] == b"{":
+            return self._json.decode(payload)
+        return msgpack.unpackb(payload, raw=False)
+
+
+CODECS: Dict[str, Type[Codec]] = {
+    JsonCodec.name: JsonCodec,
+    MsgPackCodec.name: MsgPackCodec,
+}
+
+_instances: Dict[str, Codec] = {}
+
+
+def get_codec(name: str) -> Codec:
+    """
+    获取编解码器实例
+    
+    Args:
+        name: 编解码器名称，见CODECS
+    
+    Raises:
+        ValueError: 名称未知或依赖未安装时
+    """
+    codec = _instances.get(name)
+    if codec is None:
+        codec_cls = CODECS.get(name)
+        if codec_cls is None:
+            raise ValueError(f"未知的编解码器: {name}")
+        codec = _instances[name] = codec_cls()
+    return codec
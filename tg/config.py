@@ -1,12 +1,16 @@
 """配置管理模块（重构版）
 
 使用dataclass提供类型安全的配置管理。
+数据库配置通过存储后端（见storage模块）持久化，默认为延迟写入的db.json。
 """
 
+import atexit
 import logging
+import threading
 from dataclasses import dataclass, field
-from typing import Dict, List, Any
+from typing import Callable, Dict, List, Any, Iterable, Optional
 import util
+from storage import StorageBackend, create_storage, FLUSH_DELAY
 
 
 logger = logging.getLogger(__name__)
@@ -22,6 +26,7 @@ class DeviceConfig:
     ir_password: str
     ir_sub_topic: str
     ir_pub_topic: str
+    ir_codec: str = "json"
     
     @classmethod
     def from_dict(cls, data: Dict[str, Any]) -> 'DeviceConfig':
@@ -33,7 +38,8 @@ class DeviceConfig:
             ir_username=data.get("ir_username", ""),
             ir_password=data.get("ir_password", ""),
             ir_sub_topic=data.get("ir_sub_topic", ""),
-            ir_pub_topic=data.get("ir_pub_topic", "")
+            ir_pub_topic=data.get("ir_pub_topic", ""),
+            ir_codec=data.get("ir_codec", "json")
         )
     
     def to_dict(self) -> Dict[str, Any]:
@@ -45,7 +51,8 @@ class DeviceConfig:
             "ir_username": self.ir_username,
             "ir_password": self.ir_password,
             "ir_sub_topic": self.ir_sub_topic,
-            "ir_pub_topic": self.ir_pub_topic
+            "ir_pub_topic": self.ir_pub_topic,
+            "ir_codec": self.ir_codec
         }
 
 
@@ -55,6 +62,34 @@ class EnvConfig:
     ir_bot_token: str
     ir_admin_chat_id: int
     devices: List[DeviceConfig] = field(default_factory=list)
+    # MQTT入站消息工作池
+    ir_inbound_workers: int = 4
+    ir_inbound_queue_size: int = 1000
+    ir_inbound_overflow: str = "drop_oldest"
+    # MQTT启动时间预算（秒），超时后记录仍未连接的设备
+    ir_mqtt_startup_budget: float = 10
+    # 存储后端: json或sqlite
+    ir_storage: str = "json"
+    ir_sqlite_file: str = "db.sqlite3"
+    # 设备影子缓存有效期（秒），为0时不缓存
+    ir_shadow_ttl: float = 30
+    # 命令等待设备回复的超时时间（秒），为0时不检查
+    ir_request_timeout: float = 10
+    # Bot API服务器地址，为空时使用api.telegram.org（可指向自建的Bot API服务器）
+    ir_api_url: str = ""
+    # 任务调度模式: device（任务保存在设备上）或server（任务保存在bot端，到期后发往设备）
+    ir_scheduler: str = "device"
+    ir_scheduler_max_tasks: int = 10000
+    # 日志输出格式: text或json（JSON lines）
+    ir_log_format: str = "text"
+    # 日志记录器名称 -> 每秒允许的INFO及以下级别记录数
+    ir_log_rate_limits: Dict[str, float] = field(default_factory=dict)
+    # 指标HTTP端口，为0时不启动；默认只监听本机
+    ir_metrics_port: int = 0
+    ir_metrics_host: str = "127.0.0.1"
+    # trace导出文件，为空时只保存在内存中；格式: json或otlp
+    ir_trace_file: str = ""
+    ir_trace_format: str = "json"
     
     @classmethod
     def from_dict(cls, data: Dict[str, Any]) -> 'EnvConfig':
@@ -63,7 +98,24 @@ class EnvConfig:
         return cls(
             ir_bot_token=data.get("ir_bot_token", ""),
             ir_admin_chat_id=data.get("ir_admin_chat_id", 0),
-            devices=devices
+            devices=devices,
+            ir_inbound_workers=data.get("ir_inbound_workers", 4),
+            ir_inbound_queue_size=data.get("ir_inbound_queue_size", 1000),
+            ir_inbound_overflow=data.get("ir_inbound_overflow", "drop_oldest"),
+            ir_mqtt_startup_budget=data.get("ir_mqtt_startup_budget", 10),
+            ir_storage=data.get("ir_storage", "json"),
+            ir_sqlite_file=data.get("ir_sqlite_file", "db.sqlite3"),
+            ir_shadow_ttl=data.get("ir_shadow_ttl", 30),
+            ir_request_timeout=data.get("ir_request_timeout", 10),
+            ir_api_url=data.get("ir_api_url", ""),
+            ir_scheduler=data.get("ir_scheduler", "device"),
+            ir_scheduler_max_tasks=data.get("ir_scheduler_max_tasks", 10000),
+            ir_log_format=data.get("ir_log_format", "text"),
+            ir_log_rate_limits=data.get("ir_log_rate_limits", {}),
+            ir_metrics_port=data.get("ir_metrics_port", 0),
+            ir_metrics_host=data.get("ir_metrics_host", "127.0.0.1"),
+            ir_trace_file=data.get("ir_trace_file", ""),
+            ir_trace_format=data.get("ir_trace_format", "json")
         )
 
 
@@ -83,24 +135,61 @@ class DatabaseConfig:
         }
 
 
+class AuthorizationIndex:
+    """授权用户索引
+    
+    以frozenset快照保存授权用户，查询为O(1)。用户列表变化时整体替换快照，
+    替换是单次引用赋值，读取方无需加锁，且总能看到完整的新旧快照之一。
+    """
+    
+    def __init__(self, users: Iterable[int] = ()):
+        self._users = frozenset(users)
+    
+    def __contains__(self, chat_id: int) -> bool:
+        return chat_id in self._users
+    
+    def __len__(self) -> int:
+        return len(self._users)
+    
+    def is_authorized(self, chat_id: int) -> bool:
+        """检查聊天ID是否已授权"""
+        return chat_id in self._users
+    
+    def replace(self, users: Iterable[int]) -> None:
+        """用新的用户列表替换快照"""
+        self._users = frozenset(users)
+
+
 class ConfigManager:
     """配置管理器"""
     
-    def __init__(self, env_file: str = util.ENVFILE, db_file: str = util.DBFILE):
+    def __init__(self, env_file: str = util.ENVFILE, db_file: str = util.DBFILE,
+                 flush_delay: float = FLUSH_DELAY):
         """
         初始化配置管理器
         
         Args:
             env_file: 环境配置文件路径
             db_file: 数据库文件路径
+            flush_delay: JSON存储后端延迟写入的秒数
         """
         self.env_file = env_file
         self.db_file = db_file
+        self.flush_delay = flush_delay
         self.env: EnvConfig = None
         self.db: DatabaseConfig = None
         self.devices: Dict[str, DeviceConfig] = {}
+        self.storage: StorageBackend = None
+        self.auth = AuthorizationIndex()
+        # 别名配置每次变化时递增，别名执行计划缓存据此判断是否过期
+        self.preferences_version = 0
+        # 别名配置变化的监听函数，参数为(设备名称, 别名或None表示全部)，返回别名编译错误
+        self.preferences_listeners: List[Callable[[str, Optional[str]], List[str]]] = []
+        
+        self._lock = threading.RLock()
         
         self._load()
+        atexit.register(self.close)
     
     def _load(self) -> None:
         """加载配置"""
@@ -112,7 +201,10 @@ class ConfigManager:
         self.devices = {device.name: device for device in self.env.devices}
         
         # 加载数据库配置
-        db_data = util.load_dict(self.db_file)
+        self.storage = create_storage(
+            self.env.ir_storage, self.db_file, self.env.ir_sqlite_file, self.flush_delay
+        )
+        db_data = self.storage.load()
         
         # 设置默认值
         if "device" not in db_data and self.env.devices:
@@ -141,16 +233,42 @@ class ConfigManager:
             user=users,
             preference=preferences
         )
+        self.auth.replace(self.db.user)
         
-        # 保存初始化后的配置
-        self.save_db()
+        # 补充了默认值时保存初始化后的配置
+        if db_data != self.db.to_dict():
+            self.save_db(sync=True)
         
-        logger.info(f"配置加载完成: 设备数={len(self.devices)}, 用户数={len(self.db.user)}")
+        logger.info(
+            "配置加载完成: 存储=%s, 设备数=%s, 用户数=%s",
+            self.env.ir_storage, len(self.devices), len(self.db.user)
+        )
+    
+    def save_db(self, sync: bool = False) -> None:
+        """
+        整体保存数据库配置
+        
+        日常修改由各方法按行写入存储后端，此方法用于初始化等需要整体覆盖的场合。
+        
+        Args:
+            sync: 是否立即同步写入
+        """
+        with self._lock:
+            self.storage.save_all(self.db.to_dict())
+            if sync:
+                self.flush()
+    
+    def flush(self) -> None:
+        """立即写入未保存的数据库配置"""
+        with self._lock:
+            self.storage.flush()
     
-    def save_db(self) -> None:
-        """保存数据库配置"""
-        util.save_dict(self.db_file, self.db.to_dict())
-        logger.debug("数据库配置已保存")
+    def close(self) -> None:
+        """写入未保存的数据库配置并关闭存储后端，退出前调用"""
+        with self._lock:
+            if self.storage is not None:
+                self.storage.close()
+                self.storage = None
     
     def get_current_device(self) -> DeviceConfig:
         """获取当前设备配置"""
@@ -167,33 +285,89 @@ class ConfigManager:
             是否成功设置
         """
         if device_name not in self.devices:
-            logger.warning(f"设备不存在: {device_name}")
+            logger.warning("设备不存在: %s", device_name)
             return False
         
-        self.db.device = self.devices[device_name]
-        
-        # 确保设备在偏好设置中存在
-        if device_name not in self.db.preference:
-            self.db.preference[device_name] = {}
-        
-        self.save_db()
-        logger.info(f"切换设备: {device_name}")
+        with self._lock:
+            self.db.device = self.devices[device_name]
+            
+            # 确保设备在偏好设置中存在
+            if device_name not in self.db.preference:
+                self.db.preference[device_name] = {}
+            
+            self.storage.set_device(self.db.device.to_dict())
+        logger.info("切换设备: %s", device_name)
         return True
     
     def get_current_preferences(self) -> Dict[str, List[str]]:
         """获取当前设备的偏好设置"""
         return self.db.preference.get(self.db.device.name, {})
     
-    def update_preferences(self, preferences: Dict[str, List[str]]) -> None:
+    def update_preferences(self, preferences: Dict[str, List[str]]) -> List[str]:
         """
         更新当前设备的偏好设置
         
         Args:
             preferences: 新的偏好设置
+            
+        Returns:
+            别名编译错误，为空时全部有效
+        """
+        with self._lock:
+            device_name = self.db.device.name
+            self.db.preference[device_name] = preferences
+            self.storage.set_preferences(device_name, preferences)
+            self.preferences_version += 1
+        logger.info("偏好设置已更新: %s", device_name)
+        return self._notify_preferences(device_name, None)
+    
+    def set_alias(self, alias: str, commands: List[str]) -> List[str]:
+        """
+        新增或更新当前设备的别名
+        
+        Args:
+            alias: 别名
+            commands: 命令列表
+            
+        Returns:
+            别名编译错误，为空时全部有效
+        """
+        with self._lock:
+            device_name = self.db.device.name
+            self.db.preference.setdefault(device_name, {})[alias] = commands
+            self.storage.set_alias(device_name, alias, commands)
+            self.preferences_version += 1
+        logger.info("别名已保存: %s/%s", device_name, alias)
+        return self._notify_preferences(device_name, alias)
+    
+    def delete_alias(self, alias: str) -> bool:
+        """
+        删除当前设备的别名
+        
+        Args:
+            alias: 别名
+            
+        Returns:
+            别名是否存在
         """
-        self.db.preference[self.db.device.name] = preferences
-        self.save_db()
-        logger.info(f"偏好设置已更新: {self.db.device.name}")
+        with self._lock:
+            device_name = self.db.device.name
+            preferences = self.db.preference.get(device_name, {})
+            if alias not in preferences:
+                return False
+            del preferences[alias]
+            self.storage.delete_alias(device_name, alias)
+            self.preferences_version += 1
+        logger.info("别名已删除: %s/%s", device_name, alias)
+        self._notify_preferences(device_name, alias)
+        return True
+    
+    def _notify_preferences(self, device_name: str, alias: Optional[str]) -> List[str]:
+        """通知别名配置变化，返回各监听函数报告的编译错误"""
+        errors: List[str] = []
+        for listener in self.preferences_listeners:
+            errors.extend(listener(device_name, alias))
+        return errors
     
     def is_user_authorized(self, chat_id: int) -> bool:
         """
@@ -205,7 +379,7 @@ class ConfigManager:
         Returns:
             是否已授权
         """
-        return chat_id in self.db.user
+        return self.auth.is_authorized(chat_id)
     
     def add_user(self, chat_id: int) -> None:
         """
@@ -214,10 +388,13 @@ class ConfigManager:
         Args:
             chat_id: 聊天ID
         """
-        if chat_id not in self.db.user:
+        with self._lock:
+            if chat_id in self.db.user:
+                return
             self.db.user.append(chat_id)
-            self.save_db()
-            logger.info(f"添加授权用户: {chat_id}")
+            self.auth.replace(self.db.user)
+            self.storage.add_user(chat_id)
+        logger.info("添加授权用户: %s", chat_id)
     
     def remove_user(self, chat_id: int) -> None:
         """
@@ -226,10 +403,15 @@ class ConfigManager:
         Args:
             chat_id: 聊天ID
         """
-        if chat_id in self.db.user and chat_id != self.env.ir_admin_chat_id:
+        if chat_id == self.env.ir_admin_chat_id:
+            return
+        with self._lock:
+            if chat_id not in self.db.user:
+                return
             self.db.user.remove(chat_id)
-            self.save_db()
-            logger.info(f"移除授权用户: {chat_id}")
+            self.auth.replace(self.db.user)
+            self.storage.remove_user(chat_id)
+        logger.info("移除授权用户: %s", chat_id)
 
 
 def load_config(env_file: str = util.ENVFILE, db_file: str = util.DBFILE) -> ConfigManager:
@@ -0,0 +1,199 @@
+"""请求关联模块
+
+bot发往设备的每条命令带有关联ID（rid），设备在该命令产生的回复中原样带回。
+bot据此：
+
+- 在待回复表中登记命令，收到带相同rid的回复时计算往返时延（RTT）
+- 超时仍未收到回复的命令视为丢失，通知发出命令的聊天
+- 按设备统计RTT直方图（p50/p95/p99）
+
+只有在回复中声明了rid能力的设备才会登记待回复表，旧固件忽略rid字段，
+不会产生误报的超时。
+"""
+
+import logging
+import math
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional
+
+
+logger = logging.getLogger(__name__)
+
+CAP_RID = "rid"
+RID_KEY = "rid"
+
+# 设备端rid为uint32，超过后回绕，0表示没有rid
+RID_LIMIT = 2 ** 31
+
+
+class LatencyHistogram:
+    """对数分桶的时延直方图，相邻桶边界相差10%，内存占用与样本数无关"""
+    
+    GROWTH = 1.1
+    # 最小分辨率（秒），小于此值的样本计入第0个桶
+    RESOLUTION = 0.001
+    
+    def __init__(self):
+        self.buckets: Dict[int, int] = {}
+        self.count = 0
+        self.timeouts = 0
+        self.total = 0.0
+        self.max = 0.0
+    
+    def record(self, seconds: float) -> None:
+        """记录一个往返时延样本"""
+        index = 0
+        if seconds > self.RESOLUTION:
+            index = int(math.log(seconds / self.RESOLUTION, self.GROWTH)) + 1
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+    
+    def percentile(self, p: float) -> float:
+        """
+        获取时延分位数
+        
+        Args:
+            p: 分位，如0.99
+        
+        Returns:
+            分位数所在桶的上边界（秒），没有样本时为0
+        """
+        if not self.count:
+            return 0.0
+        rank = max(1, math.ceil(self.count * p))
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                return min(self.RESOLUTION * self.GROWTH ** index, self.max)
+        return self.max
+    
+    def snapshot(self) -> Dict[str, Any]:
+        """获取统计快照"""
+        return {
+            "count": self.count,
+            "timeouts": self.timeouts,
+            "avg": self.total / self.count if self.count else 0.0,
+            "p50": self.percentile(0.50),
+            "p95": self.percentile(0.95),
+            "p99": self.percentile(0.99),
+            "max": self.max,
+        }
+
+
+@dataclass
+class PendingRequest:
+    """等待设备回复的命令"""
+    rid: int
+    device_name: str
+    cmd: str
+    chat_id: int
+    sent: float
+    deadline: float
+
+
+class RequestTracker:
+    """待回复表与各设备的RTT统计"""
+    
+    def __init__(self, timeout: float = 10):
+        """
+        初始化请求跟踪器
+        
+        Args:
+            timeout: 命令等待回复的超时时间（秒），为0时不登记待回复表
+        """
+        self.timeout = timeout
+        self.pending: Dict[int, PendingRequest] = {}
+        self.histograms: Dict[str, LatencyHistogram] = {}
+        self._last_rid = 0
+        self._lock = threading.Lock()
+    
+    def next_rid(self) -> int:
+        """分配关联ID"""
+        with self._lock:
+            self._last_rid = self._last_rid % (RID_LIMIT - 1) + 1
+            return self._last_rid
+    
+    def register(self, device_name: str, data: Dict[str, Any]) -> None:
+        """
+        登记已发布的命令
+        
+        Args:
+            device_name: 设备名称
+            data: 带rid的命令数据
+        """
+        if self.timeout <= 0:
+            return
+        now = time.monotonic()
+        request = PendingRequest(
+            data[RID_KEY], device_name, str(data.get("cmd", "")),
+            data.get("chat_id", 0), now, now + self.timeout
+        )
+        with self._lock:
+            self.pending[request.rid] = request
+    
+    def resolve(self, device_name: Optional[str], message: Dict[str, Any]) -> Optional[PendingRequest]:
+        """
+        用设备回复完成待回复的命令并记录RTT
+        
+        一条命令可能产生多个回复（如exec多个名称），只有第一个回复计入RTT。
+        
+        Args:
+            device_name: 设备名称
+            message: 设备回复
+        
+        Returns:
+            完成的命令，回复不对应待回复的命令时返回None
+        """
+        rid = message.get(RID_KEY)
+        if not rid:
+            return None
+        with self._lock:
+            request = self.pending.get(rid)
+            if request is None or request.device_name != device_name:
+                return None
+            del self.pending[rid]
+            self._histogram(device_name).record(time.monotonic() - request.sent)
+        return request
+    
+    def expire(self) -> List[PendingRequest]:
+        """
+        移除已超时的命令
+        
+        Returns:
+            超时的命令列表
+        """
+        now = time.monotonic()
+        with self._lock:
+            expired = [r for r in self.pending.values() if r.deadline <= now]
+            for request in expired:
+                del self.pending[request.rid]
+                self._histogram(request.device_name).timeouts += 1
+        return expired
+    
+    def _histogram(self, device_name: str) -> LatencyHistogram:
+        histogram = self.histograms.get(device_name)
+        if histogram is None:
+            histogram = self.histograms[device_name] = LatencyHistogram()
+        return histogram
+    
+    def get_stats(self) -> Dict[str, Dict[str, Any]]:
+        """获取每个设备的RTT统计（秒）与待回复命令数"""
+        with self._lock:
+            stats = {name: h.snapshot() for name, h in self.histograms.items()}
+            for request in self.pending.values():
+                entry = stats.setdefault(request.device_name, LatencyHistogram().snapshot())
+                entry["pending"] = entry.get("pending", 0) + 1
+        return stats
+    
+    @staticmethod
+    def timeout_text(request: PendingRequest) -> str:
+        """构建命令超时的通知文本"""
+        return (
+            f"{request.device_name}: no reply to {request.cmd} (rid={request.rid}) "
+            f"within {time.monotonic() - request.sent:.0f}s"
+        )
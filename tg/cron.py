@@ -0,0 +1,201 @@
+"""cron表达式模块
+
+与esp/IR.ino的parse_cron/match_cron语义一致：
+
+- 6字段（秒 分 时 日 月 周），兼容5字段（无秒，秒取0）
+- 每个字段支持 `, - * /`，周字段0和7都表示周日
+- 日与周同时满足才匹配
+- 按UTC+8计算
+
+表达式预编译为每个字段的位掩码，编译结果按表达式缓存。计算下次执行时间时
+按字段从月到秒逐级查找下一个可取的值，某一级没有可取的值时进位到上一级，
+不逐秒扫描。
+"""
+
+import calendar
+import time
+from functools import lru_cache
+from typing import List, Optional, Tuple
+
+
+# 设备端固定使用UTC+8
+TIMEZONE_OFFSET = 8 * 3600
+
+FIELD_NAMES = ("秒", "分", "时", "日", "月", "周")
+# 秒 分 时 日 月 周 的取值范围
+FIELD_BOUNDS = ((0, 59), (0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+# 向后查找下次执行时间的最大年数，覆盖日期与星期组合的28年周期
+SEARCH_YEARS = 28
+
+# 缓存的已编译表达式数量
+CACHE_SIZE = 256
+
+
+class CronError(ValueError):
+    """cron表达式不合法"""
+
+
+def _atoi(s: str) -> int:
+    """与C的atoi一致：取开头的数字，没有数字时为0"""
+    digits = ""
+    for ch in s.strip():
+        if not ch.isdigit():
+            break
+        digits += ch
+    return int(digits) if digits else 0
+
+
+def _next_bit(mask: int, value: int) -> Optional[int]:
+    """获取掩码中不小于value的最小取值，没有时返回None"""
+    rest = mask >> value
+    if not rest:
+        return None
+    return value + (rest & -rest).bit_length() - 1
+
+
+def parse_field(field: str, min_val: int, max_val: int) -> int:
+    """
+    解析cron的一个字段
+    
+    Returns:
+        取值的位掩码，没有任何取值时为0
+    """
+    mask = 0
+    for token in field.split(","):
+        if token.startswith("*"):
+            step = int(token[2:]) if token[1:2] == "/" and token[2:].isdigit() else 1
+            values = range(min_val, max_val + 1, max(step, 1))
+        elif "-" in token:
+            start, _, end = token.partition("-")
+            end, _, step = end.partition("/")
+            values = range(max(_atoi(start), min_val), min(_atoi(end), max_val) + 1, max(_atoi(step), 1))
+        else:
+            num = _atoi(token)
+            values = [num] if min_val <= num <= max_val else []
+        for v in values:
+            mask |= 1 << v
+    return mask
+
+
+class CronPattern:
+    """编译后的cron表达式"""
+    
+    def __init__(self, expr: str, masks: Tuple[int, ...]):
+        self.expr = expr
+        self.second, self.minute, self.hour, self.day, self.month, self.weekday = masks
+    
+    def _match_day(self, year: int, month: int, day: int) -> bool:
+        # calendar.weekday周一为0，cron周日为0
+        return bool(self.day >> day & 1 and self.weekday >> (calendar.weekday(year, month, day) + 1) % 7 & 1)
+    
+    def matches(self, timestamp: int) -> bool:
+        """判断时间戳是否匹配"""
+        t = time.gmtime(timestamp + TIMEZONE_OFFSET)
+        return bool(
+            self.month >> t.tm_mon & 1
+            and self._match_day(t.tm_year, t.tm_mon, t.tm_mday)
+            and self.hour >> t.tm_hour & 1
+            and self.minute >> t.tm_min & 1
+            and self.second >> t.tm_sec & 1
+        )
+    
+    def _next_day(self, year: int, month: int, day: int) -> Optional[int]:
+        """获取当月不早于day且日与周都匹配的一天"""
+        days = calendar.monthrange(year, month)[1]
+        candidate = _next_bit(self.day, day)
+        while candidate is not None and candidate <= days:
+            if self._match_day(year, month, candidate):
+                return candidate
+            candidate = _next_bit(self.day, candidate + 1)
+        return None
+    
+    def next_fire(self, after: int) -> Optional[int]:
+        """
+        计算after之后（不含）的第一个匹配时间
+        
+        Args:
+            after: Unix时间戳
+        
+        Returns:
+            Unix时间戳，SEARCH_YEARS年内没有匹配时返回None
+        """
+        t = time.gmtime(after + 1 + TIMEZONE_OFFSET)
+        year, month, day, hour, minute, second = t[:6]
+        last_year = year + SEARCH_YEARS
+        # 某一级找到更大的值时，更低的各级从最小值重新查找
+        while year <= last_year:
+            value = _next_bit(self.month, month)
+            if value is None:
+                year, month, day, hour, minute, second = year + 1, 1, 1, 0, 0, 0
+                continue
+            if value != month:
+                month, day, hour, minute, second = value, 1, 0, 0, 0
+            value = self._next_day(year, month, day)
+            if value is None:
+                year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+                day, hour, minute, second = 1, 0, 0, 0
+                continue
+            if value != day:
+                day, hour, minute, second = value, 0, 0, 0
+            value = _next_bit(self.hour, hour)
+            if value is None:
+                day, hour, minute, second = day + 1, 0, 0, 0
+                continue
+            if value != hour:
+                hour, minute, second = value, 0, 0
+            value = _next_bit(self.minute, minute)
+            if value is None:
+                hour, minute, second = hour + 1, 0, 0
+                continue
+            if value != minute:
+                minute, second = value, 0
+            value = _next_bit(self.second, second)
+            if value is None:
+                minute, second = minute + 1, 0
+                continue
+            return calendar.timegm((year, month, day, hour, minute, value)) - TIMEZONE_OFFSET
+        return None
+    
+    def next_fires(self, after: int, count: int) -> List[int]:
+        """
+        计算after之后（不含）的count个匹配时间
+        
+        Returns:
+            Unix时间戳列表，SEARCH_YEARS年内匹配不足count个时只返回找到的部分
+        """
+        fires: List[int] = []
+        while len(fires) < count:
+            after = self.next_fire(after)
+            if after is None:
+                break
+            fires.append(after)
+        return fires
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def compile_cron(expr: str) -> CronPattern:
+    """
+    编译cron表达式，结果按表达式缓存
+    
+    Args:
+        expr: 5字段或6字段cron表达式
+    
+    Raises:
+        CronError: 字段数不正确或某个字段没有可取的值
+    """
+    fields = expr.split()
+    if len(fields) == 5:
+        fields = ["0"] + fields
+    if len(fields) != 6:
+        raise CronError(f"cron表达式需要5或6个字段: {expr}")
+    masks = []
+    for name, field, (lo, hi) in zip(FIELD_NAMES, fields, FIELD_BOUNDS):
+        mask = parse_field(field, lo, hi)
+        if not mask:
+            raise CronError(f"cron表达式的{name}字段没有可取的值（{lo}-{hi}）: {field}")
+        masks.append(mask)
+    # 星期0和7都表示周日
+    if masks[5] & 0x81:
+        masks[5] |= 0x81
+    return CronPattern(expr, tuple(masks))
@@ -5,27 +5,61 @@
 
 import logging
 import json
+import inspect
+import time
 from functools import wraps
 from typing import Callable, Dict, Any, Optional
+from config import AuthorizationIndex
+import cron
+import metrics
+import tracing
+import util
 
 
 logger = logging.getLogger(__name__)
 
+# 确认消息中显示的cron任务执行时间个数
+NEXT_FIRES_SHOWN = 3
+
+# 命令执行结果，作为tg_commands_total的outcome标签
+OUTCOME_OK = "ok"
+OUTCOME_UNAUTHORIZED = "unauthorized"
+OUTCOME_INVALID = "invalid"
+OUTCOME_ERROR = "error"
+COMMAND_OUTCOMES = (OUTCOME_OK, OUTCOME_UNAUTHORIZED, OUTCOME_INVALID, OUTCOME_ERROR)
+
+
+def command_name(func: Callable) -> str:
+    """命令名：处理函数名去掉bot_前缀"""
+    name = func.__name__
+    return name[len("bot_"):] if name.startswith("bot_") else name
+
+
+def command_counters(func: Callable) -> Dict[str, Any]:
+    """
+    预先取得命令各执行结果的计数器
+    
+    Returns:
+        执行结果 -> 计数器
+    """
+    name = command_name(func)
+    return {outcome: metrics.COMMANDS.labels(name, outcome) for outcome in COMMAND_OUTCOMES}
+
 
 class PermissionDecorator:
     """权限装饰器类"""
     
-    def __init__(self, bot, db: Dict[str, Any], mqtt_publisher: Callable):
+    def __init__(self, bot, auth: AuthorizationIndex, mqtt_publisher: Callable):
         """
         初始化权限装饰器
         
         Args:
             bot: Telegram bot实例
-            db: 数据库字典
+            auth: 授权用户索引，随/usermod等修改实时更新
             mqtt_publisher: MQTT发布函数
         """
         self.bot = bot
-        self.db = db
+        self.auth = auth
         self.mqtt_publisher = mqtt_publisher
     
     def require_auth(self, func: Callable) -> Callable:
@@ -34,56 +68,127 @@ class PermissionDecorator:
         
         检查用户是否在授权列表中，并自动发布MQTT消息
         """
+        counters = command_counters(func)
+        command = command_name(func)
+        
         @wraps(func)
         def wrapper(message, *args, **kwargs):
-            # 清理消息内容，只保留ASCII可见字符和空格换行
-            message.text = ''.join(
-                filter(lambda char: 32 <= ord(char) <= 126 or char == '\n', message.text)
-            )
-            
-            logger.debug(f"权限检查: user_id={message.from_user.id}, chat_id={message.chat.id}")
-            
-            # 权限验证
-            if message.chat.id not in self.db["user"]:
-                logger.warning(
-                    f"未授权用户尝试访问: user_id={message.from_user.id}, "
-                    f"chat_id={message.chat.id}"
-                )
+            with tracing.span("auth.check"):
+                authorized = self._check(message)
+            if not authorized:
+                counters[OUTCOME_UNAUTHORIZED].inc()
                 self.bot.reply_to(message, "authentication required")
                 return
             
-            logger.info(
-                f"用户权限验证通过: user_id={message.from_user.id}, "
-                f"chat_id={message.chat.id}"
-            )
-            
             # 执行命令
             try:
-                data = func(message, *args, **kwargs)
+                with tracing.span("command.parse", command=command):
+                    data = func(message, *args, **kwargs)
                 
                 # 如果返回数据，则发布到MQTT
                 if data:
-                    logger.info(f"发送MQTT消息: data={str(data)}")
+                    logger.info("发送MQTT消息: cmd=%s, chat_id=%s", data.get("cmd"), data.get("chat_id"))
+                    logger.debug("MQTT消息内容: %s", data)
                     self.mqtt_publisher(data)
                     
                     # 发送确认消息（隐藏完整chat_id）
-                    data_copy = data.copy()
-                    data_copy['chat_id'] %= 100000
-                    self.bot.send_message(
-                        message.chat.id,
-                        f"{json.dumps(data_copy, ensure_ascii=False)} is transmitted"
-                    )
+                    self.bot.send_message(message.chat.id, self.transmitted_text(data))
+                counters[OUTCOME_OK].inc()
             except ValueError as e:
                 # 处理命令解析错误
-                logger.warning(f"命令解析错误: {e}")
+                counters[OUTCOME_INVALID].inc()
+                logger.warning("命令解析错误: %s", e)
                 self.bot.reply_to(message, str(e))
             except Exception as e:
                 # 处理其他错误
-                logger.error(f"命令执行失败: {e}", exc_info=True)
+                counters[OUTCOME_ERROR].inc()
+                logger.error("命令执行失败: %s", e, exc_info=True)
                 self.bot.reply_to(message, f"命令执行失败: {str(e)}")
         
         return wrapper
     
+    def _check(self, message) -> bool:
+        """
+        清理消息内容并检查用户权限
+        
+        Args:
+            message: Telegram消息对象
+            
+        Returns:
+            是否已授权
+        """
+        # 清理消息内容，只保留ASCII可见字符和空格换行
+        message.text = ''.join(
+            filter(lambda char: 32 <= ord(char) <= 126 or char == '\n', message.text)
+        )
+        
+        logger.debug("权限检查: user_id=%s, chat_id=%s", message.from_user.id, message.chat.id)
+        
+        # 权限验证
+        if message.chat.id not in self.auth:
+            logger.warning(
+                "未授权用户尝试访问: user_id=%s, chat_id=%s",
+                message.from_user.id, message.chat.id
+            )
+            return False
+        
+        logger.info(
+            "用户权限验证通过: user_id=%s, chat_id=%s",
+            message.from_user.id, message.chat.id
+        )
+        return True
+    
+    def require_callback_auth(self, func: Callable) -> Callable:
+        """
+        回调查询的权限验证装饰器
+        
+        内联按钮可能被转发到未授权的聊天中，点击前同样需要检查权限
+        """
+        @wraps(func)
+        def wrapper(call, *args, **kwargs):
+            if not self._check_callback(call):
+                self.bot.answer_callback_query(call.id, "authentication required")
+                return
+            return func(call, *args, **kwargs)
+        
+        return wrapper
+    
+    def _check_callback(self, call) -> bool:
+        """
+        检查回调查询所在聊天是否已授权
+        
+        Args:
+            call: 回调查询对象
+            
+        Returns:
+            是否已授权
+        """
+        if call.message.chat.id not in self.auth:
+            logger.warning(
+                "未授权用户尝试回调: user_id=%s, chat_id=%s, data=%s",
+                call.from_user.id, call.message.chat.id, call.data
+            )
+            return False
+        return True
+    
+    @staticmethod
+    def transmitted_text(data: Dict[str, Any]) -> str:
+        """
+        构建命令已发送的确认文本（隐藏完整chat_id）
+        
+        Args:
+            data: 已发布的命令数据
+        """
+        data_copy = data.copy()
+        data_copy['chat_id'] %= 100000
+        text = f"{json.dumps(data_copy, ensure_ascii=False)} is transmitted"
+        
+        # cron任务附上接下来的执行时间
+        if data.get("cron"):
+            fires = cron.compile_cron(data["cron"]).next_fires(int(time.time()), NEXT_FIRES_SHOWN)
+            text += "\nnext run: " + ", ".join(util.unix_timestamp_to_datetime(t) for t in fires)
+        return text
+    
     def no_auth_required(self, func: Callable) -> Callable:
         """
         不需要权限验证的装饰器
@@ -95,22 +200,120 @@ class PermissionDecorator:
             try:
                 return func(message, *args, **kwargs)
             except Exception as e:
-                logger.error(f"命令执行失败: {e}", exc_info=True)
+                logger.error("命令执行失败: %s", e, exc_info=True)
                 self.bot.reply_to(message, f"命令执行失败")
         
         return wrapper
 
 
-def create_permission_decorator(bot, db: Dict[str, Any], mqtt_publisher: Callable) -> PermissionDecorator:
+class AsyncPermissionDecorator(PermissionDecorator):
+    """异步权限装饰器类，配合AsyncTeleBot使用
+    
+    被装饰的函数可以是普通函数（如命令解析）也可以是协程，
+    mqtt_publisher需为协程函数。
+    """
+    
+    def require_auth(self, func: Callable) -> Callable:
+        """
+        需要权限验证的装饰器
+        
+        检查用户是否在授权列表中，并自动发布MQTT消息
+        """
+        counters = command_counters(func)
+        command = command_name(func)
+        
+        @wraps(func)
+        async def wrapper(message, *args, **kwargs):
+            with tracing.span("auth.check"):
+                authorized = self._check(message)
+            if not authorized:
+                counters[OUTCOME_UNAUTHORIZED].inc()
+                await self.bot.reply_to(message, "authentication required")
+                return
+            
+            try:
+                with tracing.span("command.parse", command=command):
+                    data = func(message, *args, **kwargs)
+                    if inspect.isawaitable(data):
+                        data = await data
+                
+                if data:
+                    logger.info("发送MQTT消息: cmd=%s, chat_id=%s", data.get("cmd"), data.get("chat_id"))
+                    logger.debug("MQTT消息内容: %s", data)
+                    await self.mqtt_publisher(data)
+                    await self.bot.send_message(message.chat.id, self.transmitted_text(data))
+                counters[OUTCOME_OK].inc()
+            except ValueError as e:
+                counters[OUTCOME_INVALID].inc()
+                logger.warning("命令解析错误: %s", e)
+                await self.bot.reply_to(message, str(e))
+            except Exception as e:
+                counters[OUTCOME_ERROR].inc()
+                logger.error("命令执行失败: %s", e, exc_info=True)
+                await self.bot.reply_to(message, f"命令执行失败: {str(e)}")
+        
+        return wrapper
+    
+    def require_callback_auth(self, func: Callable) -> Callable:
+        """
+        回调查询的权限验证装饰器
+        
+        内联按钮可能被转发到未授权的聊天中，点击前同样需要检查权限
+        """
+        @wraps(func)
+        async def wrapper(call, *args, **kwargs):
+            if not self._check_callback(call):
+                await self.bot.answer_callback_query(call.id, "authentication required")
+                return
+            return await func(call, *args, **kwargs)
+        
+        return wrapper
+    
+    def no_auth_required(self, func: Callable) -> Callable:
+        """
+        不需要权限验证的装饰器
+        
+        用于公开命令如/start, /help, /auth等
+        """
+        @wraps(func)
+        async def wrapper(message, *args, **kwargs):
+            try:
+                result = func(message, *args, **kwargs)
+                if inspect.isawaitable(result):
+                    result = await result
+                return result
+            except Exception as e:
+                logger.error("命令执行失败: %s", e, exc_info=True)
+                await self.bot.reply_to(message, "命令执行失败")
+        
+        return wrapper
+
+
+def create_permission_decorator(bot, auth: AuthorizationIndex, mqtt_publisher: Callable) -> PermissionDecorator:
     """
     创建权限装饰器实例的工厂函数
     
     Args:
         bot: Telegram bot实例
-        db: 数据库字典
+        auth: 授权用户索引
         mqtt_publisher: MQTT发布函数
         
     Returns:
         PermissionDecorator实例
     """
-    return PermissionDecorator(bot, db, mqtt_publisher)
+    return PermissionDecorator(bot, auth, mqtt_publisher)
+
+
+def create_async_permission_decorator(bot, auth: AuthorizationIndex, mqtt_publisher: Callable) -> AsyncPermissionDecorator:
+    """
+    创建异步权限装饰器实例的工厂函数
+    
+    Args:
+        bot: AsyncTeleBot实例
+        auth: 授权用户索引
+        mqtt_publisher: 异步MQTT发布函数
+        
+    Returns:
+        AsyncPermissionDecorator实例
+    """
+    return AsyncPermissionDecorator(bot, auth, mqtt_publisher)
@@ -0,0 +1,111 @@
+"""任务表增量同步模块
+
+设备为任务表维护递增的版本号（ver）与每次启动随机生成的纪元（epoch）。
+bot在本地为每个设备保存一份任务表副本，查询任务列表时带上副本的版本与纪元，
+设备只回复该版本之后新增、变化或删除的任务。协议说明见 esp/DELTA_PROTOCOL.md。
+
+增量回复合并到副本后转换为完整的tasks回复，后续的渲染、分页与设备影子
+都不需要区分两种回复。设备在回复中声明 "delta" 能力后才发送增量请求，
+旧固件始终回复完整任务表。
+"""
+
+import logging
+import threading
+from dataclasses import dataclass, field
+from typing import Any, Dict, Optional
+
+
+logger = logging.getLogger(__name__)
+
+CAP_DELTA = "delta"
+
+# 增量查询字段
+SINCE_KEY = "since"
+EPOCH_KEY = "epoch"
+
+# 设备回复中的字段
+VER_KEY = "ver"
+BASE_KEY = "base"
+DELTA_KEY = "tasks_delta"
+REMOVED_KEY = "removed"
+
+
+@dataclass
+class Replica:
+    """一个设备的任务表副本"""
+    epoch: int
+    ver: int
+    # 任务ID -> 任务
+    tasks: Dict[int, Dict[str, Any]] = field(default_factory=dict)
+
+
+class TaskReplica:
+    """各设备的任务表副本"""
+    
+    def __init__(self):
+        # 设备名称 -> 任务表副本
+        self._replicas: Dict[str, Replica] = {}
+        self._lock = threading.Lock()
+        self.full = 0
+        self.deltas = 0
+    
+    def request_fields(self, device_name: str) -> Dict[str, int]:
+        """
+        获取任务列表查询需要附加的字段
+        
+        Returns:
+            {"since": 版本, "epoch": 纪元}，没有副本时返回空字典（请求完整任务表）
+        """
+        with self._lock:
+            replica = self._replicas.get(device_name)
+            if replica is None:
+                return {}
+            return {SINCE_KEY: replica.ver, EPOCH_KEY: replica.epoch}
+    
+    def apply(self, device_name: Optional[str], message: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        用设备回复更新副本
+        
+        Args:
+            device_name: 设备名称
+            message: 设备回复
+        
+        Returns:
+            供后续处理的回复：增量回复转换为完整的tasks回复，其他回复原样返回
+        """
+        if device_name is None or VER_KEY not in message:
+            return message
+        if "tasks" in message:
+            tasks = {task["taskid"]: task for task in message["tasks"] if "taskid" in task}
+            with self._lock:
+                self._replicas[device_name] = Replica(message.get(EPOCH_KEY, 0), message[VER_KEY], tasks)
+            self.full += 1
+            return message
+        if DELTA_KEY not in message:
+            return message
+        
+        with self._lock:
+            replica = self._replicas.get(device_name)
+            if replica is None or replica.epoch != message.get(EPOCH_KEY) or message.get(BASE_KEY, 0) > replica.ver:
+                # 副本已丢失或与设备不一致，增量无法合并，下次查询请求完整任务表
+                self._replicas.pop(device_name, None)
+                logger.warning("任务表增量无法合并，丢弃副本: device=%s", device_name)
+                reply = {k: v for k, v in message.items() if k not in (DELTA_KEY, REMOVED_KEY)}
+                reply["message"] = f'{message.get("message", "")} (task list out of sync, please query again)'
+                return reply
+            # 先发出的查询的回复晚到时不回退副本，直接用副本渲染
+            if message[VER_KEY] >= replica.ver:
+                for taskid in message.get(REMOVED_KEY, []):
+                    replica.tasks.pop(taskid, None)
+                for task in message[DELTA_KEY]:
+                    replica.tasks[task["taskid"]] = task
+                replica.ver = message[VER_KEY]
+            tasks = [replica.tasks[taskid] for taskid in sorted(replica.tasks)]
+            ver = replica.ver
+        self.deltas += 1
+        logger.debug("合并任务表增量: device=%s, base=%s, ver=%s, changed=%d, removed=%d",
+                     device_name, message.get(BASE_KEY), ver, len(message[DELTA_KEY]), len(message.get(REMOVED_KEY, [])))
+        reply = {k: v for k, v in message.items() if k not in (DELTA_KEY, REMOVED_KEY, BASE_KEY)}
+        reply["tasks"] = tasks
+        reply[VER_KEY] = ver
+        return reply
@@ -0,0 +1,271 @@
+"""更新分发模块
+
+向bot只注册一个消息处理器和一个回调查询处理器，再按索引分发：
+
+- 命令按名称在字典中查找
+- 回调数据先按完整值在字典中查找，再在前缀树中查找最长匹配的前缀
+
+新增命令或回调类型不会增加每条更新的匹配开销。每条路由记录处理耗时，
+同时计入tg_handler_seconds直方图。
+"""
+
+import inspect
+import logging
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Deque, Dict, Optional, Tuple
+from telebot import util as telebot_util
+import metrics
+import tracing
+
+
+logger = logging.getLogger(__name__)
+
+# 路由耗时统计的日志间隔（秒）
+STATS_LOG_INTERVAL = 60
+
+
+class RouteStats:
+    """单条路由的耗时统计"""
+    
+    def __init__(self, window: int = 1024):
+        """
+        初始化统计信息
+        
+        Args:
+            window: 计算耗时分位数时保留的最近样本数
+        """
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.durations: Deque[float] = deque(maxlen=window)
+    
+    def record(self, duration: float, failed: bool) -> None:
+        self.count += 1
+        self.total += duration
+        self.durations.append(duration)
+        if failed:
+            self.errors += 1
+    
+    def snapshot(self) -> Dict[str, Any]:
+        """获取统计快照"""
+        durations = sorted(self.durations)
+        
+        def percentile(p: float) -> float:
+            if not durations:
+                return 0.0
+            return durations[min(len(durations) - 1, int(len(durations) * p))]
+        
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "avg": self.total / self.count if self.count else 0.0,
+            "p50": percentile(0.50),
+            "p99": percentile(0.99),
+            "max": durations[-1] if durations else 0.0,
+        }
+
+
+class _PrefixTrie:
+    """按字符构建的前缀树，查找给定字符串最长匹配的已注册前缀"""
+    
+    _VALUE = object()
+    
+    def __init__(self):
+        self.root: Dict[Any, Any] = {}
+    
+    def insert(self, prefix: str, value: Any) -> None:
+        node = self.root
+        for char in prefix:
+            node = node.setdefault(char, {})
+        node[self._VALUE] = value
+    
+    def longest_match(self, text: str) -> Optional[Tuple[str, Any]]:
+        """
+        查找最长匹配前缀
+        
+        Returns:
+            (前缀, 值)，没有匹配时返回None
+        """
+        node = self.root
+        match = None
+        for i, char in enumerate(text):
+            node = node.get(char)
+            if node is None:
+                break
+            if self._VALUE in node:
+                match = (text[:i + 1], node[self._VALUE])
+        return match
+
+
+class Dispatcher:
+    """命令与回调查询分发器"""
+    
+    def __init__(self):
+        self.commands: Dict[str, Callable] = {}
+        self.callbacks: Dict[str, Callable] = {}
+        self.callback_prefixes = _PrefixTrie()
+        self.stats: Dict[str, RouteStats] = {}
+        self._stats_lock = threading.Lock()
+        self._last_stats_log = time.monotonic()
+    
+    def command(self, *names: str) -> Callable:
+        """
+        注册命令处理器的装饰器
+        
+        Args:
+            *names: 命令名称（不含/）
+        """
+        def decorator(func: Callable) -> Callable:
+            for name in names:
+                self.commands[name] = func
+            return func
+        
+        return decorator
+    
+    def callback(self, *data: str, prefix: Optional[str] = None) -> Callable:
+        """
+        注册回调查询处理器的装饰器
+        
+        Args:
+            *data: 完整匹配的回调数据
+            prefix: 前缀匹配的回调数据，完整匹配优先
+        """
+        def decorator(func: Callable) -> Callable:
+            for value in data:
+                self.callbacks[value] = func
+            if prefix is not None:
+                self.callback_prefixes.insert(prefix, func)
+            return func
+        
+        return decorator
+    
+    def resolve_message(self, message) -> Optional[Tuple[str, Callable]]:
+        """
+        查找消息对应的路由
+        
+        Returns:
+            (路由名, 处理函数)，不是已注册的命令时返回None
+        """
+        command = telebot_util.extract_command(message.text)
+        if command is None:
+            return None
+        handler = self.commands.get(command)
+        if handler is None:
+            return None
+        return f"/{command}", handler
+    
+    def resolve_callback(self, call) -> Optional[Tuple[str, Callable]]:
+        """
+        查找回调查询对应的路由
+        
+        Returns:
+            (路由名, 处理函数)，没有匹配时返回None
+        """
+        data = call.data or ""
+        handler = self.callbacks.get(data)
+        if handler is not None:
+            return f"cb:{data}", handler
+        match = self.callback_prefixes.longest_match(data)
+        if match is None:
+            return None
+        prefix, handler = match
+        return f"cb:{prefix}*", handler
+    
+    def dispatch_message(self, message) -> None:
+        """分发消息（注册到bot的唯一消息处理器）"""
+        route = self.resolve_message(message)
+        if route is not None:
+            self._run(route, message)
+    
+    def dispatch_callback(self, call) -> None:
+        """分发回调查询（注册到bot的唯一回调查询处理器）"""
+        route = self.resolve_callback(call)
+        if route is None:
+            logger.warning("未知的回调数据: %s", call.data)
+            return
+        self._run(route, call)
+    
+    @staticmethod
+    def _trace_update(name: str, update):
+        """开始一条更新的trace，消息更新记录其在Telegram端等待的秒数"""
+        attributes = {"route": name}
+        message = getattr(update, "message", None) or update
+        if getattr(message, "chat", None) is not None:
+            attributes["chat_id"] = message.chat.id
+        if getattr(update, "date", None):
+            attributes["update_age"] = round(time.time() - update.date, 3)
+        return tracing.span("telegram.update", root=True, **attributes)
+    
+    def _run(self, route: Tuple[str, Callable], update) -> Any:
+        name, handler = route
+        started = time.perf_counter()
+        failed = True
+        try:
+            with self._trace_update(name, update):
+                result = handler(update)
+            failed = False
+            return result
+        finally:
+            self._record(name, time.perf_counter() - started, failed)
+    
+    def _record(self, name: str, duration: float, failed: bool) -> None:
+        metrics.HANDLER_LATENCY.labels(name).observe(duration)
+        with self._stats_lock:
+            stats = self.stats.get(name)
+            if stats is None:
+                stats = self.stats[name] = RouteStats()
+            stats.record(duration, failed)
+            now = time.monotonic()
+            if now - self._last_stats_log < STATS_LOG_INTERVAL:
+                return
+            self._last_stats_log = now
+        logger.info("路由耗时统计: %s", self.get_stats())
+    
+    def get_stats(self) -> Dict[str, Dict[str, Any]]:
+        """获取每条路由的调用次数、错误数与耗时分位数（秒）"""
+        with self._stats_lock:
+            return {name: stats.snapshot() for name, stats in self.stats.items()}
+    
+    def install(self, bot) -> None:
+        """
+        向bot注册唯一的消息处理器和回调查询处理器
+        
+        需在其他按条件过滤的处理器（如等待输入的处理器）之后调用。
+        """
+        bot.register_message_handler(self.dispatch_message, content_types=['text'])
+        bot.register_callback_query_handler(self.dispatch_callback, func=None)
+        logger.info("分发器已注册: 命令数=%s, 回调数=%s", len(self.commands), len(self.callbacks))
+
+
+class AsyncDispatcher(Dispatcher):
+    """异步分发器，配合AsyncTeleBot使用，处理函数可以是协程"""
+    
+    async def dispatch_message(self, message) -> None:
+        """分发消息（注册到bot的唯一消息处理器）"""
+        route = self.resolve_message(message)
+        if route is not None:
+            await self._run(route, message)
+    
+    async def dispatch_callback(self, call) -> None:
+        """分发回调查询（注册到bot的唯一回调查询处理器）"""
+        route = self.resolve_callback(call)
+        if route is None:
+            logger.warning("未知的回调数据: %s", call.data)
+            return
+        await self._run(route, call)
+    
+    async def _run(self, route: Tuple[str, Callable], update) -> Any:
+        name, handler = route
+        started = time.perf_counter()
+        failed = True
+        try:
+            with self._trace_update(name, update):
+                result = handler(update)
+                if inspect.isawaitable(result):
+                    result = await result
+            failed = False
+            return result
+        finally:
+            self._record(name, time.perf_counter() - started, failed)
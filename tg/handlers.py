@@ -4,13 +4,26 @@
 """
 
 import logging
-from typing import Dict, Any, List
-from telebot import types
+from typing import Dict, Any, List, Optional, Set, Tuple
+import time
 import util
+import cron
+import pagination
+from pagination import Entry, PageCache
+import batch
+import metrics
+import tracing
+from shadow import DeviceShadow
+from correlation import RequestTracker, RID_KEY
+from live_messages import MessageRegistry
+from delta import TaskReplica
 
 
 logger = logging.getLogger(__name__)
 
+# 刷新时编辑原消息而不是发送新消息的消息类型
+LIVE_KINDS = ("tasks",)
+
 
 class MessageHandler:
     """MQTT消息处理器基类"""
@@ -25,6 +38,18 @@ class MessageHandler:
         self.bot = bot
         self.logger = logging.getLogger(self.__class__.__name__)
     
+    def render(self, message: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """
+        将消息渲染为send_message的参数
+        
+        Args:
+            message: 消息字典
+        
+        Returns:
+            send_message的关键字参数，消息无效时返回None
+        """
+        raise NotImplementedError
+    
     def handle(self, message: Dict[str, Any]) -> None:
         """
         处理消息
@@ -32,15 +57,49 @@ class MessageHandler:
         Args:
             message: 消息字典
         """
-        raise NotImplementedError
+        reply = self.render(message)
+        if reply:
+            self.bot.send_message(**reply)
+
+
+def format_task(task: Dict[str, Any]) -> str:
+    """
+    格式化单个任务的信息
+    
+    Args:
+        task: 设备回复中的任务字典
+    """
+    lines = [
+        f'任务号: {task.get("taskid")}',
+        f'任务名: {task.get("taskname")}',
+        f'指令: {task.get("cmd")}',
+        f'指令编号: {task.get("xid")}',
+    ]
+    if task.get("cron"):
+        lines.append(f'cron: {task.get("cron")}')
+        lines.append(f'下次执行: {next_fire_text(task.get("cron"))}')
+    else:
+        lines.append(f'执行时间: {util.unix_timestamp_to_datetime(task.get("start", 0))}')
+        lines.append(f'周期: {util.seconds_to_hms(task.get("freq", 0))}')
+    lines.append(f'剩余次数: {task.get("remain")}')
+    return "\n".join(lines)
+
+
+def next_fire_text(expr: str) -> str:
+    """计算cron任务的下次执行时间"""
+    try:
+        fire = cron.compile_cron(expr).next_fire(int(time.time()))
+    except cron.CronError:
+        return "-"
+    return util.unix_timestamp_to_datetime(fire) if fire is not None else "-"
 
 
 class TaskMessageHandler(MessageHandler):
     """单个任务消息处理器"""
     
-    def handle(self, message: Dict[str, Any]) -> None:
+    def render(self, message: Dict[str, Any]) -> Optional[Dict[str, Any]]:
         """
-        处理单个任务的消息
+        渲染单个任务的消息
         
         Args:
             message: 包含task和message字段的消息字典
@@ -50,222 +109,303 @@ class TaskMessageHandler(MessageHandler):
         chat_id = message.get("chat_id")
         
         if not task or not chat_id:
-            self.logger.warning(f"任务消息缺少必要字段: {message}")
-            return
-        
-        # 构建任务信息文本
-        text = f"{msg_text}\n"
-        
-        if task.get("cron"):
-            text += (
-                f'\n任务号: {task.get("taskid")}\n'
-                f'任务名: {task.get("taskname")}\n'
-                f'指令: {task.get("cmd")}\n'
-                f'指令编号: {task.get("xid")}\n'
-                f'cron: {task.get("cron")}\n'
-                f'剩余次数: {task.get("remain")}\n'
-            )
-        else:
-            start_time = util.unix_timestamp_to_datetime(task.get("start", 0))
-            freq = util.seconds_to_hms(task.get("freq", 0))
-            text += (
-                f'\n任务号: {task.get("taskid")}\n'
-                f'任务名: {task.get("taskname")}\n'
-                f'指令: {task.get("cmd")}\n'
-                f'指令编号: {task.get("xid")}\n'
-                f'执行时间: {start_time}\n'
-                f'周期: {freq}\n'
-                f'剩余次数: {task.get("remain")}\n'
-            )
+            self.logger.warning("任务消息缺少必要字段: %s", message)
+            return None
         
-        self.bot.send_message(chat_id, text)
+        return {"chat_id": chat_id, "text": f"{msg_text}\n\n{format_task(task)}"}
 
 
-class TasksMessageHandler(MessageHandler):
-    """任务列表消息处理器"""
+class PagedListHandler(MessageHandler):
+    """分页列表消息处理器基类
     
-    def handle(self, message: Dict[str, Any]) -> None:
+    子类将回复拆成条目，超过一页时附加翻页按钮，各页保存在翻页缓存中。
+    """
+    
+    # 回复中的列表字段
+    field = ""
+    # 条目之间的分隔符与每页最多的条目数
+    separator = "\n"
+    max_items = pagination.MAX_PAGE_ITEMS
+    
+    def __init__(self, bot, pages: PageCache):
         """
-        处理任务列表消息
+        初始化分页列表处理器
         
         Args:
-            message: 包含tasks和message字段的消息字典
+            bot: Telegram bot实例
+            pages: 翻页缓存
         """
-        tasks = message.get("tasks", [])
-        msg_text = message.get("message", "")
+        super().__init__(bot)
+        self.pages = pages
+    
+    def entries(self, items: List[Any]) -> List[Entry]:
+        """将列表数据转换为条目"""
+        raise NotImplementedError
+    
+    def footer(self, items: List[Any]) -> str:
+        """有条目的页末尾的文本"""
+        return ""
+    
+    def render(self, message: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """
+        渲染列表的第一页
+        
+        Args:
+            message: 包含列表字段和message字段的消息字典
+        """
+        items = message.get(self.field, [])
         chat_id = message.get("chat_id")
         
         if chat_id is None:
-            self.logger.warning(f"任务列表消息缺少chat_id: {message}")
-            return
-        
-        text = f"{msg_text}\n"
-        task_names = set()
-        task_ids = set()
+            self.logger.warning("列表消息缺少chat_id: %s", message)
+            return None
         
-        # 构建任务列表文本
-        for task in tasks:
-            if task.get("cron"):
-                text += (
-                    f'\n任务号: {task.get("taskid")}\n'
-                    f'任务名: {task.get("taskname")}\n'
-                    f'指令: {task.get("cmd")}\n'
-                    f'指令编号: {task.get("xid")}\n'
-                    f'cron: {task.get("cron")}\n'
-                    f'剩余次数: {task.get("remain")}\n'
-                )
-            else:
-                start_time = util.unix_timestamp_to_datetime(task.get("start", 0))
-                freq = util.seconds_to_hms(task.get("freq", 0))
-                text += (
-                    f'\n任务号: {task.get("taskid")}\n'
-                    f'任务名: {task.get("taskname")}\n'
-                    f'指令: {task.get("cmd")}\n'
-                    f'指令编号: {task.get("xid")}\n'
-                    f'执行时间: {start_time}\n'
-                    f'周期: {freq}\n'
-                    f'剩余次数: {task.get("remain")}\n'
-                )
-            
-            # 收集任务名和任务ID用于创建按钮
+        pages = pagination.build_pages(
+            message.get("message", ""), self.entries(items), self.footer(items),
+            self.separator, self.max_items
+        )
+        return {"chat_id": chat_id, **self.pages.render(pages)}
+
+
+class TasksMessageHandler(PagedListHandler):
+    """任务列表消息处理器，每个任务附带按任务名与任务号终止的按钮"""
+    
+    field = "tasks"
+    separator = "\n\n"
+    # 每个任务最多两个按钮
+    max_items = 20
+    
+    def entries(self, items: List[Any]) -> List[Entry]:
+        entries = []
+        for task in items:
+            buttons = []
             if task.get("taskname"):
-                task_names.add(task.get("taskname"))
+                buttons.append((f'{task.get("taskname")} (name)', f'taskname_{task.get("taskname")}'))
             if task.get("taskid") is not None:
-                task_ids.add(task.get("taskid"))
-        
-        # 创建内联键盘
-        markup = types.InlineKeyboardMarkup()
-        
-        for name in task_names:
-            btn = types.InlineKeyboardButton(
-                f"{name} (name)",
-                callback_data=f"taskname_{name}"
-            )
-            markup.add(btn)
-        
-        for task_id in task_ids:
-            btn = types.InlineKeyboardButton(
-                f"{task_id} (id)",
-                callback_data=f"taskid_{task_id}"
-            )
-            markup.add(btn)
-        
-        if tasks:
-            text += "\nterminate by following buttons"
-        
-        self.bot.send_message(chat_id, text, reply_markup=markup)
+                buttons.append((f'{task.get("taskid")} (id)', f'taskid_{task.get("taskid")}'))
+            entries.append(Entry(format_task(task), buttons))
+        return entries
+    
+    def footer(self, items: List[Any]) -> str:
+        return "terminate by following buttons"
 
 
-class CommandListHandler(MessageHandler):
+class CommandListHandler(PagedListHandler):
     """命令列表消息处理器"""
     
-    def handle(self, message: Dict[str, Any]) -> None:
-        """
-        处理命令列表消息
-        
-        Args:
-            message: 包含cmds和message字段的消息字典
-        """
-        cmds = message.get("cmds", [])
-        msg_text = message.get("message", "")
-        chat_id = message.get("chat_id")
-        
-        if chat_id is None:
-            self.logger.warning(f"命令列表消息缺少chat_id: {message}")
-            return
-        
-        text = f"{msg_text}\n"
-        for cmd in cmds:
-            text += f"  {cmd}\n"
-        
-        self.bot.send_message(chat_id, text)
+    field = "cmds"
+    max_items = 200
+    
+    def entries(self, items: List[Any]) -> List[Entry]:
+        return [Entry(f"  {cmd}") for cmd in items]
 
 
-class TaskIdListHandler(MessageHandler):
+class TaskIdListHandler(PagedListHandler):
     """任务ID列表消息处理器"""
     
-    def handle(self, message: Dict[str, Any]) -> None:
+    field = "taskids"
+    max_items = 200
+    
+    def entries(self, items: List[Any]) -> List[Entry]:
+        return [Entry(f"  {taskid}") for taskid in items]
+
+
+class SimpleMessageHandler(MessageHandler):
+    """简单消息处理器（仅包含message字段）"""
+    
+    def render(self, message: Dict[str, Any]) -> Optional[Dict[str, Any]]:
         """
-        处理任务ID列表消息
+        渲染简单消息
         
         Args:
-            message: 包含taskids和message字段的消息字典
+            message: 包含message和chat_id字段的消息字典
         """
-        taskids = message.get("taskids", [])
         msg_text = message.get("message", "")
         chat_id = message.get("chat_id")
         
         if chat_id is None:
-            self.logger.warning(f"任务ID列表消息缺少chat_id: {message}")
-            return
-        
-        text = f"{msg_text}\n"
-        for taskid in taskids:
-            text += f"  {str(taskid)}\n"
+            self.logger.warning("简单消息缺少chat_id: %s", message)
+            return None
         
-        self.bot.send_message(chat_id, text)
+        return {"chat_id": chat_id, "text": msg_text}
 
 
-class SimpleMessageHandler(MessageHandler):
-    """简单消息处理器（仅包含message字段）"""
+class BatchMessageHandler(MessageHandler):
+    """批量命令回复处理器"""
     
-    def handle(self, message: Dict[str, Any]) -> None:
+    def render(self, message: Dict[str, Any]) -> Optional[Dict[str, Any]]:
         """
-        处理简单消息
+        渲染批量命令的回复，每条命令一行
         
         Args:
-            message: 包含message和chat_id字段的消息字典
+            message: 包含results、message和chat_id字段的消息字典
         """
-        msg_text = message.get("message", "")
         chat_id = message.get("chat_id")
-        
         if chat_id is None:
-            self.logger.warning(f"简单消息缺少chat_id: {message}")
-            return
+            self.logger.warning("批量回复缺少chat_id: %s", message)
+            return None
         
-        self.bot.send_message(chat_id, msg_text)
+        lines = [message.get("message", "")]
+        for result in batch.decode_batch_reply(message):
+            lines.append(f"#{result.index} {'ok' if result.ok else 'failed'}: {result.message}")
+        if message.get("truncated"):
+            lines.append("...")
+        
+        return {"chat_id": chat_id, "text": "\n".join(lines)}
 
 
 class MessageRouter:
     """消息路由器，根据消息类型分发到对应的处理器"""
     
-    def __init__(self, bot):
+    def __init__(self, bot, shadow: Optional[DeviceShadow] = None,
+                 tracker: Optional[RequestTracker] = None):
         """
         初始化消息路由器
         
         Args:
             bot: Telegram bot实例
+            shadow: 设备状态影子，记录设备的列表类回复，可选
+            tracker: 请求跟踪器，按回复中的rid完成待回复的命令，可选
         """
         self.bot = bot
+        # 分页列表的各页，供翻页回调使用
+        self.pages = PageCache()
+        # 等待刷新的列表消息，刷新结果编辑原消息
+        self.live = MessageRegistry()
+        # 各设备的任务表副本，增量回复合并后再渲染
+        self.replica = TaskReplica()
+        self.shadow = shadow
+        self.tracker = tracker
         self.logger = logging.getLogger(__name__)
         
+        # 设备名称 -> 设备在回复中声明的能力（如batch）
+        self.capabilities: Dict[str, Set[str]] = {}
+        
         # 初始化各类处理器
         self.handlers = {
             "task": TaskMessageHandler(bot),
-            "tasks": TasksMessageHandler(bot),
-            "cmds": CommandListHandler(bot),
-            "taskids": TaskIdListHandler(bot),
+            "tasks": TasksMessageHandler(bot, self.pages),
+            "cmds": CommandListHandler(bot, self.pages),
+            "taskids": TaskIdListHandler(bot, self.pages),
+            "results": BatchMessageHandler(bot),
             "simple": SimpleMessageHandler(bot)
         }
     
-    def route(self, message: Dict[str, Any]) -> None:
+    def route(self, message: Dict[str, Any], device_name: Optional[str] = None) -> None:
         """
         路由消息到对应的处理器
         
         Args:
             message: MQTT消息字典
+            device_name: 发送消息的设备名称，用于记录设备能力
+        """
+        with self.trace_reply(message, device_name):
+            self._route(message, device_name)
+    
+    @staticmethod
+    def trace_reply(message: Dict[str, Any], device_name: Optional[str]):
+        """
+        记录device.reply span
+        
+        设备回复按rid挂在发布命令的span下，设备主动上报的消息开始新的trace；
+        设备影子等bot端构造的回复（device_name为None）挂在当前span下。
         """
+        parent = tracing.TRACER.linked(device_name, message.get(RID_KEY))
+        return tracing.span("device.reply", parent=parent, root=device_name is not None,
+                            device=device_name or "", code=message.get("code", ""))
+    
+    def _route(self, message: Dict[str, Any], device_name: Optional[str]) -> None:
+        self.update_capabilities(message, device_name)
+        message = self.replica.apply(device_name, message)
+        if self.tracker is not None:
+            self.tracker.resolve(device_name, message)
+        if self.shadow is not None:
+            self.shadow.update(device_name, message)
         try:
-            # 根据消息包含的字段判断消息类型
-            if "task" in message:
-                self.handlers["task"].handle(message)
-            elif "tasks" in message:
-                self.handlers["tasks"].handle(message)
-            elif "cmds" in message:
-                self.handlers["cmds"].handle(message)
-            elif "taskids" in message:
-                self.handlers["taskids"].handle(message)
-            else:
-                self.handlers["simple"].handle(message)
+            kind = self.message_type(message)
+            metrics.ROUTED_MESSAGES.labels(kind).inc()
+            reply = self.handlers[kind].render(message)
+            if reply:
+                self.deliver(kind, reply)
         except Exception as e:
-            self.logger.error(f"处理MQTT消息时发生错误: {e}", exc_info=True)
+            self.logger.error("处理MQTT消息时发生错误: %s", e, exc_info=True)
+    
+    def plan_delivery(self, kind: str, reply: Dict[str, Any]) -> Optional[Tuple[str, Dict[str, Any]]]:
+        """
+        决定渲染好的回复是发送新消息还是编辑等待刷新的消息
+        
+        Returns:
+            (bot方法名, 关键字参数)，无需调用时返回None
+        """
+        if kind in LIVE_KINDS:
+            return self.live.plan(kind, reply)
+        return "send_message", reply
+    
+    def deliver(self, kind: str, reply: Dict[str, Any]) -> None:
+        """
+        发送渲染好的回复
+        
+        Args:
+            kind: 消息类型
+            reply: send_message的关键字参数
+        """
+        planned = self.plan_delivery(kind, reply)
+        if planned is not None:
+            method, kwargs = planned
+            getattr(self.bot, method)(**kwargs)
+    
+    @staticmethod
+    def message_type(message: Dict[str, Any]) -> str:
+        """
+        根据消息包含的字段判断消息类型
+        
+        Args:
+            message: MQTT消息字典
+        
+        Returns:
+            处理器名称
+        """
+        for key in ("task", "tasks", "cmds", "taskids", "results"):
+            if key in message:
+                return key
+        return "simple"
+    
+    def update_capabilities(self, message: Dict[str, Any], device_name: Optional[str]) -> None:
+        """
+        记录设备回复中声明的能力
+        
+        Args:
+            message: MQTT消息字典
+            device_name: 设备名称
+        """
+        if device_name is None or "caps" not in message:
+            return
+        caps = set(batch.parse_caps(message))
+        if self.capabilities.get(device_name) != caps:
+            self.logger.info("设备能力: %s -> %s", device_name, sorted(caps))
+            self.capabilities[device_name] = caps
+    
+    def supports(self, device_name: str, capability: str) -> bool:
+        """
+        检查设备是否声明过某项能力
+        
+        Args:
+            device_name: 设备名称
+            capability: 能力名称，如batch.CAP_BATCH
+        """
+        return capability in self.capabilities.get(device_name, ())
+
+
+class AsyncMessageRouter(MessageRouter):
+    """异步消息路由器，配合AsyncOutboundDispatcher在事件循环中发送消息"""
+    
+    async def route(self, message: Dict[str, Any], device_name: Optional[str] = None) -> None:
+        """
+        路由消息到对应的处理器，回复交给出站调度器排队后返回，不等待发送完成
+        
+        Args:
+            message: MQTT消息字典
+            device_name: 发送消息的设备名称，用于记录设备能力
+        """
+        with self.trace_reply(message, device_name):
+            self._route(message, device_name)
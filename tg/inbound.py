@@ -0,0 +1,320 @@
+"""MQTT入站消息工作池模块
+
+paho的网络线程只负责把消息放入有界队列，JSON解析、消息路由以及
+Telegram请求都在工作线程中完成，避免慢请求阻塞心跳和后续消息。
+
+同一设备的消息总是分配到同一个工作线程，保证按到达顺序处理。
+异步运行时使用AsyncInboundWorkerPool，以事件循环中的消费任务代替工作线程，
+连接的接收循环只负责放入队列，分片、保序与溢出策略与线程版一致。
+"""
+
+import asyncio
+import logging
+import threading
+import time
+import zlib
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+import metrics
+
+
+logger = logging.getLogger(__name__)
+
+# 队列满时的处理策略
+OVERFLOW_DROP_OLDEST = "drop_oldest"  # 丢弃队列中最旧的消息
+OVERFLOW_DROP_NEWEST = "drop_newest"  # 丢弃新到达的消息
+OVERFLOW_BLOCK = "block"              # 阻塞网络线程直到有空位（最多BLOCK_TIMEOUT秒）
+OVERFLOW_POLICIES = (OVERFLOW_DROP_OLDEST, OVERFLOW_DROP_NEWEST, OVERFLOW_BLOCK)
+
+# block策略下网络线程最长等待时间，超时后丢弃新消息，避免心跳超时
+BLOCK_TIMEOUT = 5
+# 统计信息的日志间隔（秒）
+STATS_LOG_INTERVAL = 60
+
+
+class _Shard:
+    """单个工作线程及其有界队列"""
+    
+    def __init__(self, index: int, maxsize: int, overflow: str, pool: 'InboundWorkerPool'):
+        self.index = index
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.pool = pool
+        self.items: Deque[Tuple[float, Callable, Tuple]] = deque()
+        self.cond = threading.Condition()
+        self.running = True
+        self.thread = threading.Thread(target=self._loop, name=f"mqtt-inbound-{index}", daemon=True)
+        self.thread.start()
+    
+    def put(self, item: Tuple[float, Callable, Tuple]) -> bool:
+        """
+        放入一条消息
+        
+        Returns:
+            消息是否被接受（drop_oldest策略下总是接受新消息）
+        """
+        with self.cond:
+            if len(self.items) >= self.maxsize:
+                if self.overflow == OVERFLOW_DROP_OLDEST:
+                    self.items.popleft()
+                    self.pool._record_drop()
+                elif self.overflow == OVERFLOW_BLOCK:
+                    deadline = time.monotonic() + BLOCK_TIMEOUT
+                    while len(self.items) >= self.maxsize and self.running:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        self.cond.wait(remaining)
+                    if len(self.items) >= self.maxsize:
+                        self.pool._record_drop()
+                        return False
+                else:
+                    self.pool._record_drop()
+                    return False
+            self.items.append(item)
+            self.cond.notify_all()
+            return True
+    
+    def _loop(self) -> None:
+        while True:
+            with self.cond:
+                while not self.items and self.running:
+                    self.cond.wait()
+                if not self.items:
+                    return
+                enqueued_at, func, args = self.items.popleft()
+                self.cond.notify_all()
+            
+            self.pool._record_lag(time.monotonic() - enqueued_at)
+            try:
+                func(*args)
+            except Exception as e:
+                logger.error("处理MQTT入站消息失败: %s", e, exc_info=True)
+    
+    def stop(self, timeout: float) -> None:
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        self.thread.join(timeout)
+
+
+class _AsyncShard:
+    """单个消费任务及其有界队列（在事件循环中运行）"""
+    
+    def __init__(self, index: int, maxsize: int, overflow: str, pool: 'InboundWorkerPool'):
+        self.index = index
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.pool = pool
+        self.items: Deque[Tuple[float, Callable[..., Awaitable[Any]], Tuple]] = deque()
+        self.running = True
+        self.task: Optional[asyncio.Task] = None
+        self._ready: Optional[asyncio.Event] = None
+        self._space: Optional[asyncio.Event] = None
+    
+    def start(self) -> None:
+        self._ready = asyncio.Event()
+        self._space = asyncio.Event()
+        self.task = asyncio.create_task(self._loop(), name=f"mqtt-inbound-{self.index}")
+    
+    async def put(self, item: Tuple[float, Callable[..., Awaitable[Any]], Tuple]) -> bool:
+        """
+        放入一条消息，block策略下队列满时等待空位
+        
+        Returns:
+            消息是否被接受（drop_oldest策略下总是接受新消息）
+        """
+        if len(self.items) >= self.maxsize:
+            if self.overflow == OVERFLOW_DROP_OLDEST:
+                self.items.popleft()
+                self.pool._record_drop()
+            elif self.overflow == OVERFLOW_BLOCK:
+                deadline = time.monotonic() + BLOCK_TIMEOUT
+                while len(self.items) >= self.maxsize and self.running:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._space.clear()
+                    try:
+                        await asyncio.wait_for(self._space.wait(), remaining)
+                    except asyncio.TimeoutError:
+                        pass
+                if len(self.items) >= self.maxsize:
+                    self.pool._record_drop()
+                    return False
+            else:
+                self.pool._record_drop()
+                return False
+        self.items.append(item)
+        self._ready.set()
+        return True
+    
+    async def _loop(self) -> None:
+        while True:
+            while not self.items and self.running:
+                self._ready.clear()
+                await self._ready.wait()
+            if not self.items:
+                return
+            enqueued_at, func, args = self.items.popleft()
+            self._space.set()
+            
+            self.pool._record_lag(time.monotonic() - enqueued_at)
+            try:
+                await func(*args)
+            except Exception as e:
+                logger.error("处理MQTT入站消息失败: %s", e, exc_info=True)
+    
+    def stop(self) -> None:
+        self.running = False
+        if self._ready is not None:
+            self._ready.set()
+            self._space.set()
+
+
+class InboundWorkerPool:
+    """MQTT入站消息工作池"""
+    
+    def __init__(self, workers: int = 4, queue_size: int = 1000,
+                 overflow: str = OVERFLOW_DROP_OLDEST, lag_window: int = 1024):
+        """
+        初始化工作池
+        
+        Args:
+            workers: 工作线程数
+            queue_size: 所有工作线程队列容量之和
+            overflow: 队列满时的处理策略，见OVERFLOW_POLICIES
+            lag_window: 计算排队延迟分位数时保留的最近样本数
+        """
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"未知的入站队列溢出策略: {overflow}")
+        
+        workers = max(1, workers)
+        per_shard = max(1, queue_size // workers)
+        self.overflow = overflow
+        self.processed = 0
+        self.dropped = 0
+        self._lags: Deque[float] = deque(maxlen=lag_window)
+        self._stats_lock = threading.Lock()
+        self._last_stats_log = time.monotonic()
+        self._shards: List[Any] = [self._new_shard(i, per_shard) for i in range(workers)]
+        metrics.INBOUND_QUEUE_DEPTH.set_callback(lambda: {(): self.queue_depth()})
+        logger.info(
+            "入站工作池启动: workers=%s, queue_size=%s, overflow=%s", workers, per_shard * workers, overflow
+        )
+    
+    def _new_shard(self, index: int, maxsize: int) -> _Shard:
+        return _Shard(index, maxsize, self.overflow, self)
+    
+    def _shard_for(self, key: str) -> Any:
+        return self._shards[zlib.crc32(key.encode('utf-8')) % len(self._shards)]
+    
+    def submit(self, key: str, func: Callable, *args: Any) -> bool:
+        """
+        提交一条入站消息
+        
+        Args:
+            key: 保序键（设备名），相同键的消息按提交顺序处理
+            func: 处理函数
+            *args: 处理函数参数
+        
+        Returns:
+            消息是否被接受
+        """
+        return self._shard_for(key).put((time.monotonic(), func, args))
+    
+    def _record_drop(self) -> None:
+        with self._stats_lock:
+            self.dropped += 1
+            dropped = self.dropped
+        metrics.INBOUND_DROPPED.inc()
+        # 避免丢弃风暴时刷屏，只记录第1条和之后每100条
+        if dropped == 1 or dropped % 100 == 0:
+            logger.warning("入站队列已满，按%s策略丢弃消息，累计丢弃: %s", self.overflow, dropped)
+    
+    def _record_lag(self, lag: float) -> None:
+        metrics.INBOUND_LAG.observe(lag)
+        with self._stats_lock:
+            self.processed += 1
+            self._lags.append(lag)
+            now = time.monotonic()
+            if now - self._last_stats_log < STATS_LOG_INTERVAL:
+                return
+            self._last_stats_log = now
+        logger.info("入站消息统计: %s", self.get_stats())
+    
+    def queue_depth(self) -> int:
+        """所有工作线程队列中等待处理的消息数"""
+        return sum(len(shard.items) for shard in self._shards)
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """获取队列深度、排队延迟与丢弃统计"""
+        with self._stats_lock:
+            lags = sorted(self._lags)
+            processed, dropped = self.processed, self.dropped
+        
+        def percentile(p: float) -> float:
+            if not lags:
+                return 0.0
+            return lags[min(len(lags) - 1, int(len(lags) * p))]
+        
+        return {
+            "queue_depth": self.queue_depth(),
+            "processed": processed,
+            "dropped": dropped,
+            "lag_p50": percentile(0.50),
+            "lag_p99": percentile(0.99),
+            "lag_max": lags[-1] if lags else 0.0,
+        }
+    
+    def stop(self, timeout: float = 5) -> None:
+        """
+        停止工作池，处理完已排队的消息后退出
+        
+        Args:
+            timeout: 每个工作线程的最长等待秒数
+        """
+        for shard in self._shards:
+            shard.stop(timeout)
+
+
+class AsyncInboundWorkerPool(InboundWorkerPool):
+    """异步MQTT入站消息工作池，消费任务需通过start()在事件循环中启动"""
+    
+    def _new_shard(self, index: int, maxsize: int) -> _AsyncShard:
+        return _AsyncShard(index, maxsize, self.overflow, self)
+    
+    def start(self) -> None:
+        """在当前事件循环中启动消费任务"""
+        for shard in self._shards:
+            shard.start()
+    
+    async def submit(self, key: str, func: Callable[..., Awaitable[Any]], *args: Any) -> bool:
+        """
+        提交一条入站消息
+        
+        Args:
+            key: 保序键（设备名），相同键的消息按提交顺序处理
+            func: 处理协程函数
+            *args: 处理函数参数
+        
+        Returns:
+            消息是否被接受
+        """
+        return await self._shard_for(key).put((time.monotonic(), func, args))
+    
+    async def stop(self, timeout: float = 5) -> None:
+        """
+        停止工作池，处理完已排队的消息后退出，超时后取消仍在运行的消费任务
+        
+        Args:
+            timeout: 最长等待秒数
+        """
+        tasks = [shard.task for shard in self._shards if shard.task is not None]
+        for shard in self._shards:
+            shard.stop()
+        if not tasks:
+            return
+        _, pending = await asyncio.wait(tasks, timeout=timeout)
+        for task in pending:
+            task.cancel()
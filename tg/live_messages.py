@@ -0,0 +1,114 @@
+"""实时消息模块
+
+点击任务列表上的终止按钮后，bot会刷新任务列表。此前刷新结果作为新消息发送，
+每次点击至少产生三次Telegram API调用并刷屏。
+
+消息登记表记录每个聊天中等待刷新的列表消息（即被点击按钮的那条消息）及其
+当前内容。对应类型的下一条设备回复不再发送新消息，而是编辑这条消息：
+
+- 文本与按钮都未变化时跳过编辑
+- 只有按钮变化时使用edit_message_reply_markup
+- 否则使用edit_message_text
+
+等待刷新超过REFRESH_TTL秒仍未收到回复时，登记失效，之后的回复照常发送新消息。
+"""
+
+import logging
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, Optional, Tuple
+
+
+logger = logging.getLogger(__name__)
+
+# 等待刷新的有效期（秒）
+REFRESH_TTL = 30
+
+# 编辑动作
+EDIT_TEXT = "edit_message_text"
+EDIT_MARKUP = "edit_message_reply_markup"
+
+Signature = Tuple[str, Tuple[str, ...]]
+
+
+def signature(text: Optional[str], markup) -> Signature:
+    """
+    计算消息内容的签名：文本与按钮文本
+    
+    翻页按钮的回调数据带有每次渲染都会变化的列表编号，签名只比较按钮文本。
+    """
+    buttons = tuple(button.text for row in markup.keyboard for button in row) if markup else ()
+    return text or "", buttons
+
+
+@dataclass
+class LiveMessage:
+    """等待刷新的消息"""
+    message_id: int
+    signature: Signature
+    expires: float
+
+
+class MessageRegistry:
+    """每个聊天中等待刷新的列表消息"""
+    
+    def __init__(self, ttl: float = REFRESH_TTL):
+        """
+        初始化消息登记表
+        
+        Args:
+            ttl: 等待刷新的有效期（秒）
+        """
+        self.ttl = ttl
+        # (聊天ID, 消息类型) -> 等待刷新的消息
+        self._pending: Dict[Tuple[Any, str], LiveMessage] = {}
+        self._lock = threading.Lock()
+    
+    def expect_refresh(self, chat_id: Any, kind: str, message_id: int, text: Optional[str], markup) -> None:
+        """
+        登记一条等待刷新的消息
+        
+        Args:
+            chat_id: 聊天ID
+            kind: 消息类型，如"tasks"
+            message_id: 消息ID
+            text: 消息当前的文本
+            markup: 消息当前的内联键盘
+        """
+        live = LiveMessage(message_id, signature(text, markup), time.monotonic() + self.ttl)
+        with self._lock:
+            self._pending[(chat_id, kind)] = live
+    
+    def take(self, chat_id: Any, kind: str) -> Optional[LiveMessage]:
+        """取出等待刷新的消息，没有或已过期时返回None"""
+        with self._lock:
+            live = self._pending.pop((chat_id, kind), None)
+        if live is None or live.expires <= time.monotonic():
+            return None
+        return live
+    
+    def plan(self, kind: str, reply: Dict[str, Any]) -> Optional[Tuple[str, Dict[str, Any]]]:
+        """
+        决定如何发送渲染好的回复
+        
+        Args:
+            kind: 消息类型
+            reply: send_message的关键字参数
+        
+        Returns:
+            (bot方法名, 关键字参数)；内容未变化、无需调用时返回None
+        """
+        chat_id = reply["chat_id"]
+        live = self.take(chat_id, kind)
+        if live is None:
+            return "send_message", reply
+        
+        current = signature(reply.get("text"), reply.get("reply_markup"))
+        if current == live.signature:
+            logger.debug("列表内容未变化，跳过编辑: chat_id=%s, message_id=%s", chat_id, live.message_id)
+            return None
+        target = {"chat_id": chat_id, "message_id": live.message_id}
+        if current[0] == live.signature[0]:
+            return EDIT_MARKUP, {**target, "reply_markup": reply.get("reply_markup")}
+        return EDIT_TEXT, {**target, **{k: v for k, v in reply.items() if k != "chat_id"}}
@@ -1,49 +1,169 @@
+"""日志配置模块
+
+所有日志记录经QueueHandler放入内存队列，由QueueListener的后台线程写入文件与控制台，
+处理消息的线程不会因磁盘写入而阻塞。
+
+- 输出格式可选文本（默认）或JSON lines（每行一个JSON对象，便于日志采集）
+- 可按日志记录器限制INFO及以下级别记录的速率，超出的记录丢弃并在下一条放行的
+  记录中注明丢弃数量；WARNING及以上级别不受限制
+"""
+
+import atexit
+import json
 import logging
 import logging.handlers
 import os
+import queue
+import threading
+import time
+from typing import Dict, Optional
+
+
+LOG_FORMAT_TEXT = "text"
+LOG_FORMAT_JSON = "json"
+LOG_FORMATS = (LOG_FORMAT_TEXT, LOG_FORMAT_JSON)
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# 后台写入线程，setup_logging首次调用时启动
+_listener: Optional[logging.handlers.QueueListener] = None
+_queue_handler: Optional[logging.handlers.QueueHandler] = None
 
-def setup_logging():
-    """配置TG项目的日志记录"""
-    # 获取tg目录路径并设置日志文件
-    tg_dir = os.path.dirname(os.path.abspath(__file__))
-    log_file = os.path.join(tg_dir, 'tg_bot.log')
+
+class JsonLinesFormatter(logging.Formatter):
+    """
+    将日志记录格式化为一行JSON
+    
+    QueueHandler入队前已把异常堆栈追加到消息中，message字段包含完整堆栈。
+    """
+    
+    def format(self, record: logging.LogRecord) -> str:
+        return json.dumps({
+            "time": self.formatTime(record, DATE_FORMAT),
+            "logger": record.name,
+            "level": record.levelname,
+            "thread": record.threadName,
+            "message": record.getMessage(),
+        }, ensure_ascii=False)
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    按日志记录器限制记录速率
+    
+    rates中的键为日志记录器名称，对该记录器及其子记录器生效（取最长匹配，每个记录器分别计数），
+    值为每秒允许的记录数（令牌桶，允许突发1秒的量，至少1条）。
+    """
+    
+    def __init__(self, rates: Dict[str, float]):
+        super().__init__()
+        self.rates = {name: rate for name, rate in rates.items() if rate > 0}
+        # 日志记录器名称 -> [令牌数, 上次补充时间, 已丢弃数]
+        self._buckets: Dict[str, list] = {}
+        self._lock = threading.Lock()
+    
+    def _rate_for(self, name: str) -> Optional[float]:
+        while True:
+            rate = self.rates.get(name)
+            if rate is not None or not name:
+                return rate
+            name = name.rpartition(".")[0]
+    
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self._rate_for(record.name)
+        if rate is None:
+            return True
+        now = time.monotonic()
+        with self._lock:
+            # 桶容量至少为1，速率低于每秒1条时仍能积满一个令牌
+            capacity = max(rate, 1.0)
+            bucket = self._buckets.setdefault(record.name, [capacity, now, 0])
+            bucket[0] = min(capacity, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+            if bucket[0] < 1:
+                bucket[2] += 1
+                return False
+            bucket[0] -= 1
+            dropped, bucket[2] = bucket[2], 0
+        if dropped:
+            # 记录尚未格式化，在格式化前追加丢弃数量
+            record.msg = f"{record.msg} (限速丢弃{dropped}条)"
+        return True
+
+
+def _make_formatter(log_format: str) -> logging.Formatter:
+    if log_format == LOG_FORMAT_JSON:
+        return JsonLinesFormatter()
+    return logging.Formatter(TEXT_FORMAT, datefmt=DATE_FORMAT)
+
+
+def setup_logging(log_format: str = LOG_FORMAT_TEXT, rate_limits: Optional[Dict[str, float]] = None):
+    """
+    配置TG项目的日志记录
+    
+    首次调用时安装队列处理器并启动后台写入线程；再次调用时只更新输出格式与限速，
+    因此可以先以默认参数初始化，加载配置后再应用配置中的日志参数。
+    
+    Args:
+        log_format: 输出格式，text或json
+        rate_limits: 日志记录器名称 -> 每秒允许的INFO及以下级别记录数
+    
+    Raises:
+        ValueError: 输出格式不正确
+    """
+    global _listener, _queue_handler
+    if log_format not in LOG_FORMATS:
+        raise ValueError(f"未知的日志格式: {log_format}，可选: {', '.join(LOG_FORMATS)}")
     
     # 配置根日志记录器
     logger = logging.getLogger()
     logger.setLevel(logging.INFO)
     
-    # 避免重复添加处理器
-    if logger.handlers:
-        return
-    
-    # 创建格式化器
-    formatter = logging.Formatter(
-        '%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-        datefmt='%Y-%m-%d %H:%M:%S'
-    )
-    
-    # 文件处理器 - 使用RotatingFileHandler避免日志文件过大
-    file_handler = logging.handlers.RotatingFileHandler(
-        log_file, 
-        maxBytes=10*1024*1024,  # 10MB
-        backupCount=5,
-        encoding='utf-8'
-    )
-    file_handler.setLevel(logging.INFO)
-    file_handler.setFormatter(formatter)
-    
-    # 控制台处理器
-    console_handler = logging.StreamHandler()
-    console_handler.setLevel(logging.INFO)
-    console_handler.setFormatter(formatter)
-    
-    # 添加处理器到根日志记录器
-    logger.addHandler(file_handler)
-    logger.addHandler(console_handler)
-    
-    # 设置第三方库的日志级别
-    logging.getLogger('paho.mqtt').setLevel(logging.WARNING)
-    logging.getLogger('urllib3').setLevel(logging.WARNING)
-    logging.getLogger('requests').setLevel(logging.WARNING)
-    
-    logging.info("TG Bot日志系统初始化完成")
+    if _listener is None:
+        # 避免与外部已配置的处理器重复
+        if logger.handlers:
+            return
+        
+        # 获取tg目录路径并设置日志文件
+        tg_dir = os.path.dirname(os.path.abspath(__file__))
+        log_file = os.path.join(tg_dir, 'tg_bot.log')
+        
+        # 文件处理器 - 使用RotatingFileHandler避免日志文件过大
+        file_handler = logging.handlers.RotatingFileHandler(
+            log_file,
+            maxBytes=10*1024*1024,  # 10MB
+            backupCount=5,
+            encoding='utf-8'
+        )
+        file_handler.setLevel(logging.INFO)
+        
+        # 控制台处理器
+        console_handler = logging.StreamHandler()
+        console_handler.setLevel(logging.INFO)
+        
+        # 处理线程只把记录放入队列，由后台线程写入文件与控制台
+        _queue_handler = logging.handlers.QueueHandler(queue.SimpleQueue())
+        _listener = logging.handlers.QueueListener(
+            _queue_handler.queue, file_handler, console_handler, respect_handler_level=True
+        )
+        _listener.start()
+        atexit.register(_listener.stop)
+        logger.addHandler(_queue_handler)
+        
+        # 设置第三方库的日志级别
+        logging.getLogger('paho.mqtt').setLevel(logging.WARNING)
+        logging.getLogger('urllib3').setLevel(logging.WARNING)
+        logging.getLogger('requests').setLevel(logging.WARNING)
+    
+    formatter = _make_formatter(log_format)
+    for handler in _listener.handlers:
+        handler.setFormatter(formatter)
+    for old in list(_queue_handler.filters):
+        _queue_handler.removeFilter(old)
+    if rate_limits:
+        _queue_handler.addFilter(RateLimitFilter(rate_limits))
+    
+    logging.info("TG Bot日志系统初始化完成: format=%s, rate_limits=%s", log_format, rate_limits or {})
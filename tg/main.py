@@ -5,12 +5,19 @@
 
 import telebot
 import logging
+import parsers
+import metrics
+import tracing
 from logging_config import setup_logging
 from config import load_config
 from service import BotService
 from mqtt_client import MQTTClientManager
 from decorators import create_permission_decorator
-from callbacks import TaskCallbackHandler, AliasCallbackHandler
+from alias_plan import alias_errors_text
+from callbacks import TaskCallbackHandler, AliasCallbackHandler, PageCallbackHandler
+from dispatcher import Dispatcher
+from outbox import OutboundDispatcher
+from inbound import InboundWorkerPool
 
 
 # 初始化日志
@@ -20,15 +27,36 @@ logger = logging.getLogger(__name__)
 
 # 加载配置
 config_manager = load_config()
+setup_logging(config_manager.env.ir_log_format, config_manager.env.ir_log_rate_limits)
+tracing.TRACER.configure(config_manager.env.ir_trace_file, config_manager.env.ir_trace_format)
 
 # 初始化Bot
+if config_manager.env.ir_api_url:
+    telebot.apihelper.API_URL = config_manager.env.ir_api_url.rstrip("/") + "/bot{0}/{1}"
 bot = telebot.TeleBot(config_manager.env.ir_bot_token)
 
-# 初始化MQTT客户端管理器
-mqtt_manager = MQTTClientManager(config_manager.devices, bot)
+# 所有发往Telegram的消息经过出站调度器限速、合并
+outbox = OutboundDispatcher(bot)
+
+# 初始化MQTT客户端管理器，入站消息交给有界工作池处理
+inbound_pool = InboundWorkerPool(
+    workers=config_manager.env.ir_inbound_workers,
+    queue_size=config_manager.env.ir_inbound_queue_size,
+    overflow=config_manager.env.ir_inbound_overflow
+)
+# 连接在后台并行建立，不阻塞Telegram轮询启动
+mqtt_manager = MQTTClientManager(
+    config_manager.devices, outbox, inbound_pool,
+    startup_budget=config_manager.env.ir_mqtt_startup_budget,
+    shadow_ttl=config_manager.env.ir_shadow_ttl,
+    request_timeout=config_manager.env.ir_request_timeout,
+    scheduler_mode=config_manager.env.ir_scheduler,
+    scheduler_max_tasks=config_manager.env.ir_scheduler_max_tasks,
+    storage=config_manager.storage
+)
 
 # 初始化服务
-service = BotService(bot, config_manager)
+service = BotService(outbox, config_manager, mqtt_manager)
 
 
 def current_mqtt_publish(data):
@@ -37,156 +65,172 @@ def current_mqtt_publish(data):
     mqtt_manager.publish_to_device(current_device.name, data)
 
 
+def current_mqtt_publish_batch(items):
+    """发布多条MQTT消息到当前设备，设备支持时合并为批量帧"""
+    current_device = config_manager.get_current_device()
+    mqtt_manager.publish_batch(current_device.name, items)
+
+
 # 创建权限装饰器
 permission = create_permission_decorator(
-    bot,
-    config_manager.db.to_dict(),  # 需要传递db字典以兼容原装饰器
+    outbox,
+    config_manager.auth,
     current_mqtt_publish
 )
 
 # 初始化回调处理器
 task_callback_handler = TaskCallbackHandler(
-    bot, config_manager, service, current_mqtt_publish
+    outbox, config_manager, service, current_mqtt_publish,
+    registry=mqtt_manager.message_router.live
 )
 alias_callback_handler = AliasCallbackHandler(
-    bot, config_manager, service, current_mqtt_publish
+    outbox, config_manager, service, current_mqtt_publish,
+    batch_publisher=current_mqtt_publish_batch
 )
+page_callback_handler = PageCallbackHandler(outbox, mqtt_manager.message_router.pages)
 
 
 # ============= 命令处理器 =============
 
-@bot.message_handler(commands=['copy'])
+# 命令与回调按名称/前缀索引分发，向bot只注册一个消息处理器和一个回调处理器
+dispatcher = Dispatcher()
+
+
+@dispatcher.command('copy')
 @permission.require_auth
 def bot_copy(message):
     """处理copy命令"""
     return service.copy(message)
 
 
-@bot.message_handler(commands=['exec'])
+@dispatcher.command('exec')
 @permission.require_auth
 def bot_exec(message):
     """处理exec命令"""
     return service.exec(message)
 
 
-@bot.message_handler(commands=['terminate'])
+@dispatcher.command('terminate')
 @permission.require_auth
 def bot_terminate(message):
     """处理terminate命令"""
     return service.terminate(message)
 
 
-@bot.message_handler(commands=['terminatename'])
+@dispatcher.command('terminatename')
 @permission.require_auth
 def bot_terminatename(message):
     """处理terminatename命令"""
     return service.terminatename(message)
 
 
-@bot.message_handler(commands=['cmdlist'])
+@dispatcher.command('cmdlist')
 @permission.require_auth
 def bot_cmdlist(message):
     """处理cmdlist命令"""
     return service.cmdlist(message)
 
 
-@bot.message_handler(commands=['taskidlist'])
+@dispatcher.command('taskidlist')
 @permission.require_auth
 def bot_taskidlist(message):
     """处理taskidlist命令"""
     return service.taskidlist(message)
 
 
-@bot.message_handler(commands=['tasklist'])
+@dispatcher.command('tasklist')
 @permission.require_auth
 def bot_tasklist(message):
     """处理tasklist命令"""
     return service.tasklist(message)
 
 
-@bot.message_handler(commands=['task'])
+@dispatcher.command('task')
 @permission.require_auth
 def bot_task(message):
     """处理task命令"""
     return service.task(message)
 
 
-@bot.message_handler(commands=['device'])
+@dispatcher.command('device')
 @permission.require_auth
 def bot_device(message):
     """处理device命令"""
     service.device(message)
 
 
-@bot.message_handler(commands=['usermod'])
+@dispatcher.command('usermod')
 @permission.require_auth
 def bot_usermod(message):
     """处理usermod命令"""
     service.usermod(message)
 
 
-@bot.message_handler(commands=['preference'])
+@dispatcher.command('rtt')
+@permission.require_auth
+def bot_rtt(message):
+    """处理rtt命令"""
+    service.rtt(message)
+
+
+@dispatcher.command('trace')
+@permission.require_auth
+def bot_trace(message):
+    """处理trace命令"""
+    service.trace(message)
+
+
+@dispatcher.command('profile')
+@permission.require_auth
+def bot_profile(message):
+    """处理profile命令"""
+    service.profile(message)
+
+
+@dispatcher.command('preference')
 @permission.require_auth
 def bot_preference(message):
     """处理preference命令"""
-    logger.info(f"执行preference命令: user_id={message.from_user.id}")
+    logger.info("执行preference命令: user_id=%s", message.from_user.id)
     
-    lines = [i.strip() for i in message.text.split('\n') if i and i.strip()]
     preferences = config_manager.get_current_preferences()
+    aliases = parsers.PreferenceParser.apply(message.text, preferences)
     
-    # 添加删除别名
-    adding = ""
-    for line in lines[1:]:
-        if line[0] == "+":  # 添加新别名
-            adding = line[1:]
-            preferences[adding] = []
-            continue
-        if line[0] == "-":  # 删除别名
-            adding = ""
-            if line[1:] in preferences:
-                del preferences[line[1:]]
-            continue
-        if adding:  # 添加命令到当前别名
-            preferences[adding].append(line)
-    
-    config_manager.update_preferences(preferences)
-    logger.info(f"preference配置更新完成，当前别名数量: {len(preferences)}")
+    errors = config_manager.update_preferences(preferences)
+    logger.info("preference配置更新完成，当前别名数量: %s", len(preferences))
     
     # 返回别名列表
-    preference_msg = "\n".join([
-        f"+{k}\n    {chr(10).join('    ' + line for line in v)}"
-        for k, v in preferences.items()
-    ])
-    bot.reply_to(message, f"alias list:\n{preference_msg}")
+    outbox.reply_to(message, parsers.PreferenceParser.format(preferences))
+    if errors:
+        outbox.reply_to(message, alias_errors_text(errors))
     
     # 执行别名
-    args = [i for i in lines[0].split(" ")[1:] if i]
-    for alias in args:
+    for alias in aliases:
         alias_callback_handler._exec_alias(alias, message)
 
 
-@bot.message_handler(commands=['alias'])
+@dispatcher.command('alias')
 @permission.require_auth
 def bot_alias(message):
     """处理alias命令"""
     alias_callback_handler.show_alias_menu(message)
 
 
-@bot.message_handler(commands=['auth'])
+@dispatcher.command('auth')
 @permission.no_auth_required
 def bot_auth(message):
     """处理auth命令"""
     service.auth(message)
 
 
-@bot.message_handler(commands=['start'])
+@dispatcher.command('start')
 @permission.no_auth_required
 def bot_start(message):
     """处理start命令"""
     service.start(message)
 
 
-@bot.message_handler(commands=['help'])
+@dispatcher.command('help')
 @permission.no_auth_required
 def bot_help(message):
     """处理help命令"""
@@ -195,55 +239,77 @@ def bot_help(message):
 
 # ============= 回调查询处理器 =============
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("taskid_"))
+@dispatcher.callback(prefix="taskid_")
+@permission.require_callback_auth
 def callback_taskid(call):
     """处理任务ID终止回调"""
     task_callback_handler.handle_taskid(call)
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("taskname_"))
+@dispatcher.callback(prefix="taskname_")
+@permission.require_callback_auth
 def callback_taskname(call):
     """处理任务名称终止回调"""
     task_callback_handler.handle_taskname(call)
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("alias_exc_"))
+@dispatcher.callback(prefix="page_")
+@permission.require_callback_auth
+def callback_page(call):
+    """处理列表翻页回调"""
+    page_callback_handler.handle_page(call)
+
+
+@dispatcher.callback(prefix="alias_exc_")
+@permission.require_callback_auth
 def callback_alias_exec(call):
     """处理别名执行回调"""
     alias_callback_handler.handle_exec(call)
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("alias_del_"))
+@dispatcher.callback(prefix="alias_del_")
+@permission.require_callback_auth
 def callback_alias_delete(call):
     """处理别名删除回调"""
     alias_callback_handler.handle_delete(call)
 
 
-@bot.callback_query_handler(func=lambda call: call.data == "alias_add")
+@dispatcher.callback("alias_add")
+@permission.require_callback_auth
 def callback_alias_add(call):
     """处理别名添加回调"""
     alias_callback_handler.handle_add(call)
 
 
-@bot.callback_query_handler(func=lambda call: call.data in ["alias_del", "alias_exc", "alias_cancel"])
+@dispatcher.callback("alias_del", "alias_exc", "alias_cancel")
+@permission.require_callback_auth
 def callback_alias_menu(call):
     """处理别名菜单切换回调"""
     alias_callback_handler.handle_menu_switch(call)
 
 
+dispatcher.install(bot)
+
+
 # ============= 主函数 =============
 
 if __name__ == "__main__":
     logger.info("TG Bot启动")
-    logger.info(f"当前设备: {config_manager.get_current_device().name}")
-    logger.info(f"授权用户数: {len(config_manager.db.user)}")
+    logger.info("当前设备: %s", config_manager.get_current_device().name)
+    logger.info("授权用户数: %s", len(config_manager.auth))
+    if config_manager.env.ir_metrics_port:
+        metrics.start_http_server(config_manager.env.ir_metrics_port, config_manager.env.ir_metrics_host)
     
     try:
         bot.infinity_polling()
     except KeyboardInterrupt:
         logger.info("收到停止信号，正在关闭...")
         mqtt_manager.disconnect_all()
+        outbox.stop()
+        config_manager.close()
     except Exception as e:
-        logger.critical(f"TG Bot运行异常: {e}", exc_info=True)
+        logger.critical("TG Bot运行异常: %s", e, exc_info=True)
         mqtt_manager.disconnect_all()
+        outbox.stop()
+        config_manager.close()
         raise
@@ -0,0 +1,339 @@
+"""运行指标模块
+
+进程内的指标注册表，可选地在本地HTTP端口以Prometheus文本格式导出，供Prometheus
+或兼容OpenMetrics的采集器抓取：
+
+- 计数器（Counter）与直方图（Histogram）按标签值分为子指标，子指标第一次使用时创建，
+  之后的查找是一次字典读取；记录时只持有子指标自身的锁，不同标签之间互不竞争
+- 热路径上的调用方可以预先取得子指标（labels()的结果）并保存，记录时不再查找
+- 仪表（Gauge）可以设置回调，在导出时计算当前值，如连接状态与队列深度，
+  不在热路径上维护
+
+指标名称以tg_开头，见本模块末尾的定义。未启动HTTP端口时指标只在内存中累计。
+"""
+
+import bisect
+import logging
+import math
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# 默认的时延分桶（秒），覆盖Telegram API调用的常见范围
+DEFAULT_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+# 更新处理函数耗时分桶（秒），大多数处理函数只入队消息，在毫秒级完成
+HANDLER_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 10)
+
+LabelValues = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)) + "}"
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    """指标基类：按标签值管理子指标"""
+    
+    type_name = ""
+    
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[LabelValues, object] = {}
+        self._lock = threading.Lock()
+    
+    @property
+    def family(self) -> str:
+        """导出时HELP/TYPE行与样本使用的指标族名称"""
+        return self.name
+    
+    def _new_child(self):
+        raise NotImplementedError
+    
+    def labels(self, *values) -> object:
+        """
+        获取标签值对应的子指标，不存在时创建
+        
+        Raises:
+            ValueError: 标签值数量与标签名数量不一致
+        """
+        key = tuple(str(value) for value in values)
+        child = self._children.get(key)
+        if child is None:
+            if len(key) != len(self.labelnames):
+                raise ValueError(f"指标{self.name}需要{len(self.labelnames)}个标签值: {key}")
+            with self._lock:
+                child = self._children.setdefault(key, self._new_child())
+        return child
+    
+    def samples(self) -> Iterable[Tuple[str, LabelValues, Sequence[str], float]]:
+        """导出的样本: (名称后缀, 标签值, 额外标签名与值, 数值)"""
+        raise NotImplementedError
+    
+    def render(self) -> List[str]:
+        """以Prometheus文本格式输出"""
+        family = self.family
+        lines = [f"# HELP {family} {self.documentation}", f"# TYPE {family} {self.type_name}"]
+        for suffix, values, extra, value in self.samples():
+            names = self.labelnames + tuple(extra[::2])
+            label_values = values + tuple(extra[1::2])
+            lines.append(f"{family}{suffix}{_format_labels(names, label_values)} {_format_value(value)}")
+        return lines
+
+
+class _CounterChild:
+    __slots__ = ("value", "_lock")
+    
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+    
+    def inc(self, amount: float = 1) -> None:
+        with self._lock:
+            self.value += amount
+
+
+class Counter(_Metric):
+    """单调递增的计数器，导出的指标族与样本名为名称加_total后缀"""
+    
+    type_name = "counter"
+    
+    @property
+    def family(self) -> str:
+        return f"{self.name}_total"
+    
+    def _new_child(self) -> _CounterChild:
+        return _CounterChild()
+    
+    def inc(self, amount: float = 1) -> None:
+        """无标签计数器加amount"""
+        self.labels().inc(amount)
+    
+    def samples(self):
+        for values, child in list(self._children.items()):
+            yield "", values, (), child.value
+
+
+class _GaugeChild:
+    __slots__ = ("value",)
+    
+    def __init__(self):
+        self.value = 0.0
+    
+    def set(self, value: float) -> None:
+        self.value = value
+
+
+class Gauge(_Metric):
+    """
+    仪表，可直接设置数值，也可以设置导出时调用的回调
+    
+    回调返回 {标签值元组: 数值}，无标签时键为空元组。
+    """
+    
+    type_name = "gauge"
+    
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._callback: Optional[Callable[[], Dict[LabelValues, float]]] = None
+    
+    def _new_child(self) -> _GaugeChild:
+        return _GaugeChild()
+    
+    def set(self, value: float) -> None:
+        """设置无标签仪表的数值"""
+        self.labels().set(value)
+    
+    def set_callback(self, callback: Optional[Callable[[], Dict[LabelValues, float]]]) -> None:
+        """设置导出时计算数值的回调，为None时取消"""
+        self._callback = callback
+    
+    def samples(self):
+        for values, child in list(self._children.items()):
+            yield "", values, (), child.value
+        if self._callback is not None:
+            try:
+                values = self._callback()
+            except Exception as e:
+                logger.error("计算指标%s失败: %s", self.name, e)
+                return
+            for key, value in values.items():
+                yield "", tuple(str(v) for v in key), (), value
+
+
+class _HistogramChild:
+    __slots__ = ("bounds", "counts", "sum", "_lock")
+    
+    def __init__(self, bounds: Tuple[float, ...]):
+        self.bounds = bounds
+        # 最后一个桶为+Inf
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+    
+    def observe(self, value: float) -> None:
+        index = bisect.bisect_left(self.bounds, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+
+class Histogram(_Metric):
+    """分桶直方图，导出累计的桶计数、总和与样本数"""
+    
+    type_name = "histogram"
+    
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+    
+    def _new_child(self) -> _HistogramChild:
+        return _HistogramChild(self.buckets)
+    
+    def observe(self, value: float) -> None:
+        """无标签直方图记录一个样本"""
+        self.labels().observe(value)
+    
+    def samples(self):
+        for values, child in list(self._children.items()):
+            with child._lock:
+                counts, total = list(child.counts), child.sum
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                yield "_bucket", values, ("le", _format_value(bound)), cumulative
+            yield "_sum", values, (), total
+            yield "_count", values, (), cumulative
+
+
+class Registry:
+    """指标注册表"""
+    
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+    
+    def register(self, metric: _Metric) -> _Metric:
+        """
+        注册指标
+        
+        Raises:
+            ValueError: 同名指标已注册
+        """
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"指标已注册: {metric.name}")
+            self._metrics[metric.name] = metric
+        return metric
+    
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+    
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self.register(Gauge(name, documentation, labelnames))
+    
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+    
+    def render(self) -> str:
+        """以Prometheus文本格式输出全部指标"""
+        lines: List[str] = []
+        for metric in list(self._metrics.values()):
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    """导出指标的HTTP处理器，只响应GET /metrics"""
+    
+    registry = REGISTRY
+    
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/metrics", "/"):
+            self.send_error(404)
+            return
+        body = self.registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def log_message(self, format, *args):
+        logger.debug("指标请求: " + format, *args)
+
+
+def start_http_server(port: int, host: str = "127.0.0.1", registry: Registry = REGISTRY) -> ThreadingHTTPServer:
+    """
+    在后台线程中启动指标HTTP端口
+    
+    Args:
+        port: 监听端口
+        host: 监听地址，默认只监听本机
+        registry: 导出的注册表
+    
+    Returns:
+        HTTP服务器，调用shutdown()停止
+    """
+    handler = type("MetricsHandler", (_MetricsHandler,), {"registry": registry})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True)
+    thread.start()
+    logger.info("指标HTTP端口已启动: http://%s:%s/metrics", host, server.server_address[1])
+    return server
+
+
+# ============= 指标定义 =============
+
+COMMANDS = REGISTRY.counter(
+    "tg_commands", "Telegram commands handled, by command and outcome", ("command", "outcome"))
+MQTT_MESSAGES = REGISTRY.counter(
+    "tg_mqtt_messages", "MQTT messages received from or published to devices", ("device", "direction"))
+ROUTED_MESSAGES = REGISTRY.counter(
+    "tg_routed_messages", "Device replies routed to message handlers, by reply type", ("kind",))
+HANDLER_LATENCY = REGISTRY.histogram(
+    "tg_handler_seconds", "Wall time of Telegram update handlers in seconds, by route", ("route",),
+    HANDLER_BUCKETS)
+TELEGRAM_LATENCY = REGISTRY.histogram(
+    "tg_telegram_api_seconds", "Telegram Bot API call latency in seconds", ("method",))
+TELEGRAM_ERRORS = REGISTRY.counter(
+    "tg_telegram_api_errors", "Failed Telegram Bot API calls, by method and error code", ("method", "code"))
+TELEGRAM_RATE_LIMITED = REGISTRY.counter(
+    "tg_telegram_rate_limited", "Telegram Bot API calls rejected with 429", ("method",))
+MQTT_CONNECTION_STATE = REGISTRY.gauge(
+    "tg_mqtt_connection_state", "MQTT connection state per broker (1 for the current state)", ("broker", "state"))
+OUTBOX_QUEUE_DEPTH = REGISTRY.gauge(
+    "tg_outbox_queue_depth", "Telegram messages waiting in the outbound queue")
+INBOUND_QUEUE_DEPTH = REGISTRY.gauge(
+    "tg_inbound_queue_depth", "MQTT messages waiting in the inbound worker queues")
+INBOUND_DROPPED = REGISTRY.counter(
+    "tg_inbound_dropped", "MQTT messages dropped because the inbound queue was full")
+INBOUND_LAG = REGISTRY.histogram(
+    "tg_inbound_lag_seconds", "Time MQTT messages waited in the inbound queue in seconds", (),
+    HANDLER_BUCKETS)
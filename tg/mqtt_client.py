@@ -1,35 +1,104 @@
 """MQTT客户端管理模块（重构版）
 
 使用消息路由器简化MQTT客户端管理。
+连接到同一MQTT服务器（地址、端口、认证信息相同）的设备共享一个连接，
+按订阅主题将收到的消息分发给对应设备。
+
+所有连接以connect_async并行建立，不阻塞启动；收到CONNACK前设备处于
+connecting状态。
 """
 
 import logging
-import json
+import threading
+import time
 import uuid
-from typing import Dict, Callable
+from typing import Dict, Callable, Iterable, List, Optional, Tuple
 from paho.mqtt import client as mqtt
 from config import DeviceConfig
+import batch
+from shadow import DeviceShadow
+import correlation
+import metrics
+import tracing
+import delta
+from correlation import RequestTracker
+import scheduler
+from scheduler import TaskScheduler
+from storage import StorageBackend
+from codec import Codec, get_codec
 from handlers import MessageRouter
+from inbound import InboundWorkerPool
 
 
 logger = logging.getLogger(__name__)
 
+# 连接状态
+STATE_CONNECTING = "connecting"
+STATE_CONNECTED = "connected"
+STATE_UNAVAILABLE = "unavailable"  # 客户端初始化失败
+
+# 断线重连的初始与最大等待时间（秒）
+RECONNECT_MIN_DELAY = 1
+RECONNECT_MAX_DELAY = 60
+
+
+def connection_states(connections: Iterable) -> Dict[Tuple[str, str], int]:
+    """
+    计算tg_mqtt_connection_state指标：每个连接的当前状态为1，其余状态为0
+    
+    Args:
+        connections: MQTTClient或AsyncMQTTClient
+    """
+    states = {}
+    for client in connections:
+        broker = f"{client.host}:{client.port}"
+        for state in (STATE_CONNECTING, STATE_CONNECTED, STATE_UNAVAILABLE):
+            states[(broker, state)] = int(client.state == state)
+    return states
+
+
+def broker_key(device: DeviceConfig) -> Tuple[str, int, str, str]:
+    """
+    获取设备所连接MQTT服务器的标识，标识相同的设备共享同一个连接
+    
+    Args:
+        device: 设备配置
+    """
+    return (device.ir_mqtthost, device.ir_mqttport, device.ir_username, device.ir_password)
+
 
 class MQTTClient:
-    """单个MQTT客户端封装"""
+    """单个MQTT服务器连接封装，可被多个设备共享"""
     
-    def __init__(self, device: DeviceConfig, message_router: MessageRouter):
+    def __init__(self, devices: List[DeviceConfig], message_router: MessageRouter,
+                 inbound: InboundWorkerPool):
         """
         初始化MQTT客户端
         
         Args:
-            device: 设备配置
+            devices: 共享此连接的设备配置，须具有相同的broker_key
             message_router: 消息路由器
+            inbound: 入站消息工作池
         """
-        self.device = device
+        self.devices = devices
+        self.host, self.port, self.username, self.password = broker_key(devices[0])
         self.message_router = message_router
+        self.inbound = inbound
         self.client: mqtt.Client = None
-        self.logger = logging.getLogger(f"{__name__}.{device.name}")
+        self.logger = logging.getLogger(f"{__name__}.{self.host}:{self.port}")
+        self.state = STATE_CONNECTING
+        self.connect_latency: Optional[float] = None
+        self._connect_started = time.monotonic()
+        
+        # 订阅主题 -> 设备名称，多个设备使用相同订阅主题时只分发给第一个
+        self.topics: Dict[str, str] = {}
+        for device in devices:
+            self.topics.setdefault(device.ir_sub_topic, device.name)
+        # 发布主题 -> 设备名称，用于按设备统计发出的消息
+        self.pub_topics: Dict[str, str] = {device.ir_pub_topic: device.name for device in devices}
+        
+        # 设备名称 -> 编解码器
+        self.codecs: Dict[str, Codec] = {device.name: get_codec(device.ir_codec) for device in devices}
         
         self._connect()
     
@@ -56,39 +125,86 @@ class MQTTClient:
         ]
         
         if rc == 0:
-            self.logger.info(f"MQTT连接状态: {rc_messages[rc]}")
-            client.subscribe(self.device.ir_sub_topic)
+            self.connect_latency = time.monotonic() - self._connect_started
+            self.state = STATE_CONNECTED
+            self.logger.info(
+                "MQTT连接状态: %s, devices=%s, 耗时: %.0fms",
+                rc_messages[rc], [device.name for device in self.devices], self.connect_latency * 1000
+            )
+            client.subscribe([(topic, 0) for topic in self.topics])
         else:
-            self.logger.error(f"MQTT连接失败: {rc_messages[rc]} (code: {rc})")
+            self.logger.error("MQTT连接失败: %s (code: %s)", rc_messages[rc], rc)
+    
+    def _on_disconnect(self, client, userdata, rc):
+        """
+        MQTT断开回调，paho网络线程会自动重连
+        
+        Args:
+            rc: 返回码，0表示主动断开
+        """
+        if self.state == STATE_CONNECTED:
+            self._connect_started = time.monotonic()
+        self.state = STATE_CONNECTING
+        if rc != 0:
+            self.logger.warning("MQTT连接断开 (code: %s)，等待自动重连", rc)
     
     def _on_message(self, client, userdata, msg):
         """
-        MQTT消息接收回调
+        MQTT消息接收回调（运行在paho网络线程中）
+        
+        按主题找到对应设备后放入入站队列，具体处理由工作池完成
         
         Args:
             msg: 消息对象
         """
+        device_name = self._device_for_topic(msg.topic)
+        if device_name is None:
+            self.logger.warning("收到未知主题的MQTT消息: topic='%s'", msg.topic)
+            return
+        self.inbound.submit(device_name, self._handle_message, device_name, msg)
+    
+    def _device_for_topic(self, topic: str) -> Optional[str]:
+        """
+        根据消息主题查找设备名称，支持通配符订阅
+        
+        Args:
+            topic: 消息主题
+        """
+        device_name = self.topics.get(topic)
+        if device_name is not None:
+            return device_name
+        for sub, name in self.topics.items():
+            if mqtt.topic_matches_sub(sub, topic):
+                return name
+        return None
+    
+    def _handle_message(self, device_name: str, msg) -> None:
+        """
+        处理MQTT消息（运行在入站工作线程中）
+        
+        Args:
+            device_name: 消息所属设备名称
+            msg: 消息对象
+        """
         try:
-            message = json.loads(msg.payload.decode('utf-8'))
-            self.logger.info(
-                f"接收MQTT消息: topic='{msg.topic}', "
-                f"qos={msg.qos}, payload='{str(message)}'"
-            )
+            message = self.codecs[device_name].decode(msg.payload)
+            metrics.MQTT_MESSAGES.labels(device_name, "in").inc()
+            self.logger.info("接收MQTT消息: device=%s, topic='%s', qos=%s", device_name, msg.topic, msg.qos)
+            self.logger.debug("MQTT消息内容: %s", message)
             
             # 使用消息路由器处理消息
-            self.message_router.route(message)
-            
-        except json.JSONDecodeError as e:
-            self.logger.error(f"JSON解析失败: {e}")
+            self.message_router.route(message, device_name)
+        
+        except ValueError as e:
+            self.logger.error("消息解析失败: %s", e)
         except Exception as e:
-            self.logger.error(f"处理MQTT消息时发生错误: {e}", exc_info=True)
+            self.logger.error("处理MQTT消息时发生错误: %s", e, exc_info=True)
     
     def _connect(self) -> None:
         """建立MQTT连接"""
         self.logger.info(
-            f"初始化MQTT连接: host={self.device.ir_mqtthost}, "
-            f"port={self.device.ir_mqttport}, user={self.device.ir_username}, "
-            f"sub_topic={self.device.ir_sub_topic}, pub_topic={self.device.ir_pub_topic}"
+            "初始化MQTT连接: host=%s, port=%s, user=%s, devices=%s, sub_topics=%s",
+            self.host, self.port, self.username, [device.name for device in self.devices], list(self.topics)
         )
         
         # 创建客户端
@@ -99,32 +215,25 @@ class MQTTClient:
         
         # 设置回调
         self.client.on_connect = self._on_connect
+        self.client.on_disconnect = self._on_disconnect
         self.client.on_message = self._on_message
         
         # 设置认证
-        self.client.username_pw_set(
-            self.device.ir_username,
-            self.device.ir_password
-        )
+        self.client.username_pw_set(self.username, self.password)
+        self.client.reconnect_delay_set(RECONNECT_MIN_DELAY, RECONNECT_MAX_DELAY)
         
         try:
-            # 连接并启动循环
-            self.client.connect(
-                self.device.ir_mqtthost,
-                self.device.ir_mqttport,
-                60
-            )
+            # 连接在网络线程中建立，不阻塞调用方；首次连接失败也会自动重试
+            self._connect_started = time.monotonic()
+            self.client.connect_async(self.host, self.port, 60)
             self.client.loop_start()
             
-            self.logger.info(
-                f"MQTT客户端启动成功: {self.device.ir_mqtthost}:"
-                f"{self.device.ir_mqttport}"
-            )
+            self.logger.info("MQTT客户端启动: %s:%s, 等待连接", self.host, self.port)
         except Exception as e:
-            self.logger.error(f"MQTT连接启动失败: {e}")
+            self.logger.error("MQTT连接启动失败: %s", e)
             raise
     
-    def publish(self, topic: str, payload: str, qos: int = 0) -> None:
+    def publish(self, topic: str, payload: bytes, qos: int = 0) -> None:
         """
         发布MQTT消息
         
@@ -134,8 +243,11 @@ class MQTTClient:
             qos: 服务质量等级
         """
         if self.client:
+            if self.state != STATE_CONNECTED:
+                self.logger.warning("MQTT连接尚未建立（%s），消息可能丢失: topic=%s", self.state, topic)
             self.client.publish(topic, payload, qos)
-            self.logger.debug(f"发布MQTT消息: topic={topic}, payload={payload}")
+            metrics.MQTT_MESSAGES.labels(self.pub_topics.get(topic, topic), "out").inc()
+            self.logger.debug("发布MQTT消息: topic=%s, payload=%s", topic, payload)
     
     def disconnect(self) -> None:
         """断开MQTT连接"""
@@ -148,28 +260,117 @@ class MQTTClient:
 class MQTTClientManager:
     """MQTT客户端管理器"""
     
-    def __init__(self, devices: Dict[str, DeviceConfig], bot):
+    def __init__(self, devices: Dict[str, DeviceConfig], bot,
+                 inbound: Optional[InboundWorkerPool] = None,
+                 startup_budget: float = 10, shadow_ttl: float = 30,
+                 request_timeout: float = 10, scheduler_mode: str = scheduler.MODE_DEVICE,
+                 scheduler_max_tasks: int = 10000, storage: Optional[StorageBackend] = None):
         """
         初始化MQTT客户端管理器
         
+        连接在后台并行建立，构造函数立即返回。
+        
         Args:
             devices: 设备配置字典
             bot: Telegram bot实例
+            inbound: 入站消息工作池，为None时使用默认配置创建
+            startup_budget: 启动时间预算（秒），超时后记录仍未连接的设备
+            shadow_ttl: 设备影子缓存有效期（秒），为0时列表查询总是发往设备
+            request_timeout: 命令等待设备回复的超时时间（秒），超时后通知发出命令的聊天
+            scheduler_mode: 任务调度模式，见scheduler.SCHEDULER_MODES
+            scheduler_max_tasks: 服务端调度时每个设备最多保存的任务数
+            storage: 服务端调度时保存任务的存储后端，bot重启后恢复
         """
+        if scheduler_mode not in scheduler.SCHEDULER_MODES:
+            raise ValueError(f"未知的任务调度模式: {scheduler_mode}")
+        
         self.devices = devices
         self.bot = bot
         self.logger = logging.getLogger(__name__)
         
-        # 创建消息路由器
-        self.message_router = MessageRouter(bot)
+        # 设备影子缓存列表类回复，请求跟踪器按rid匹配回复，创建消息路由器
+        self.shadow = DeviceShadow(shadow_ttl)
+        self.requests = RequestTracker(request_timeout)
+        self.message_router = MessageRouter(bot, self.shadow, self.requests)
+        
+        # 入站消息在工作池中处理，不占用paho网络线程
+        self.inbound = inbound or InboundWorkerPool()
+        
+        # 按MQTT服务器分组，同一服务器的设备共享一个连接
+        groups: Dict[Tuple[str, int, str, str], List[DeviceConfig]] = {}
+        for device in devices.values():
+            groups.setdefault(broker_key(device), []).append(device)
         
-        # 创建所有设备的MQTT客户端
+        # 设备名称 -> 所用连接；服务器标识 -> 连接
         self.clients: Dict[str, MQTTClient] = {}
-        for name, device in devices.items():
+        self.connections: Dict[Tuple[str, int, str, str], MQTTClient] = {}
+        for key, group in groups.items():
+            names = [device.name for device in group]
             try:
-                self.clients[name] = MQTTClient(device, self.message_router)
+                client = MQTTClient(group, self.message_router, self.inbound)
             except Exception as e:
-                self.logger.error(f"初始化设备 {name} 的MQTT客户端失败: {e}")
+                self.logger.error("初始化设备 %s 的MQTT客户端失败: %s", names, e)
+                continue
+            self.connections[key] = client
+            for name in names:
+                self.clients[name] = client
+        
+        self.logger.info("MQTT连接数: %s, 设备数: %s", len(self.connections), len(devices))
+        metrics.MQTT_CONNECTION_STATE.set_callback(lambda: connection_states(self.connections.values()))
+        
+        self._startup_timer = threading.Timer(startup_budget, self._check_startup)
+        self._startup_timer.daemon = True
+        self._startup_timer.start()
+        
+        # 定期检查超时未回复的命令
+        self._stopped = threading.Event()
+        self._sweeper = threading.Thread(target=self._sweep_requests, name="mqtt-requests", daemon=True)
+        self._sweeper.start()
+        
+        # 服务端调度模式下，延期执行的任务保存在bot端，到期后发往设备
+        self.scheduler: Optional[TaskScheduler] = None
+        if scheduler_mode == scheduler.MODE_SERVER:
+            self.scheduler = TaskScheduler(
+                self.publish_to_device, scheduler_max_tasks, storage, self.shadow.known_commands
+            )
+            threading.Thread(
+                target=self.scheduler.run, args=(self._stopped,), name="task-scheduler", daemon=True
+            ).start()
+    
+    def _check_startup(self) -> None:
+        """启动时间预算到期，汇总各设备连接耗时"""
+        pending = [name for name in self.devices if self.get_state(name) != STATE_CONNECTED]
+        latencies = {
+            name: f"{client.connect_latency * 1000:.0f}ms"
+            for name, client in self.clients.items()
+            if client.connect_latency is not None
+        }
+        self.logger.info("MQTT启动连接耗时: %s", latencies)
+        if pending:
+            self.logger.warning("启动时间预算内未连接的设备: %s", pending)
+    
+    def _sweep_requests(self) -> None:
+        """每秒检查一次待回复表，通知超时的命令"""
+        while not self._stopped.wait(1):
+            for request in self.requests.expire():
+                self.logger.warning("命令回复超时: %s", request)
+                try:
+                    self.bot.send_message(request.chat_id, RequestTracker.timeout_text(request))
+                except Exception as e:
+                    self.logger.error("发送超时通知失败: %s", e)
+    
+    def get_state(self, device_name: str) -> str:
+        """
+        获取设备的连接状态
+        
+        Args:
+            device_name: 设备名称
+        
+        Returns:
+            连接状态，客户端初始化失败时为STATE_UNAVAILABLE
+        """
+        client = self.clients.get(device_name)
+        return client.state if client else STATE_UNAVAILABLE
     
     def get(self, device_name: str) -> MQTTClient:
         """
@@ -177,13 +378,13 @@ class MQTTClientManager:
         
         Args:
             device_name: 设备名称
-            
+        
         Returns:
             MQTT客户端，如果不存在则返回None
         """
         client = self.clients.get(device_name)
         if client is None:
-            self.logger.warning(f"未找到MQTT客户端: {device_name}")
+            self.logger.warning("未找到MQTT客户端: %s", device_name)
         return client
     
     def publish_to_device(self, device_name: str, data: Dict) -> None:
@@ -194,15 +395,88 @@ class MQTTClientManager:
             device_name: 设备名称
             data: 消息数据
         """
+        if self._schedule(device_name, data):
+            return
+        
+        # 有效期内的列表查询直接用设备影子回复
+        cached = self.shadow.lookup(device_name, data)
+        if cached is not None:
+            self.message_router.route(cached)
+            return
+        
         client = self.get(device_name)
         if client:
+            self.shadow.note_publish(device_name, data)
+            data = {**self.shadow.strip(data), correlation.RID_KEY: self.requests.next_rid()}
+            # 已有任务表副本时只请求副本版本之后的变化
+            if data.get("cmd") == "tasklist" and self.message_router.supports(device_name, delta.CAP_DELTA):
+                data.update(self.message_router.replica.request_fields(device_name))
+            if self.message_router.supports(device_name, correlation.CAP_RID):
+                self.requests.register(device_name, data)
             device = self.devices[device_name]
-            client.publish(device.ir_pub_topic, str(data), 0)
+            with tracing.span("mqtt.publish", device=device_name, cmd=data.get("cmd"), rid=data[correlation.RID_KEY]):
+                # 设备回复带回rid，据此把device.reply挂在本span下
+                tracing.TRACER.link(device_name, data[correlation.RID_KEY])
+                payload = client.codecs[device_name].encode(data)
+                client.publish(device.ir_pub_topic, payload, 0)
+    
+    def _schedule(self, device_name: str, data: Dict) -> bool:
+        """
+        服务端调度模式下由调度器处理任务相关的命令
+        
+        Returns:
+            命令已由调度器处理（无需发往设备）时返回True
+        """
+        if self.scheduler is None:
+            return False
+        replies = self.scheduler.handle(device_name, data)
+        if replies is None:
+            return False
+        for reply in replies:
+            self.message_router.route(reply)
+        return True
+    
+    def publish_batch(self, device_name: str, items: List[Dict]) -> None:
+        """
+        向指定设备发布多条命令
+        
+        设备声明支持批量帧时，可批量的命令合并为批量帧发送（保持原有顺序），
+        否则逐条发送。
+        
+        Args:
+            device_name: 设备名称
+            items: 命令数据列表
+        """
+        items = [data for data in items if not self._schedule(device_name, data)]
+        if not self.message_router.supports(device_name, batch.CAP_BATCH):
+            for data in items:
+                self.publish_to_device(device_name, data)
+            return
+        
+        # 相邻的可批量命令合并为一组，不可批量的命令单独发送
+        run: List[Dict] = []
+        for data in items + [None]:
+            if data is not None and batch.is_batchable(data):
+                run.append(data)
+                continue
+            if len(run) == 1:
+                self.publish_to_device(device_name, run[0])
+            elif run:
+                device = self.devices[device_name]
+                frames = batch.encode_batch(run, run[0]["chat_id"], get_codec(device.ir_codec), device.ir_pub_topic)
+                for frame in frames:
+                    self.publish_to_device(device_name, frame)
+            run = []
+            if data is not None:
+                self.publish_to_device(device_name, data)
     
     def disconnect_all(self) -> None:
         """断开所有MQTT客户端"""
-        for name, client in self.clients.items():
+        self._startup_timer.cancel()
+        self._stopped.set()
+        for (host, port, _, _), client in self.connections.items():
             try:
                 client.disconnect()
             except Exception as e:
-                self.logger.error(f"断开设备 {name} 的MQTT客户端失败: {e}")
+                self.logger.error("断开MQTT服务器 %s:%s 的连接失败: %s", host, port, e)
+        self.inbound.stop()
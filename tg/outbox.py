@@ -0,0 +1,622 @@
+"""出站消息调度模块
+
+所有发往Telegram的消息统一经过调度器：
+- 令牌桶限制每个聊天以及全局的发送速率，避免触发429
+- 同一聊天连续的短文本合并为一条消息（不超过4096字符）
+- 收到429时按照Telegram返回的retry_after延迟重试
+- 统计队列深度与发送延迟
+
+停止时继续按限速发送已排队的消息，超过等待时间仍未发送的消息以RuntimeError失败，
+不会静默丢失。
+"""
+
+import asyncio
+import logging
+import math
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, Deque, Dict, List, Optional, Set, Tuple
+import metrics
+import tracing
+
+
+logger = logging.getLogger(__name__)
+
+# Telegram单条消息最大长度
+MAX_MESSAGE_LENGTH = 4096
+# 合并消息之间的分隔符
+COALESCE_SEPARATOR = "\n\n"
+# 429重试的最大次数
+MAX_RETRIES = 5
+# 统计信息的日志间隔（秒）
+STATS_LOG_INTERVAL = 60
+
+
+class TokenBucket:
+    """令牌桶"""
+    
+    def __init__(self, rate: float, capacity: float):
+        """
+        初始化令牌桶
+        
+        Args:
+            rate: 每秒补充的令牌数
+            capacity: 桶容量（允许的突发量）
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+    
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    def wait_time(self, now: float) -> float:
+        """
+        获取下一个令牌可用前需要等待的秒数
+        
+        Args:
+            now: 当前monotonic时间
+        """
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+    
+    def consume(self) -> None:
+        """消耗一个令牌（调用前需确认wait_time为0）"""
+        self.tokens -= 1
+    
+    def is_full(self, now: float) -> bool:
+        """桶是否已满（长时间空闲）"""
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+@dataclass
+class _Job:
+    """待发送的Telegram调用"""
+    chat_id: Any
+    method: str
+    args: Tuple
+    kwargs: Dict[str, Any]
+    future: Any
+    # 可合并的纯文本消息内容，不可合并时为None
+    text: Optional[str] = None
+    enqueued_at: float = field(default_factory=time.monotonic)
+    attempts: int = 0
+    # 排队时的当前span，发送时作为telegram.<方法> span的父span
+    trace: Optional[tracing.SpanContext] = field(default_factory=tracing.current)
+
+
+class OutboundStats:
+    """出站统计信息"""
+    
+    def __init__(self, window: int = 1024):
+        """
+        初始化统计信息
+        
+        Args:
+            window: 计算延迟分位数时保留的最近样本数
+        """
+        self.sent = 0
+        self.coalesced = 0
+        self.retries = 0
+        self.failed = 0
+        self.latencies: Deque[float] = deque(maxlen=window)
+    
+    def snapshot(self, queue_depth: int) -> Dict[str, Any]:
+        """
+        获取统计快照
+        
+        Args:
+            queue_depth: 当前排队的消息数
+        """
+        latencies = sorted(self.latencies)
+        
+        def percentile(p: float) -> float:
+            if not latencies:
+                return 0.0
+            return latencies[min(len(latencies) - 1, int(len(latencies) * p))]
+        
+        return {
+            "queue_depth": queue_depth,
+            "sent": self.sent,
+            "coalesced": self.coalesced,
+            "retries": self.retries,
+            "failed": self.failed,
+            "latency_p50": percentile(0.50),
+            "latency_p99": percentile(0.99),
+            "latency_max": latencies[-1] if latencies else 0.0,
+        }
+
+
+class _OutboxCore:
+    """调度核心：维护每个聊天的队列、令牌桶与合并逻辑，不负责执行"""
+    
+    def __init__(self, bot, global_rate: float = 30, chat_rate: float = 1,
+                 chat_burst: float = 3, coalesce: bool = True):
+        """
+        初始化调度核心
+        
+        Args:
+            bot: Telegram bot实例
+            global_rate: 全局每秒最多发送的消息数
+            chat_rate: 每个聊天每秒最多发送的消息数
+            chat_burst: 每个聊天允许的突发消息数
+            coalesce: 是否合并同一聊天的连续短文本
+        """
+        self.bot = bot
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.coalesce = coalesce
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.stats = OutboundStats()
+        
+        self._queues: Dict[Any, Deque[_Job]] = {}
+        self._chat_buckets: Dict[Any, TokenBucket] = {}
+        self._blocked_until: Dict[Any, float] = {}
+        self._inflight: set = set()
+        # 有待发送消息的聊天，按轮询顺序排列
+        self._ready: Deque[Any] = deque()
+        self._depth = 0
+        self._last_stats_log = time.monotonic()
+        metrics.OUTBOX_QUEUE_DEPTH.set_callback(lambda: {(): self._depth})
+    
+    def __getattr__(self, name: str) -> Any:
+        """未经调度的方法直接透传给bot"""
+        if name == "bot":
+            raise AttributeError(name)
+        return getattr(self.bot, name)
+    
+    @staticmethod
+    def _chat_of(method: str, args: Tuple, kwargs: Dict[str, Any]) -> Any:
+        """从调用参数中取出目标聊天ID"""
+        if method == "reply_to":
+            return args[0].chat.id
+        if "chat_id" in kwargs:
+            return kwargs["chat_id"]
+        return args[0] if args else None
+    
+    def _make_job(self, method: str, args: Tuple, kwargs: Dict[str, Any], future) -> _Job:
+        """构建任务，纯文本的send_message标记为可合并"""
+        chat_id = self._chat_of(method, args, kwargs)
+        text = None
+        if self.coalesce and method == "send_message":
+            params = dict(zip(("chat_id", "text"), args))
+            params.update(kwargs)
+            if set(params) == {"chat_id", "text"} and isinstance(params["text"], str):
+                text = params["text"]
+        return _Job(chat_id, method, args, kwargs, future, text)
+    
+    def _push(self, job: _Job) -> None:
+        """将任务加入聊天队列"""
+        queue = self._queues.get(job.chat_id)
+        if queue is None:
+            queue = self._queues[job.chat_id] = deque()
+        if not queue and job.chat_id not in self._inflight:
+            self._ready.append(job.chat_id)
+        queue.append(job)
+        self._depth += 1
+    
+    def _chat_bucket(self, chat_id: Any) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+    
+    def _pick(self, now: float) -> Tuple[Optional[List[_Job]], Optional[float]]:
+        """
+        选出下一批可以发送的任务
+        
+        Returns:
+            (任务列表, None)；没有可发送任务时返回 (None, 需要等待的秒数或None)
+        """
+        wait: Optional[float] = None
+        for _ in range(len(self._ready)):
+            chat_id = self._ready[0]
+            self._ready.rotate(-1)
+            
+            chat_wait = max(
+                self._blocked_until.get(chat_id, 0) - now,
+                self._chat_bucket(chat_id).wait_time(now),
+                self.global_bucket.wait_time(now),
+            )
+            if chat_wait > 0:
+                wait = chat_wait if wait is None else min(wait, chat_wait)
+                continue
+            
+            self._chat_bucket(chat_id).consume()
+            self.global_bucket.consume()
+            self._ready.remove(chat_id)
+            self._inflight.add(chat_id)
+            self._blocked_until.pop(chat_id, None)
+            return self._take_batch(chat_id), None
+        return None, wait
+    
+    def _take_batch(self, chat_id: Any) -> List[_Job]:
+        """取出队首任务，并尽可能合并其后连续的可合并文本"""
+        queue = self._queues[chat_id]
+        batch = [queue.popleft()]
+        if batch[0].text is not None:
+            length = len(batch[0].text)
+            while queue and queue[0].text is not None:
+                length += len(COALESCE_SEPARATOR) + len(queue[0].text)
+                if length > MAX_MESSAGE_LENGTH:
+                    break
+                batch.append(queue.popleft())
+        self._depth -= len(batch)
+        return batch
+    
+    @staticmethod
+    def _call_args(batch: List[_Job]) -> Tuple[str, Tuple, Dict[str, Any]]:
+        """获取一批任务合并后的调用参数"""
+        head = batch[0]
+        if len(batch) == 1:
+            return head.method, head.args, head.kwargs
+        text = COALESCE_SEPARATOR.join(job.text for job in batch)
+        return "send_message", (head.chat_id, text), {}
+    
+    @staticmethod
+    def _retry_after(error: Exception) -> Optional[float]:
+        """若为429错误，返回Telegram要求的等待秒数"""
+        if getattr(error, "error_code", None) != 429:
+            return None
+        result_json = getattr(error, "result_json", None) or {}
+        return float(result_json.get("parameters", {}).get("retry_after", 1))
+    
+    def _finish(self, batch: List[_Job], now: float, error: Optional[Exception]) -> Optional[List[_Job]]:
+        """
+        处理一批任务的执行结果
+        
+        Returns:
+            需要重试时返回原任务列表（已放回队首），否则返回None
+        """
+        chat_id = batch[0].chat_id
+        self._inflight.discard(chat_id)
+        queue = self._queues.get(chat_id)
+        
+        retry_after = self._retry_after(error) if error else None
+        if error:
+            method = batch[0].method
+            if retry_after is not None:
+                metrics.TELEGRAM_RATE_LIMITED.labels(method).inc()
+            metrics.TELEGRAM_ERRORS.labels(method, getattr(error, "error_code", None) or type(error).__name__).inc()
+        if retry_after is not None and batch[0].attempts < MAX_RETRIES:
+            for job in batch:
+                job.attempts += 1
+            queue.extendleft(reversed(batch))
+            self._depth += len(batch)
+            self._blocked_until[chat_id] = now + retry_after
+            self.stats.retries += 1
+            logger.warning("Telegram限流(429): chat_id=%s, %s秒后重试", chat_id, retry_after)
+        else:
+            if error:
+                self.stats.failed += len(batch)
+            else:
+                self.stats.sent += 1
+                self.stats.coalesced += len(batch) - 1
+            for job in batch:
+                self.stats.latencies.append(now - job.enqueued_at)
+            batch = None
+        
+        if queue:
+            self._ready.append(chat_id)
+        else:
+            self._queues.pop(chat_id, None)
+            bucket = self._chat_buckets.get(chat_id)
+            if bucket and bucket.is_full(now) and chat_id not in self._blocked_until:
+                del self._chat_buckets[chat_id]
+        
+        if now - self._last_stats_log >= STATS_LOG_INTERVAL:
+            self._last_stats_log = now
+            logger.info("出站消息统计: %s", self.stats.snapshot(self._depth))
+        return batch
+    
+    def _drop_pending(self) -> List[_Job]:
+        """取出所有排队中的任务（停止时调用），正在执行的聊天保留空队列供_finish使用"""
+        dropped: List[_Job] = []
+        for chat_id in list(self._queues):
+            dropped.extend(self._queues[chat_id])
+            self._queues[chat_id].clear()
+            if chat_id not in self._inflight:
+                del self._queues[chat_id]
+        self._ready.clear()
+        self._depth = 0
+        return dropped
+    
+    @staticmethod
+    def _fail_dropped(dropped: List[_Job]) -> None:
+        """以RuntimeError结束停止时未发送的任务"""
+        if not dropped:
+            return
+        logger.warning("出站调度器已停止，%d条消息未发送", len(dropped))
+        error = RuntimeError("outbound dispatcher stopped")
+        for job in dropped:
+            if not job.future.done():
+                job.future.set_exception(error)
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """获取队列深度与发送延迟统计"""
+        return self.stats.snapshot(self._depth)
+
+
+class OutboundDispatcher(_OutboxCore):
+    """线程版出站消息调度器
+    
+    可替代bot传给各模块：send_message等方法立即返回Future，
+    由后台调度线程按限速发送；其余方法透传给bot。
+    """
+    
+    def __init__(self, bot, workers: int = 4, **kwargs):
+        """
+        初始化出站消息调度器
+        
+        Args:
+            bot: TeleBot实例
+            workers: 并发执行Telegram请求的线程数
+            **kwargs: 传给调度核心的限速参数
+        """
+        super().__init__(bot, **kwargs)
+        self._cond = threading.Condition()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="outbox")
+        self._running = True
+        # 停止后继续发送排队消息的截止时间；调度线程退出后_closed为True
+        self._deadline = 0.0
+        self._closed = False
+        self._thread = threading.Thread(target=self._loop, name="outbox-scheduler", daemon=True)
+        self._thread.start()
+    
+    def _enqueue(self, method: str, args: Tuple, kwargs: Dict[str, Any]) -> Future:
+        future: Future = Future()
+        with self._cond:
+            self._push(self._make_job(method, args, kwargs, future))
+            self._cond.notify()
+        return future
+    
+    def send_message(self, *args, **kwargs) -> Future:
+        """排队发送消息"""
+        return self._enqueue("send_message", args, kwargs)
+    
+    def reply_to(self, *args, **kwargs) -> Future:
+        """排队回复消息"""
+        return self._enqueue("reply_to", args, kwargs)
+    
+    def send_sticker(self, *args, **kwargs) -> Future:
+        """排队发送贴纸"""
+        return self._enqueue("send_sticker", args, kwargs)
+    
+    def send_document(self, *args, **kwargs) -> Future:
+        """排队发送文件"""
+        return self._enqueue("send_document", args, kwargs)
+    
+    def edit_message_text(self, *args, **kwargs) -> Future:
+        """排队编辑消息文本"""
+        return self._enqueue("edit_message_text", args, kwargs)
+    
+    def edit_message_reply_markup(self, *args, **kwargs) -> Future:
+        """排队编辑消息键盘"""
+        return self._enqueue("edit_message_reply_markup", args, kwargs)
+    
+    def _loop(self) -> None:
+        """调度线程：选出可发送的任务交给线程池执行，停止后发送完排队消息或到截止时间退出"""
+        while True:
+            with self._cond:
+                now = time.monotonic()
+                if not self._running and (self._depth == 0 or now >= self._deadline):
+                    self._closed = True
+                    dropped = self._drop_pending()
+                    break
+                batch, wait = self._pick(now)
+                if batch is None:
+                    if not self._running:
+                        wait = min(wait if wait is not None else math.inf, self._deadline - now)
+                    self._cond.wait(timeout=wait)
+                    continue
+            try:
+                self._executor.submit(self._execute, batch)
+            except RuntimeError as e:
+                # 线程池已关闭
+                logger.error("出站消息无法提交执行: chat_id=%s, error=%s", batch[0].chat_id, e)
+                with self._cond:
+                    self._finish(batch, time.monotonic(), e)
+                for job in batch:
+                    job.future.set_exception(e)
+        self._fail_dropped(dropped)
+    
+    def _execute(self, batch: List[_Job]) -> None:
+        """在工作线程中执行一批任务"""
+        method, args, kwargs = self._call_args(batch)
+        result, error = None, None
+        started = time.monotonic()
+        try:
+            with tracing.span(f"telegram.{method}", parent=batch[0].trace, messages=len(batch)):
+                result = getattr(self.bot, method)(*args, **kwargs)
+        except Exception as e:
+            error = e
+        metrics.TELEGRAM_LATENCY.labels(method).observe(time.monotonic() - started)
+        
+        dropped: List[_Job] = []
+        with self._cond:
+            retry = self._finish(batch, time.monotonic(), error)
+            if retry and self._closed:
+                # 调度线程已退出，放回队列的重试不会再被发送
+                dropped = self._drop_pending()
+            self._cond.notify()
+        self._fail_dropped(dropped)
+        if retry:
+            return
+        
+        if error:
+            logger.error("Telegram请求失败: method=%s, chat_id=%s, error=%s", method, batch[0].chat_id, error)
+        for job in batch:
+            if error:
+                job.future.set_exception(error)
+            else:
+                job.future.set_result(result)
+    
+    def stop(self, timeout: float = 10) -> None:
+        """
+        停止调度器，等待已排队的消息发送完成
+        
+        超过timeout仍在排队的消息以RuntimeError失败；调度线程退出后才关闭线程池，
+        并等待正在执行的请求完成。
+        
+        Args:
+            timeout: 最长等待秒数
+        """
+        with self._cond:
+            self._running = False
+            self._deadline = time.monotonic() + timeout
+            self._cond.notify()
+        self._thread.join(timeout + 1)
+        if self._thread.is_alive():
+            logger.error("出站调度线程未能在%s秒内退出", timeout)
+            return
+        self._executor.shutdown(wait=True)
+
+
+def _consume_exception(future: asyncio.Future) -> None:
+    if not future.cancelled():
+        future.exception()
+
+
+class AsyncOutboundDispatcher(_OutboxCore):
+    """asyncio版出站消息调度器，配合AsyncTeleBot使用
+    
+    send_message等方法把消息排队后立即返回asyncio.Future，await该future得到发送结果；
+    不需要结果的调用方（如设备回复的转发）可以不等待，避免被按聊天限速的发送阻塞。
+    """
+    
+    def __init__(self, bot, **kwargs):
+        """
+        初始化异步出站消息调度器
+        
+        Args:
+            bot: AsyncTeleBot实例
+            **kwargs: 传给调度核心的限速参数
+        """
+        super().__init__(bot, **kwargs)
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        # 正在执行的请求，保留引用避免执行中被回收，停止时等待完成
+        self._executing: Set[asyncio.Task] = set()
+        self._running = True
+        self._deadline = 0.0
+        self._closed = False
+    
+    def start(self) -> None:
+        """在当前事件循环中启动调度任务"""
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._loop(), name="outbox-scheduler")
+    
+    def _enqueue(self, method: str, args: Tuple, kwargs: Dict[str, Any]) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        # 失败已由调度器记录日志，未被等待的future不再报告未取得的异常
+        future.add_done_callback(_consume_exception)
+        self._push(self._make_job(method, args, kwargs, future))
+        self._wakeup.set()
+        return future
+    
+    def send_message(self, *args, **kwargs) -> asyncio.Future:
+        """排队发送消息"""
+        return self._enqueue("send_message", args, kwargs)
+    
+    def reply_to(self, *args, **kwargs) -> asyncio.Future:
+        """排队回复消息"""
+        return self._enqueue("reply_to", args, kwargs)
+    
+    def send_sticker(self, *args, **kwargs) -> asyncio.Future:
+        """排队发送贴纸"""
+        return self._enqueue("send_sticker", args, kwargs)
+    
+    def send_document(self, *args, **kwargs) -> asyncio.Future:
+        """排队发送文件"""
+        return self._enqueue("send_document", args, kwargs)
+    
+    def edit_message_text(self, *args, **kwargs) -> asyncio.Future:
+        """排队编辑消息文本"""
+        return self._enqueue("edit_message_text", args, kwargs)
+    
+    def edit_message_reply_markup(self, *args, **kwargs) -> asyncio.Future:
+        """排队编辑消息键盘"""
+        return self._enqueue("edit_message_reply_markup", args, kwargs)
+    
+    async def _loop(self) -> None:
+        """调度任务：选出可发送的任务并发执行，停止后发送完排队消息或到截止时间退出"""
+        while True:
+            now = time.monotonic()
+            if not self._running and (self._depth == 0 or now >= self._deadline):
+                self._closed = True
+                self._fail_dropped(self._drop_pending())
+                return
+            batch, wait = self._pick(now)
+            if batch is not None:
+                task = asyncio.create_task(self._execute(batch))
+                self._executing.add(task)
+                task.add_done_callback(self._executing.discard)
+                continue
+            if not self._running:
+                wait = min(wait if wait is not None else math.inf, self._deadline - now)
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=wait)
+            except asyncio.TimeoutError:
+                pass
+    
+    async def _execute(self, batch: List[_Job]) -> None:
+        """执行一批任务"""
+        method, args, kwargs = self._call_args(batch)
+        result, error = None, None
+        started = time.monotonic()
+        try:
+            with tracing.span(f"telegram.{method}", parent=batch[0].trace, messages=len(batch)):
+                result = await getattr(self.bot, method)(*args, **kwargs)
+        except Exception as e:
+            error = e
+        metrics.TELEGRAM_LATENCY.labels(method).observe(time.monotonic() - started)
+        
+        retry = self._finish(batch, time.monotonic(), error)
+        if retry and self._closed:
+            # 调度任务已退出，放回队列的重试不会再被发送
+            self._fail_dropped(self._drop_pending())
+        self._wakeup.set()
+        if retry:
+            return
+        
+        if error:
+            logger.error("Telegram请求失败: method=%s, chat_id=%s, error=%s", method, batch[0].chat_id, error)
+        for job in batch:
+            if job.future.done():
+                continue
+            if error:
+                job.future.set_exception(error)
+            else:
+                job.future.set_result(result)
+    
+    async def stop(self, timeout: float = 10) -> None:
+        """
+        停止调度任务，等待已排队的消息发送完成
+        
+        超过timeout仍在排队的消息以RuntimeError失败，之后等待正在执行的请求完成。
+        
+        Args:
+            timeout: 最长等待秒数
+        """
+        if self._task is None:
+            return
+        self._running = False
+        self._deadline = time.monotonic() + timeout
+        self._wakeup.set()
+        try:
+            await asyncio.wait_for(self._task, timeout + 1)
+        except asyncio.TimeoutError:
+            logger.error("出站调度任务未能在%s秒内退出", timeout)
+            self._fail_dropped(self._drop_pending())
+        self._task = None
+        if self._executing:
+            await asyncio.gather(*self._executing, return_exceptions=True)
@@ -0,0 +1,184 @@
+"""列表分页模块
+
+任务列表、命令列表等回复可能超过Telegram单条消息4096字符与内联键盘的限制。
+列表先拆成条目（每个任务一个条目，附带该任务的按钮），再只在条目之间分页，
+每页不超过MAX_PAGE_LENGTH字符与指定条目数。多于一页时附加上一页/下一页按钮。
+
+渲染好的各页保存在短期缓存中，翻页时直接编辑原消息，不再查询设备。
+"""
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+from telebot import types
+
+
+logger = logging.getLogger(__name__)
+
+# 单页文本的最大长度，为Telegram的4096字符上限留出余量
+MAX_PAGE_LENGTH = 3800
+# 默认每页最多的条目数，限制每页的按钮数量
+MAX_PAGE_ITEMS = 50
+
+# 翻页缓存的有效期（秒）与保留的列表数
+PAGE_TTL = 600
+PAGE_CACHE_SIZE = 256
+
+# 翻页回调数据前缀，格式为 page_<列表编号>_<页码>
+PAGE_PREFIX = "page_"
+# 页码指示按钮的回调数据，点击时不做任何操作
+PAGE_NOOP = PAGE_PREFIX + "noop"
+
+
+@dataclass
+class Entry:
+    """列表中的一个条目"""
+    text: str
+    # 条目附带的按钮 (文本, 回调数据)
+    buttons: List[Tuple[str, str]] = field(default_factory=list)
+
+
+@dataclass
+class Page:
+    """渲染后的一页"""
+    text: str
+    buttons: List[Tuple[str, str]]
+
+
+def build_pages(header: str, entries: List[Entry], footer: str = "", separator: str = "\n",
+                max_items: int = MAX_PAGE_ITEMS, max_length: int = MAX_PAGE_LENGTH) -> List[Page]:
+    """
+    将条目分页，每页都带有header与footer
+    
+    Args:
+        header: 每页开头的文本
+        entries: 条目列表
+        footer: 有条目的页末尾的文本
+        separator: 条目之间的分隔符
+        max_items: 每页最多的条目数
+        max_length: 每页最大的文本长度
+    
+    Returns:
+        页列表，没有条目时只有一页header
+    """
+    budget = max(max_length - len(header) - len(footer) - 2 * len(separator), 1)
+    groups: List[List[Entry]] = [[]]
+    length = 0
+    for entry in entries:
+        if len(entry.text) > budget:
+            entry = Entry(entry.text[:budget], entry.buttons)
+        size = len(entry.text) + len(separator)
+        if groups[-1] and (length + size > budget or len(groups[-1]) >= max_items):
+            groups.append([])
+            length = 0
+        groups[-1].append(entry)
+        length += size
+    
+    pages = []
+    for group in groups:
+        parts = [header] + [entry.text for entry in group]
+        if group and footer:
+            parts.append(footer)
+        # 同一页中相同的按钮只保留一个
+        buttons = list(dict.fromkeys(button for entry in group for button in entry.buttons))
+        pages.append(Page(separator.join(parts), buttons))
+    return pages
+
+
+def page_markup(page: Page, list_id: Optional[int], index: int, count: int) -> Optional[types.InlineKeyboardMarkup]:
+    """
+    构建一页的内联键盘：条目按钮每个一行，多于一页时末尾为翻页按钮
+    
+    Returns:
+        内联键盘，没有任何按钮时返回None
+    """
+    if not page.buttons and count <= 1:
+        return None
+    markup = types.InlineKeyboardMarkup()
+    for text, data in page.buttons:
+        markup.add(types.InlineKeyboardButton(text, callback_data=data))
+    if count > 1 and list_id is not None:
+        nav = []
+        if index > 0:
+            nav.append(types.InlineKeyboardButton("« prev", callback_data=f"{PAGE_PREFIX}{list_id}_{index - 1}"))
+        nav.append(types.InlineKeyboardButton(f"{index + 1}/{count}", callback_data=PAGE_NOOP))
+        if index < count - 1:
+            nav.append(types.InlineKeyboardButton("next »", callback_data=f"{PAGE_PREFIX}{list_id}_{index + 1}"))
+        markup.row(*nav)
+    return markup
+
+
+def parse_callback(data: str) -> Optional[Tuple[int, int]]:
+    """解析翻页回调数据，返回(列表编号, 页码)，格式不正确时返回None"""
+    list_id, _, index = data[len(PAGE_PREFIX):].partition("_")
+    if not (list_id.isdigit() and index.isdigit()):
+        return None
+    return int(list_id), int(index)
+
+
+class PageCache:
+    """最近渲染的分页列表，按列表编号查找"""
+    
+    def __init__(self, ttl: float = PAGE_TTL, capacity: int = PAGE_CACHE_SIZE):
+        """
+        初始化翻页缓存
+        
+        Args:
+            ttl: 列表的有效期（秒）
+            capacity: 最多保留的列表数，超出时淘汰最早的列表
+        """
+        self.ttl = ttl
+        self.capacity = capacity
+        self._lists: "OrderedDict[int, Tuple[float, List[Page]]]" = OrderedDict()
+        self._last_id = 0
+        self._lock = threading.Lock()
+    
+    def put(self, pages: List[Page]) -> int:
+        """保存分页列表，返回列表编号"""
+        with self._lock:
+            self._last_id += 1
+            self._lists[self._last_id] = (time.monotonic() + self.ttl, pages)
+            while len(self._lists) > self.capacity:
+                self._lists.popitem(last=False)
+            return self._last_id
+    
+    def get(self, list_id: int, index: int) -> Optional[Tuple[Page, int]]:
+        """
+        获取列表中的一页
+        
+        Returns:
+            (页, 总页数)，列表已过期或页码越界时返回None
+        """
+        with self._lock:
+            entry = self._lists.get(list_id)
+            if entry is None:
+                return None
+            expires, pages = entry
+            if expires <= time.monotonic():
+                del self._lists[list_id]
+                return None
+        if not 0 <= index < len(pages):
+            return None
+        return pages[index], len(pages)
+    
+    def render(self, pages: List[Page]) -> Dict[str, Any]:
+        """
+        渲染第一页为send_message的参数（不含chat_id），多于一页时保存各页用于翻页
+        
+        Args:
+            pages: build_pages的结果
+        """
+        list_id = self.put(pages) if len(pages) > 1 else None
+        return self.page_kwargs(pages[0], list_id, 0, len(pages))
+    
+    @staticmethod
+    def page_kwargs(page: Page, list_id: Optional[int], index: int, count: int) -> Dict[str, Any]:
+        """构建一页的消息参数（text与可选的reply_markup）"""
+        kwargs: Dict[str, Any] = {"text": page.text}
+        markup = page_markup(page, list_id, index, count)
+        if markup is not None:
+            kwargs["reply_markup"] = markup
+        return kwargs
@@ -6,7 +6,9 @@
 import re
 import logging
 from datetime import datetime, timezone, timedelta
-from typing import Dict, Any, Optional
+from typing import Dict, Any, List, Optional
+import shadow
+import cron
 
 
 logger = logging.getLogger(__name__)
@@ -120,6 +122,10 @@ class ExecCommandParser(CommandParser):
         解析cron格式的exec命令
         
         格式: /exec <name> cron(<cron_expr>) [remain] [taskname]
+        
+        Raises:
+            ValueError: 缺少参数
+            cron.CronError: cron表达式不合法
         """
         args = []
         
@@ -158,6 +164,9 @@ class ExecCommandParser(CommandParser):
         if len(args) < 2 or not args[1]:
             raise ValueError("cron表达式错误")
         
+        # 在发往设备前校验表达式，与固件的解析规则一致
+        cron.compile_cron(args[1])
+        
         data = {
             "cmd": "exec",
             "name": args[0],
@@ -267,6 +276,24 @@ class SimpleCommandParser(CommandParser):
             "cmd": cmd,
             "chat_id": chat_id
         }
+    
+    @staticmethod
+    def parse_query(cmd: str, text: str, chat_id: int) -> Dict[str, Any]:
+        """
+        解析列表查询命令（cmdlist、tasklist、taskidlist）
+        
+        Args:
+            cmd: 命令名称
+            text: 命令文本，带--fresh参数时跳过bot端的设备影子缓存
+            chat_id: 聊天ID
+            
+        Returns:
+            包含cmd的字典，带--fresh参数时包含fresh字段
+        """
+        data = SimpleCommandParser.parse_no_args(cmd, chat_id)
+        if shadow.FRESH_FLAG in text.split()[1:]:
+            data[shadow.FRESH_KEY] = True
+        return data
 
 
 class TaskCommandParser(CommandParser):
@@ -299,3 +326,71 @@ class TaskCommandParser(CommandParser):
             "id": args[0],
             "chat_id": chat_id
         }
+
+
+class PreferenceParser(CommandParser):
+    """preference命令解析器"""
+    
+    @staticmethod
+    def apply(text: str, preferences: Dict[str, List[str]]) -> List[str]:
+        """
+        解析preference命令并就地修改别名配置
+        
+        格式:
+            /preference [name ...]
+            [+addname]
+            cmd
+            ...
+            [-delname]
+        
+        Args:
+            text: 命令文本
+            preferences: 当前设备的别名配置，会被就地修改
+            
+        Returns:
+            需要执行的别名列表
+        """
+        lines = [i.strip() for i in text.split('\n') if i and i.strip()]
+        
+        # 添加删除别名
+        adding = ""
+        for line in lines[1:]:
+            if line[0] == "+":  # 添加新别名
+                adding = line[1:]
+                preferences[adding] = []
+                continue
+            if line[0] == "-":  # 删除别名
+                adding = ""
+                if line[1:] in preferences:
+                    del preferences[line[1:]]
+                continue
+            if adding:  # 添加命令到当前别名
+                preferences[adding].append(line)
+        
+        return [i for i in lines[0].split(" ")[1:] if i] if lines else []
+    
+    @staticmethod
+    def format(preferences: Dict[str, List[str]]) -> str:
+        """格式化别名列表"""
+        preference_msg = "\n".join([
+            f"+{k}\n    {chr(10).join('    ' + line for line in v)}"
+            for k, v in preferences.items()
+        ])
+        return f"alias list:\n{preference_msg}"
+
+
+# 生成MQTT命令数据的命令及其解析函数，签名为 (text, chat_id) -> Dict
+COMMAND_PARSERS = {
+    "copy": CopyCommandParser.parse,
+    "exec": ExecCommandParser.parse,
+    "terminate": lambda text, chat_id: SimpleCommandParser.parse_with_args(
+        "terminate", text, chat_id, "taskid"
+    ),
+    "terminatename": lambda text, chat_id: SimpleCommandParser.parse_with_args(
+        "terminatename", text, chat_id, "taskname"
+    ),
+    "cmdlist": lambda text, chat_id: SimpleCommandParser.parse_query("cmdlist", text, chat_id),
+    "taskidlist": lambda text, chat_id: SimpleCommandParser.parse_query("taskidlist", text, chat_id),
+    "tasklist": lambda text, chat_id: SimpleCommandParser.parse_query("tasklist", text, chat_id),
+    "task": TaskCommandParser.parse,
+}
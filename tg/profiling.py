@@ -0,0 +1,229 @@
+"""性能分析模块
+
+管理员通过/profile命令在运行中的bot上采样分析一段时间，无需重启：
+
+- 采样线程按固定间隔通过sys._current_frames()读取所有其他线程的调用栈，
+  不需要在各线程中安装钩子，已在运行的线程同样被覆盖
+- 平台支持线程CPU时钟（Linux等）时按每个线程两次采样之间消耗的CPU时间加权，
+  等待锁、网络或队列的线程不计入，报告反映CPU占用；否则按采样间隔加权（墙钟时间）
+- 结果按函数汇总为pstats格式，可用 python -m pstats 或snakeviz等工具打开；
+  文本报告列出累计耗时最高的函数
+
+同一时间只运行一个分析。
+"""
+
+import logging
+import marshal
+import os
+import sys
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+
+logger = logging.getLogger(__name__)
+
+# 采样间隔（秒）
+SAMPLE_INTERVAL = 0.005
+# /profile允许的分析时长（秒）
+DEFAULT_PROFILE_SECONDS = 10
+MAX_PROFILE_SECONDS = 300
+# 文本报告列出的函数数
+REPORT_TOP = 20
+
+MODE_CPU = "cpu"
+MODE_WALL = "wall"
+
+# pstats中的函数标识: (文件名, 行号, 函数名)
+FuncKey = Tuple[str, int, str]
+
+
+def _func_key(code) -> FuncKey:
+    return code.co_filename, code.co_firstlineno, code.co_name
+
+
+def _short_path(path: str) -> str:
+    """报告中只保留文件路径的最后两级"""
+    parts = path.replace("\\", "/").split("/")
+    return "/".join(parts[-2:])
+
+
+@dataclass
+class _FuncStats:
+    # 出现在栈中的采样数 / 位于栈顶的耗时 / 累计耗时
+    samples: int = 0
+    tt: float = 0.0
+    ct: float = 0.0
+    # 调用者 -> [采样数, 位于栈顶的耗时, 累计耗时]
+    callers: Dict[FuncKey, List[float]] = field(default_factory=dict)
+
+
+@dataclass
+class ProfileResult:
+    """一次分析的结果"""
+    seconds: float
+    mode: str
+    samples: int
+    functions: Dict[FuncKey, _FuncStats]
+    # 线程名称 -> 耗时（秒）
+    threads: Dict[str, float]
+    
+    @property
+    def total(self) -> float:
+        """所有线程的总耗时（秒）"""
+        return sum(self.threads.values())
+    
+    def dump(self) -> bytes:
+        """以pstats文件格式（marshal）输出，调用次数为采样数"""
+        stats = {}
+        for key, func in self.functions.items():
+            callers = {caller: (int(n), int(n), tt, ct) for caller, (n, tt, ct) in func.callers.items()}
+            stats[key] = (func.samples, func.samples, func.tt, func.ct, callers)
+        return marshal.dumps(stats)
+    
+    def report(self, top: int = REPORT_TOP) -> str:
+        """文本报告：按累计耗时排序的前top个函数及各线程耗时"""
+        total = self.total
+        lines = [f"profile {self.seconds:.0f}s, samples={self.samples}, {self.mode} time={total:.2f}s"]
+        if not self.functions:
+            lines.append("no samples collected")
+            return "\n".join(lines)
+        
+        lines.append("threads: " + ", ".join(
+            f"{name} {spent:.2f}s" for name, spent in sorted(self.threads.items(), key=lambda i: -i[1])[:5]))
+        lines.append("cum s   cum%  self s  function")
+        ranked = sorted(self.functions.items(), key=lambda i: -i[1].ct)[:top]
+        for (filename, lineno, name), func in ranked:
+            percent = func.ct / total * 100 if total else 0.0
+            lines.append(f"{func.ct:6.2f} {percent:5.1f}% {func.tt:6.2f}  "
+                         f"{name} ({_short_path(filename)}:{lineno})")
+        return "\n".join(lines)
+
+
+class SamplingProfiler:
+    """采样分析器"""
+    
+    def __init__(self, interval: float = SAMPLE_INTERVAL):
+        self.interval = interval
+        self._lock = threading.Lock()
+    
+    @property
+    def running(self) -> bool:
+        """是否有分析正在进行"""
+        return self._lock.locked()
+    
+    def profile(self, seconds: float) -> Optional[ProfileResult]:
+        """
+        在调用线程中采样seconds秒，阻塞直到结束
+        
+        Args:
+            seconds: 分析时长（秒）
+        
+        Returns:
+            分析结果，已有分析正在进行时返回None
+        """
+        if not self._lock.acquire(blocking=False):
+            return None
+        try:
+            logger.info("开始性能分析: seconds=%s, interval=%s", seconds, self.interval)
+            started = time.monotonic()
+            result = self._sample(started + seconds)
+            result.seconds = time.monotonic() - started
+            logger.info("性能分析结束: samples=%d, mode=%s, total=%.3fs",
+                        result.samples, result.mode, result.total)
+            return result
+        finally:
+            self._lock.release()
+    
+    def _sample(self, deadline: float) -> ProfileResult:
+        own = threading.get_ident()
+        cpu_clock = hasattr(time, "pthread_getcpuclockid")
+        # 线程ID -> 上次采样时的CPU时间
+        last_cpu: Dict[int, float] = {}
+        functions: Dict[FuncKey, _FuncStats] = {}
+        thread_time: Dict[int, float] = {}
+        samples = 0
+        
+        while time.monotonic() < deadline:
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                if cpu_clock:
+                    try:
+                        spent = time.clock_gettime(time.pthread_getcpuclockid(ident))
+                    except OSError:
+                        # 线程已退出
+                        continue
+                    previous = last_cpu.get(ident)
+                    last_cpu[ident] = spent
+                    if previous is None:
+                        continue
+                    weight = spent - previous
+                    if weight <= 0:
+                        # 两次采样之间没有占用CPU（等待中）
+                        continue
+                else:
+                    weight = self.interval
+                self._record(functions, frame, weight)
+                thread_time[ident] = thread_time.get(ident, 0.0) + weight
+                samples += 1
+            time.sleep(min(self.interval, max(0.0, deadline - time.monotonic())))
+        
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        threads: Dict[str, float] = {}
+        for ident, spent in thread_time.items():
+            name = names.get(ident, str(ident))
+            threads[name] = threads.get(name, 0.0) + spent
+        return ProfileResult(0.0, MODE_CPU if cpu_clock else MODE_WALL, samples, functions, threads)
+    
+    @staticmethod
+    def _record(functions: Dict[FuncKey, _FuncStats], frame, weight: float) -> None:
+        """把一个调用栈计入统计，递归调用的函数在同一采样中只计一次"""
+        stack: List[FuncKey] = []
+        while frame is not None:
+            stack.append(_func_key(frame.f_code))
+            frame = frame.f_back
+        
+        for key in set(stack):
+            func = functions.get(key)
+            if func is None:
+                func = functions[key] = _FuncStats()
+            func.samples += 1
+            func.ct += weight
+        functions[stack[0]].tt += weight
+        
+        # 栈中相邻的(被调用者, 调用者)
+        for index, (callee, caller) in enumerate(dict.fromkeys(zip(stack, stack[1:]))):
+            entry = functions[callee].callers.setdefault(caller, [0, 0.0, 0.0])
+            entry[0] += 1
+            entry[2] += weight
+            if index == 0:
+                entry[1] += weight
+
+
+def profile_file_name() -> str:
+    """pstats文件名"""
+    return f"tg-profile-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}.pstats"
+
+
+def parse_seconds(text: str) -> Optional[int]:
+    """
+    解析/profile命令的时长参数
+    
+    Returns:
+        时长（秒），省略时为默认值；参数不正确时返回None
+    """
+    args = text.split()[1:]
+    if not args:
+        return DEFAULT_PROFILE_SECONDS
+    try:
+        seconds = int(args[0])
+    except ValueError:
+        return None
+    if not 1 <= seconds <= MAX_PROFILE_SECONDS:
+        return None
+    return seconds
+
+
+PROFILER = SamplingProfiler()
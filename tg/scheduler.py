@@ -0,0 +1,453 @@
+"""服务端任务调度模块
+
+设备任务队列只有16个位置（IR.ino的TASK_N）。开启服务端调度（ir_scheduler为server）后，
+带有执行时间、周期、cron或多次执行的exec任务保存在bot端，按下次执行时间放入最小堆，
+到期时以立即执行的exec命令（remain为1）发往设备。
+/tasklist、/taskidlist、/task、/terminate、/terminatename由调度器直接回复，
+回复格式与设备一致，沿用原有的消息处理器。
+
+任务通过存储后端（storage.py）保存，添加、触发、终止时更新，bot重启后恢复，
+停机期间错过的执行按MAX_CATCH_UP规则跳过。已知设备命令列表（cmdlist回复）时，
+添加任务会拒绝设备上不存在的命令名称。
+
+终止任务采用惰性删除：任务从任务表移除，堆中的条目在弹出时跳过，
+失效条目超过一半时重建堆，添加、触发、终止的均摊开销为O(log n)。
+"""
+
+import asyncio
+import heapq
+import itertools
+import logging
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+from cron import CronError, CronPattern, compile_cron
+from storage import StorageBackend
+
+
+logger = logging.getLogger(__name__)
+
+# 调度模式
+MODE_DEVICE = "device"  # 任务保存在设备上（默认）
+MODE_SERVER = "server"  # 任务保存在bot端，到期后发往设备立即执行
+SCHEDULER_MODES = (MODE_DEVICE, MODE_SERVER)
+
+# 由调度器回复的查询与终止命令
+QUERY_COMMANDS = ("tasklist", "taskidlist", "task", "terminate", "terminatename")
+
+# 落后超过该时长（秒）的执行直接跳过，避免bot阻塞恢复后集中补发
+MAX_CATCH_UP = 60
+
+# 没有任务时调度线程的最长等待时间（秒）
+IDLE_WAIT = 60
+
+
+def split_names(text: str) -> List[str]:
+    """按逗号分割exec的命令名称，与IR.ino一致：空串没有名称，末尾的逗号不产生空名称"""
+    names, i = [], 0
+    while i < len(text):
+        j = text.find(",", i)
+        j = len(text) if j < 0 else j
+        names.append(text[i:j])
+        i = j + 1
+    return names
+
+
+def split_tokens(text: str, accept: Callable[[str], bool]) -> List[str]:
+    """按IR.ino的terminate/terminatename规则，提取由accept字符组成的连续片段"""
+    tokens, i, n = [], 0, len(text)
+    while i < n:
+        while i < n and not accept(text[i]):
+            i += 1
+        j = i
+        while j < n and accept(text[j]):
+            j += 1
+        if i < j:
+            tokens.append(text[i:j])
+        i = j
+    return tokens
+
+
+def is_deferred(data: Dict[str, Any]) -> bool:
+    """判断exec命令是否需要进入任务队列（不是立即执行一次）"""
+    return bool(
+        data.get("cron") or data.get("start") or data.get("delay")
+        or int(data.get("remain", 1)) > 1
+    )
+
+
+@dataclass(eq=False)
+class ScheduledTask:
+    """保存在bot端的任务"""
+    taskid: int
+    device_name: str
+    cmd: str
+    chat_id: int
+    # 下次执行时间（Unix时间戳）
+    start: int
+    freq: int
+    remain: int
+    cron: str = ""
+    taskname: str = ""
+    pattern: Optional[CronPattern] = None
+    
+    def to_dict(self) -> Dict[str, Any]:
+        """转换为设备tasklist回复中的任务格式"""
+        return {
+            "taskid": self.taskid,
+            "taskname": self.taskname,
+            "cmd": self.cmd,
+            "xid": "-",
+            "start": self.start,
+            "freq": self.freq,
+            "cron": self.cron,
+            "remain": self.remain,
+        }
+    
+    def to_record(self) -> Dict[str, Any]:
+        """转换为存储后端保存的格式"""
+        return {
+            "taskid": self.taskid,
+            "cmd": self.cmd,
+            "chat_id": self.chat_id,
+            "start": self.start,
+            "freq": self.freq,
+            "remain": self.remain,
+            "cron": self.cron,
+            "taskname": self.taskname,
+        }
+    
+    @classmethod
+    def from_record(cls, device_name: str, record: Dict[str, Any]) -> 'ScheduledTask':
+        """从存储后端的记录恢复任务，cron表达式重新编译"""
+        cron = record.get("cron", "")
+        return cls(
+            int(record["taskid"]), device_name, record["cmd"], record.get("chat_id", 0),
+            int(record["start"]), int(record.get("freq", 0)), int(record.get("remain", 1)),
+            cron, record.get("taskname", ""), compile_cron(cron) if cron else None
+        )
+    
+    def next_start(self, fired: int) -> Optional[int]:
+        """计算本次执行之后的下次执行时间，cron表达式不再匹配时返回None"""
+        if self.pattern is not None:
+            return self.pattern.next_fire(fired)
+        # 与设备一致，周期为0的多次任务每秒执行一次
+        return fired + (self.freq or 1)
+    
+    def resume_at(self, fired: int, now: int) -> Optional[int]:
+        """跳过now之前错过的执行，计算不早于now的下次执行时间"""
+        if self.pattern is not None:
+            return self.pattern.next_fire(now - 1)
+        step = self.freq or 1
+        return fired + (now - fired + step - 1) // step * step
+
+
+class TaskScheduler:
+    """bot端任务调度器"""
+    
+    def __init__(self, publish: Callable[[str, Dict[str, Any]], Any], max_tasks: int = 10000,
+                 storage: Optional[StorageBackend] = None,
+                 known_commands: Optional[Callable[[str], Optional[List[str]]]] = None):
+        """
+        初始化任务调度器
+        
+        Args:
+            publish: 向设备发布命令的函数，参数为设备名称与命令数据
+            max_tasks: 每个设备最多保存的任务数
+            storage: 保存任务的存储后端，为None时任务只保存在内存中
+            known_commands: 获取设备命令名称列表的函数，未知时返回None（不校验）
+        """
+        self.publish = publish
+        self.max_tasks = max_tasks
+        self.storage = storage
+        self.known_commands = known_commands
+        # 设备名称 -> {任务号: 任务}
+        self.tasks: Dict[str, Dict[int, ScheduledTask]] = {}
+        self._next_id: Dict[str, int] = {}
+        # (下次执行时间, 序号, 任务)，序号保证相同时间按加入顺序执行
+        self._heap: List[Tuple[int, int, ScheduledTask]] = []
+        self._seq = itertools.count()
+        self._stale = 0
+        self._lock = threading.Lock()
+        self._changed = threading.Event()
+        if storage is not None:
+            self._restore(storage.load_tasks())
+    
+    def _restore(self, records: Dict[str, List[Dict[str, Any]]]) -> None:
+        """恢复存储后端中保存的任务"""
+        count = 0
+        for device_name, device_records in records.items():
+            tasks = self.tasks.setdefault(device_name, {})
+            for record in device_records:
+                try:
+                    task = ScheduledTask.from_record(device_name, record)
+                except (KeyError, TypeError, ValueError, CronError) as e:
+                    logger.warning("无法恢复任务: %s %s: %s", device_name, record, e)
+                    continue
+                if task.remain <= 0:
+                    continue
+                tasks[task.taskid] = task
+                self._next_id[device_name] = max(self._next_id.get(device_name, 0), task.taskid + 1)
+                self._push(task)
+                count += 1
+        if count:
+            logger.info("已恢复%d个服务端任务", count)
+    
+    # ============ 命令处理 ============
+    
+    def handle(self, device_name: str, data: Dict[str, Any]) -> Optional[List[Dict[str, Any]]]:
+        """
+        处理发往设备的命令
+        
+        Args:
+            device_name: 设备名称
+            data: 命令数据
+        
+        Returns:
+            回复消息列表（格式与设备回复一致）；命令仍需发往设备时返回None
+        """
+        cmd = data.get("cmd")
+        if cmd == "exec":
+            return self._exec(device_name, data) if is_deferred(data) else None
+        if cmd not in QUERY_COMMANDS:
+            return None
+        
+        chat_id = data.get("chat_id", 0)
+        with self._lock:
+            tasks = self.tasks.get(device_name, {})
+            if cmd == "tasklist":
+                return [self._reply(device_name, chat_id, 200, "get tasklist ok",
+                                    tasks=[tasks[i].to_dict() for i in sorted(tasks)])]
+            if cmd == "taskidlist":
+                return [self._reply(device_name, chat_id, 200, "get taskidlist ok", taskids=sorted(tasks))]
+            if cmd == "task":
+                taskid = str(data.get("id", ""))
+                task = tasks.get(int(taskid)) if taskid.isdigit() else None
+                if task is None:
+                    return [self._reply(device_name, chat_id, 400, "illegal task id")]
+                return [self._reply(device_name, chat_id, 200, "get task ok", task=task.to_dict())]
+            if cmd == "terminate":
+                return self._terminate(device_name, chat_id, str(data.get("taskid", "")))
+            return self._terminatename(device_name, chat_id, str(data.get("taskname", "")))
+    
+    def _exec(self, device_name: str, data: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """将exec命令中的每个名称加入任务队列"""
+        chat_id = data.get("chat_id", 0)
+        cron = str(data.get("cron", ""))
+        now = int(time.time())
+        start = int(data.get("start", 0)) or now + int(data.get("delay", 0))
+        remain = int(data.get("remain", 1))
+        pattern = None
+        if cron:
+            try:
+                pattern = compile_cron(cron)
+            except CronError as e:
+                logger.warning("cron表达式错误: %s", e)
+        commands = self.known_commands(device_name) if self.known_commands else None
+        replies = []
+        with self._lock:
+            tasks = self.tasks.setdefault(device_name, {})
+            for offset, name in enumerate(split_names(str(data.get("name", "")))):
+                if commands is not None and name not in commands:
+                    replies.append(self._reply(device_name, chat_id, 400, f"exec failure, cmd name [{name}] not exist!"))
+                    continue
+                if len(tasks) >= self.max_tasks:
+                    replies.append(self._reply(
+                        device_name, chat_id, 400, f"exec failure, tasklist is full, max is {self.max_tasks}"
+                    ))
+                    continue
+                first: Optional[int] = start + offset
+                if cron:
+                    first = pattern.next_fire(now - 1) if pattern else None
+                if first is None:
+                    replies.append(self._reply(device_name, chat_id, 400, f"exec failure, cron expr [{name}] error!"))
+                    continue
+                if remain <= 0:
+                    continue
+                taskid = self._next_id.get(device_name, 0)
+                self._next_id[device_name] = taskid + 1
+                task = tasks[taskid] = ScheduledTask(
+                    taskid, device_name, name, chat_id, first, int(data.get("freq", 0)), remain,
+                    cron, str(data.get("taskname", "")), pattern
+                )
+                self._push(task)
+                self._store(task)
+                replies.append(self._reply(device_name, chat_id, 200, f"add {name} to tasklist"))
+        return replies
+    
+    def _terminate(self, device_name: str, chat_id: int, ids: str) -> List[Dict[str, Any]]:
+        replies = []
+        tasks = self.tasks.get(device_name, {})
+        for token in split_tokens(ids, str.isdigit) or [""]:
+            task = tasks.pop(int(token), None) if token else None
+            if task is None:
+                replies.append(self._reply(device_name, chat_id, 400, "illegal task id"))
+                continue
+            self._discard(task)
+            self._store(task)
+            replies.append(self._reply(device_name, chat_id, 200, f"terminate task {token} ok"))
+        return replies
+    
+    def _terminatename(self, device_name: str, chat_id: int, names: str) -> List[Dict[str, Any]]:
+        replies = []
+        tasks = self.tasks.get(device_name, {})
+        tokens = split_tokens(names, lambda ch: 33 <= ord(ch) <= 126)
+        if not tokens:
+            return [self._reply(device_name, chat_id, 400, "illegal taskname")]
+        for name in tokens:
+            matched = [task for task in tasks.values() if task.taskname == name]
+            for task in matched:
+                del tasks[task.taskid]
+                self._discard(task)
+                self._store(task)
+            if len(matched) == 1:
+                replies.append(self._reply(device_name, chat_id, 200, f"terminate task {name} ok"))
+            elif matched:
+                replies.append(self._reply(device_name, chat_id, 200, f"terminate {len(matched)} tasks {name} ok"))
+        return replies
+    
+    @staticmethod
+    def _reply(device_name: str, chat_id: int, code: int, msg: str, **fields) -> Dict[str, Any]:
+        return {"chat_id": chat_id, "code": code, "message": f"{device_name}: {msg} (server)", **fields}
+    
+    # ============ 调度 ============
+    
+    def _push(self, task: ScheduledTask) -> None:
+        heapq.heappush(self._heap, (task.start, next(self._seq), task))
+        self._changed.set()
+    
+    def _store(self, task: ScheduledTask) -> None:
+        """保存任务的当前状态，已结束或终止的任务从存储后端删除"""
+        if self.storage is None:
+            return
+        try:
+            if task.remain > 0:
+                self.storage.save_task(task.device_name, task.to_record())
+            else:
+                self.storage.delete_task(task.device_name, task.taskid)
+        except Exception as e:
+            logger.error("保存任务失败: %s %s: %s", task.device_name, task.taskid, e)
+    
+    def _discard(self, task: ScheduledTask) -> None:
+        """终止任务，堆中的条目在弹出时跳过；失效条目超过一半时重建堆"""
+        task.remain = 0
+        self._stale += 1
+        if self._stale > len(self._heap) // 2:
+            self._heap = [entry for entry in self._heap if entry[2].remain > 0]
+            heapq.heapify(self._heap)
+            self._stale = 0
+    
+    def next_deadline(self) -> Optional[int]:
+        """获取最近一个任务的执行时间，没有任务时返回None"""
+        with self._lock:
+            return self._heap[0][0] if self._heap else None
+    
+    def pop_due(self, now: Optional[int] = None) -> List[Tuple[str, Dict[str, Any]]]:
+        """
+        取出已到期的任务并安排下次执行
+        
+        Args:
+            now: 当前Unix时间戳，默认为当前时间
+        
+        Returns:
+            (设备名称, 立即执行的exec命令) 列表
+        """
+        now = int(time.time()) if now is None else now
+        due = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                fired, _, task = heapq.heappop(self._heap)
+                if task.remain <= 0:
+                    self._stale = max(0, self._stale - 1)
+                    continue
+                if now - fired > MAX_CATCH_UP:
+                    # 跳过落后太多的执行，从当前时间重新计算，不消耗剩余次数
+                    logger.warning("任务落后%s秒，跳过错过的执行: %s %s", now - fired, task.device_name, task.taskid)
+                    self._reschedule(task, task.resume_at(fired, now))
+                    continue
+                due.append((task.device_name, {
+                    "cmd": "exec",
+                    "name": task.cmd,
+                    "remain": 1,
+                    "taskname": task.taskname,
+                    "chat_id": task.chat_id,
+                }))
+                task.remain -= 1
+                self._reschedule(task, task.next_start(fired) if task.remain > 0 else None)
+        return due
+    
+    def _reschedule(self, task: ScheduledTask, start: Optional[int]) -> None:
+        if start is None:
+            task.remain = 0
+            self.tasks.get(task.device_name, {}).pop(task.taskid, None)
+        else:
+            task.start = start
+            self._push(task)
+        self._store(task)
+    
+    def _wait_timeout(self) -> float:
+        deadline = self.next_deadline()
+        if deadline is None:
+            return IDLE_WAIT
+        return min(max(deadline - time.time(), 0), IDLE_WAIT)
+    
+    def run(self, stopped: threading.Event) -> None:
+        """
+        调度线程主循环，到期的任务通过publish发往设备
+        
+        Args:
+            stopped: 设置后退出循环
+        """
+        while not stopped.is_set():
+            self._changed.wait(self._wait_timeout())
+            self._changed.clear()
+            for device_name, data in self.pop_due():
+                try:
+                    self.publish(device_name, data)
+                except Exception as e:
+                    logger.error("发布到期任务失败: %s %s: %s", device_name, data, e)
+    
+    def get_stats(self) -> Dict[str, int]:
+        """获取每个设备保存的任务数"""
+        with self._lock:
+            return {name: len(tasks) for name, tasks in self.tasks.items()}
+
+
+class AsyncTaskScheduler(TaskScheduler):
+    """异步版本的任务调度器，调度循环作为事件循环中的任务运行"""
+    
+    def __init__(self, publish: Callable[[str, Dict[str, Any]], Awaitable[Any]], max_tasks: int = 10000,
+                 storage: Optional[StorageBackend] = None,
+                 known_commands: Optional[Callable[[str], Optional[List[str]]]] = None):
+        """
+        初始化任务调度器
+        
+        Args:
+            publish: 向设备发布命令的协程函数，参数为设备名称与命令数据
+            max_tasks: 每个设备最多保存的任务数
+            storage: 保存任务的存储后端，为None时任务只保存在内存中
+            known_commands: 获取设备命令名称列表的函数，未知时返回None（不校验）
+        """
+        self._wakeup: Optional[asyncio.Event] = None
+        super().__init__(publish, max_tasks, storage, known_commands)
+    
+    def _push(self, task: ScheduledTask) -> None:
+        super()._push(task)
+        if self._wakeup is not None:
+            self._wakeup.set()
+    
+    async def run(self) -> None:
+        """调度任务主循环（需在事件循环中运行）"""
+        self._wakeup = asyncio.Event()
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self._wait_timeout())
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            for device_name, data in self.pop_due():
+                try:
+                    await self.publish(device_name, data)
+                except Exception as e:
+                    logger.error("发布到期任务失败: %s %s: %s", device_name, data, e)
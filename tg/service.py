@@ -3,29 +3,46 @@
 提供简化的服务类，使用解析器模块处理命令。
 """
 
+import asyncio
 import logging
+import threading
 from typing import Dict, Any, Optional
 import util
 import parsers
+import profiling
+import tracing
+import pagination
+from pagination import Entry
 from config import ConfigManager
 
 
 logger = logging.getLogger(__name__)
 
+START_STICKER = "CAACAgQAAxkBAAICVGYZDg7Fg7hZ96S_Wp9t8O26xxxVAAITAwAC2SNkIbQZSopsDmMTNAQ"
+HELP_STICKER = "CAACAgQAAxkBAAICWGYZDmNki3c5DiCYg9impkXVKXP9AAILAwAC2SNkIZ-71pEOj1BjNAQ"
+
+# /trace无参数时列出的trace数
+TRACES_SHOWN = 10
+
+PROFILE_USAGE = f"usage: /profile [seconds], 1-{profiling.MAX_PROFILE_SECONDS}, default {profiling.DEFAULT_PROFILE_SECONDS}"
+PROFILE_CAPTION = "open with: python -m pstats <file>"
+
 
 class BotService:
     """机器人服务类"""
     
-    def __init__(self, bot, config_manager: ConfigManager):
+    def __init__(self, bot, config_manager: ConfigManager, mqtt_manager=None):
         """
         初始化机器人服务
         
         Args:
             bot: Telegram bot实例
             config_manager: 配置管理器实例
+            mqtt_manager: MQTT客户端管理器，用于在设备列表中显示连接状态，可选
         """
         self.bot = bot
         self.config = config_manager
+        self.mqtt_manager = mqtt_manager
         self.help_text: Optional[str] = None
         self.logger = logging.getLogger(__name__)
     
@@ -35,11 +52,11 @@ class BotService:
         
         Args:
             message: Telegram消息对象
-            
+        
         Returns:
             命令数据字典
         """
-        self.logger.info(f"执行copy命令: user_id={message.from_user.id}, chat_id={message.chat.id}")
+        self.logger.info("执行copy命令: user_id=%s, chat_id=%s", message.from_user.id, message.chat.id)
         return parsers.CopyCommandParser.parse(message.text, message.chat.id)
     
     def exec(self, message) -> Dict[str, Any]:
@@ -48,11 +65,11 @@ class BotService:
         
         Args:
             message: Telegram消息对象
-            
+        
         Returns:
             命令数据字典
         """
-        self.logger.info(f"执行exec命令: user_id={message.from_user.id}, chat_id={message.chat.id}")
+        self.logger.info("执行exec命令: user_id=%s, chat_id=%s", message.from_user.id, message.chat.id)
         return parsers.ExecCommandParser.parse(message.text, message.chat.id)
     
     def terminate(self, message) -> Dict[str, Any]:
@@ -61,11 +78,11 @@ class BotService:
         
         Args:
             message: Telegram消息对象
-            
+        
         Returns:
             命令数据字典
         """
-        self.logger.info(f"执行terminate命令: user_id={message.from_user.id}, chat_id={message.chat.id}")
+        self.logger.info("执行terminate命令: user_id=%s, chat_id=%s", message.from_user.id, message.chat.id)
         return parsers.SimpleCommandParser.parse_with_args(
             "terminate", message.text, message.chat.id, "taskid"
         )
@@ -76,11 +93,11 @@ class BotService:
         
         Args:
             message: Telegram消息对象
-            
+        
         Returns:
             命令数据字典
         """
-        self.logger.info(f"执行terminatename命令: user_id={message.from_user.id}, chat_id={message.chat.id}")
+        self.logger.info("执行terminatename命令: user_id=%s, chat_id=%s", message.from_user.id, message.chat.id)
         return parsers.SimpleCommandParser.parse_with_args(
             "terminatename", message.text, message.chat.id, "taskname"
         )
@@ -91,12 +108,12 @@ class BotService:
         
         Args:
             message: Telegram消息对象
-            
+        
         Returns:
             命令数据字典
         """
-        self.logger.info(f"执行cmdlist命令: user_id={message.from_user.id}, chat_id={message.chat.id}")
-        return parsers.SimpleCommandParser.parse_no_args("cmdlist", message.chat.id)
+        self.logger.info("执行cmdlist命令: user_id=%s, chat_id=%s", message.from_user.id, message.chat.id)
+        return parsers.SimpleCommandParser.parse_query("cmdlist", message.text, message.chat.id)
     
     def taskidlist(self, message) -> Dict[str, Any]:
         """
@@ -104,12 +121,12 @@ class BotService:
         
         Args:
             message: Telegram消息对象
-            
+        
         Returns:
             命令数据字典
         """
-        self.logger.info(f"执行taskidlist命令: user_id={message.from_user.id}, chat_id={message.chat.id}")
-        return parsers.SimpleCommandParser.parse_no_args("taskidlist", message.chat.id)
+        self.logger.info("执行taskidlist命令: user_id=%s, chat_id=%s", message.from_user.id, message.chat.id)
+        return parsers.SimpleCommandParser.parse_query("taskidlist", message.text, message.chat.id)
     
     def tasklist(self, message) -> Dict[str, Any]:
         """
@@ -117,12 +134,12 @@ class BotService:
         
         Args:
             message: Telegram消息对象
-            
+        
         Returns:
             命令数据字典
         """
-        self.logger.info(f"执行tasklist命令: user_id={message.from_user.id}, chat_id={message.chat.id}")
-        return parsers.SimpleCommandParser.parse_no_args("tasklist", message.chat.id)
+        self.logger.info("执行tasklist命令: user_id=%s, chat_id=%s", message.from_user.id, message.chat.id)
+        return parsers.SimpleCommandParser.parse_query("tasklist", message.text, message.chat.id)
     
     def task(self, message) -> Dict[str, Any]:
         """
@@ -130,11 +147,11 @@ class BotService:
         
         Args:
             message: Telegram消息对象
-            
+        
         Returns:
             命令数据字典
         """
-        self.logger.info(f"执行task命令: user_id={message.from_user.id}, chat_id={message.chat.id}")
+        self.logger.info("执行task命令: user_id=%s, chat_id=%s", message.from_user.id, message.chat.id)
         return parsers.TaskCommandParser.parse(message.text, message.chat.id)
     
     def device(self, message) -> None:
@@ -144,24 +161,49 @@ class BotService:
         Args:
             message: Telegram消息对象
         """
-        self.logger.info(f"执行device命令: user_id={message.from_user.id}, chat_id={message.chat.id}")
-        
-        args = [i for i in message.text.split(' ')[1:] if i]
+        self.logger.info("执行device命令: user_id=%s, chat_id=%s", message.from_user.id, message.chat.id)
         
         # 如果有参数，尝试切换设备
-        if len(args) > 0 and args[0] in self.config.devices:
-            if self.config.set_current_device(args[0]):
-                self.bot.reply_to(message, f"device switch to {args[0]}")
+        switched = self._switch_device(message.text)
+        if switched:
+            self.bot.reply_to(message, f"device switch to {switched}")
         
         # 显示设备列表
+        self.bot.reply_to(message, self._device_list_text())
+        
+        self.logger.info("device命令执行成功，当前设备: %s", self.config.get_current_device().name)
+    
+    def _switch_device(self, text: str) -> Optional[str]:
+        """
+        根据device命令参数切换设备
+        
+        Args:
+            text: 命令文本
+        
+        Returns:
+            切换成功的设备名称，未切换返回None
+        """
+        args = [i for i in text.split(' ')[1:] if i]
+        if len(args) > 0 and args[0] in self.config.devices:
+            if self.config.set_current_device(args[0]):
+                return args[0]
+        return None
+    
+    def _device_list_text(self) -> str:
+        """构建设备列表文本"""
         current_device = self.config.get_current_device()
         devices_msg = "\n".join([
-            ("+ " if k == current_device.name else "- ") + k
+            ("+ " if k == current_device.name else "- ") + k + self._device_state_text(k)
             for k in self.config.devices.keys()
         ])
-        self.bot.reply_to(message, f"device list:\n{devices_msg}")
-        
-        self.logger.info(f"device命令执行成功，当前设备: {current_device.name}")
+        return f"device list:\n{devices_msg}"
+    
+    def _device_state_text(self, device_name: str) -> str:
+        """设备未连接时返回状态后缀，已连接或未知时返回空字符串"""
+        if self.mqtt_manager is None:
+            return ""
+        state = self.mqtt_manager.get_state(device_name)
+        return "" if state == "connected" else f" ({state})"
     
     def usermod(self, message) -> None:
         """
@@ -170,15 +212,125 @@ class BotService:
         Args:
             message: Telegram消息对象
         """
-        self.logger.info(f"执行usermod命令: user_id={message.from_user.id}, chat_id={message.chat.id}")
+        self.logger.info("执行usermod命令: user_id=%s, chat_id=%s", message.from_user.id, message.chat.id)
         
         # 检查管理员权限
         if message.chat.id != self.config.env.ir_admin_chat_id:
             self.bot.reply_to(message, "only administrators can operate")
             return
         
+        self._apply_usermod(message.text)
+        
+        # 显示用户列表
+        self.bot.reply_to(message, f"user list:\n{str(self.config.db.user)}")
+        self.logger.info("usermod命令执行成功: 用户权限已修改")
+    
+    def rtt(self, message) -> None:
+        """
+        处理rtt命令（管理员专用），展示各设备的命令往返时延
+        
+        Args:
+            message: Telegram消息对象
+        """
+        self.logger.info("执行rtt命令: user_id=%s, chat_id=%s", message.from_user.id, message.chat.id)
+        
+        if message.chat.id != self.config.env.ir_admin_chat_id:
+            self.bot.reply_to(message, "only administrators can operate")
+            return
+        
+        self.bot.reply_to(message, self._rtt_text())
+    
+    def trace(self, message) -> None:
+        """
+        处理trace命令（管理员专用），展示最近的trace或指定trace的各段耗时
+        
+        Args:
+            message: Telegram消息对象
+        """
+        self.logger.info("执行trace命令: user_id=%s, chat_id=%s", message.from_user.id, message.chat.id)
+        
+        if message.chat.id != self.config.env.ir_admin_chat_id:
+            self.bot.reply_to(message, "only administrators can operate")
+            return
+        
+        self.bot.reply_to(message, **self._trace_reply(message.text))
+    
+    def _trace_reply(self, text: str) -> Dict[str, Any]:
+        """
+        构建trace回复的消息参数：无参数时列出最近的trace，参数为trace ID前缀时展示该trace
+        
+        单个trace超过一页时按span分页，翻页沿用设备列表的翻页缓存
+        """
+        args = text.split()[1:]
+        if not args:
+            return {"text": tracing.format_trace_list(tracing.TRACER.recent(TRACES_SHOWN))}
+        spans = tracing.TRACER.find(args[0])
+        if spans is None:
+            return {"text": f"trace {args[0]} not found"}
+        header, *lines = tracing.trace_lines(spans)
+        pages = pagination.build_pages(header, [Entry(line) for line in lines], max_items=tracing.MAX_SPANS_PER_TRACE)
+        if self.mqtt_manager is None:
+            return pagination.PageCache.page_kwargs(pages[0], None, 0, 1)
+        return self.mqtt_manager.message_router.pages.render(pages)
+    
+    def profile(self, message) -> None:
+        """
+        处理profile命令（管理员专用），在后台线程中采样分析所有线程，
+        结束后发送按累计耗时排序的报告与pstats文件
+        
+        Args:
+            message: Telegram消息对象
+        """
+        self.logger.info("执行profile命令: user_id=%s, chat_id=%s", message.from_user.id, message.chat.id)
+        
+        if message.chat.id != self.config.env.ir_admin_chat_id:
+            self.bot.reply_to(message, "only administrators can operate")
+            return
+        
+        seconds = profiling.parse_seconds(message.text)
+        if seconds is None:
+            self.bot.reply_to(message, PROFILE_USAGE)
+            return
+        if profiling.PROFILER.running:
+            self.bot.reply_to(message, "a profile is already running")
+            return
+        
+        self.bot.reply_to(message, f"profiling all threads for {seconds}s")
+        threading.Thread(target=self._run_profile, args=(message, seconds), name="profiler", daemon=True).start()
+    
+    def _run_profile(self, message, seconds: int) -> None:
+        """采样分析并发送结果（在后台线程中运行）"""
+        result = profiling.PROFILER.profile(seconds)
+        if result is None:
+            self.bot.reply_to(message, "a profile is already running")
+            return
+        self.bot.reply_to(message, result.report())
+        self.bot.send_document(message.chat.id, result.dump(), visible_file_name=profiling.profile_file_name(),
+                               caption=PROFILE_CAPTION)
+    
+    def _rtt_text(self) -> str:
+        """构建各设备往返时延统计文本（毫秒）"""
+        stats = self.mqtt_manager.requests.get_stats() if self.mqtt_manager else {}
+        if not stats:
+            return "no round trip recorded yet"
+        lines = ["device rtt (ms):"]
+        for name, s in sorted(stats.items()):
+            lines.append(
+                f"{name}: n={s['count']} p50={s['p50'] * 1000:.0f} p95={s['p95'] * 1000:.0f} "
+                f"p99={s['p99'] * 1000:.0f} max={s['max'] * 1000:.0f} "
+                f"timeout={s['timeouts']} pending={s.get('pending', 0)}"
+            )
+        return "\n".join(lines)
+    
+    def _apply_usermod(self, text: str) -> None:
+        """
+        解析usermod参数并添加或删除用户
+        
+        Args:
+            text: 命令文本
+        """
         # 解析用户ID
-        candidates = " ".join(message.text.split(' ')[1:])
+        candidates = " ".join(text.split(' ')[1:])
         i = 0
         
         while i < len(candidates):
@@ -203,10 +355,6 @@ class BotService:
                 self.config.remove_user(uid)
             else:
                 self.config.add_user(uid)
-        
-        # 显示用户列表
-        self.bot.reply_to(message, f"user list:\n{str(self.config.db.user)}")
-        self.logger.info("usermod命令执行成功: 用户权限已修改")
     
     def auth(self, message) -> None:
         """
@@ -215,22 +363,32 @@ class BotService:
         Args:
             message: Telegram消息对象
         """
-        self.logger.info(f"执行auth命令: user_id={message.from_user.id}, chat_id={message.chat.id}")
+        self.logger.info("执行auth命令: user_id=%s, chat_id=%s", message.from_user.id, message.chat.id)
         
         # 通知管理员
         self.bot.send_message(
             self.config.env.ir_admin_chat_id,
-            f"{message.from_user.first_name} {message.from_user.last_name} "
-            f"request chat id: {message.chat.id}"
+            self._auth_request_text(message)
         )
         
         # 回复用户
         self.bot.reply_to(message, "your application has been submitted to the administrator")
-        
+        self._log_auth_result(message)
+    
+    @staticmethod
+    def _auth_request_text(message) -> str:
+        """构建发给管理员的授权申请文本"""
+        return (
+            f"{message.from_user.first_name} {message.from_user.last_name} "
+            f"request chat id: {message.chat.id}"
+        )
+    
+    def _log_auth_result(self, message) -> None:
+        """记录申请用户当前的授权状态"""
         if self.config.is_user_authorized(message.chat.id):
-            self.logger.info(f"用户认证成功: user_id={message.from_user.id}")
+            self.logger.info("用户认证成功: user_id=%s", message.from_user.id)
         else:
-            self.logger.warning(f"用户认证失败: user_id={message.from_user.id}")
+            self.logger.warning("用户认证失败: user_id=%s", message.from_user.id)
     
     def start(self, message) -> None:
         """
@@ -239,11 +397,11 @@ class BotService:
         Args:
             message: Telegram消息对象
         """
-        self.logger.info(f"执行start命令: user_id={message.from_user.id}, chat_id={message.chat.id}")
+        self.logger.info("执行start命令: user_id=%s, chat_id=%s", message.from_user.id, message.chat.id)
         
         self.bot.send_sticker(
             chat_id=message.chat.id,
-            sticker="CAACAgQAAxkBAAICVGYZDg7Fg7hZ96S_Wp9t8O26xxxVAAITAwAC2SNkIbQZSopsDmMTNAQ",
+            sticker=START_STICKER,
             reply_to_message_id=message.id
         )
         
@@ -256,17 +414,175 @@ class BotService:
         Args:
             message: Telegram消息对象
         """
-        self.logger.info(f"执行help命令: user_id={message.from_user.id}, chat_id={message.chat.id}")
+        self.logger.info("执行help命令: user_id=%s, chat_id=%s", message.from_user.id, message.chat.id)
         
         self.bot.send_sticker(
             chat_id=message.chat.id,
-            sticker="CAACAgQAAxkBAAICWGYZDmNki3c5DiCYg9impkXVKXP9AAILAwAC2SNkIZ-71pEOj1BjNAQ",
+            sticker=HELP_STICKER,
             reply_to_message_id=message.id
         )
         
-        # 懒加载帮助文本
+        self.bot.send_message(message.chat.id, self._get_help_text(), parse_mode="Markdown")
+        self.logger.debug("help命令执行完成")
+    
+    def _get_help_text(self) -> str:
+        """懒加载帮助文本"""
         if not self.help_text:
             self.help_text = util.load_help()
+        return self.help_text
+
+
+class AsyncBotService(BotService):
+    """异步机器人服务类
+    
+    命令解析方法（copy、exec等）不涉及I/O，直接复用同步实现；
+    需要与Telegram交互的方法改为协程，配合AsyncTeleBot使用。
+    """
+    
+    async def device(self, message) -> None:
+        """
+        处理device命令
         
-        self.bot.send_message(message.chat.id, self.help_text, parse_mode="Markdown")
-        self.logger.debug("help命令执行完成")
+        Args:
+            message: Telegram消息对象
+        """
+        self.logger.info("执行device命令: user_id=%s, chat_id=%s", message.from_user.id, message.chat.id)
+        
+        switched = self._switch_device(message.text)
+        if switched:
+            await self.bot.reply_to(message, f"device switch to {switched}")
+        
+        await self.bot.reply_to(message, self._device_list_text())
+        
+        self.logger.info("device命令执行成功，当前设备: %s", self.config.get_current_device().name)
+    
+    async def usermod(self, message) -> None:
+        """
+        处理usermod命令（管理员专用）
+        
+        Args:
+            message: Telegram消息对象
+        """
+        self.logger.info("执行usermod命令: user_id=%s, chat_id=%s", message.from_user.id, message.chat.id)
+        
+        if message.chat.id != self.config.env.ir_admin_chat_id:
+            await self.bot.reply_to(message, "only administrators can operate")
+            return
+        
+        self._apply_usermod(message.text)
+        
+        await self.bot.reply_to(message, f"user list:\n{str(self.config.db.user)}")
+        self.logger.info("usermod命令执行成功: 用户权限已修改")
+    
+    async def rtt(self, message) -> None:
+        """
+        处理rtt命令（管理员专用），展示各设备的命令往返时延
+        
+        Args:
+            message: Telegram消息对象
+        """
+        self.logger.info("执行rtt命令: user_id=%s, chat_id=%s", message.from_user.id, message.chat.id)
+        
+        if message.chat.id != self.config.env.ir_admin_chat_id:
+            await self.bot.reply_to(message, "only administrators can operate")
+            return
+        
+        await self.bot.reply_to(message, self._rtt_text())
+    
+    async def trace(self, message) -> None:
+        """
+        处理trace命令（管理员专用），展示最近的trace或指定trace的各段耗时
+        
+        Args:
+            message: Telegram消息对象
+        """
+        self.logger.info("执行trace命令: user_id=%s, chat_id=%s", message.from_user.id, message.chat.id)
+        
+        if message.chat.id != self.config.env.ir_admin_chat_id:
+            await self.bot.reply_to(message, "only administrators can operate")
+            return
+        
+        await self.bot.reply_to(message, **self._trace_reply(message.text))
+    
+    async def profile(self, message) -> None:
+        """
+        处理profile命令（管理员专用），在线程池中采样分析所有线程，
+        结束后发送按累计耗时排序的报告与pstats文件
+        
+        Args:
+            message: Telegram消息对象
+        """
+        self.logger.info("执行profile命令: user_id=%s, chat_id=%s", message.from_user.id, message.chat.id)
+        
+        if message.chat.id != self.config.env.ir_admin_chat_id:
+            await self.bot.reply_to(message, "only administrators can operate")
+            return
+        
+        seconds = profiling.parse_seconds(message.text)
+        if seconds is None:
+            await self.bot.reply_to(message, PROFILE_USAGE)
+            return
+        if profiling.PROFILER.running:
+            await self.bot.reply_to(message, "a profile is already running")
+            return
+        
+        await self.bot.reply_to(message, f"profiling all threads for {seconds}s")
+        # 分析期间不占用当前更新的处理
+        asyncio.create_task(self._run_profile(message, seconds), name="profiler")
+    
+    async def _run_profile(self, message, seconds: int) -> None:
+        """采样分析并发送结果"""
+        result = await asyncio.to_thread(profiling.PROFILER.profile, seconds)
+        if result is None:
+            await self.bot.reply_to(message, "a profile is already running")
+            return
+        await self.bot.reply_to(message, result.report())
+        await self.bot.send_document(message.chat.id, result.dump(), visible_file_name=profiling.profile_file_name(),
+                                     caption=PROFILE_CAPTION)
+    
+    async def auth(self, message) -> None:
+        """
+        处理auth命令（用户请求授权）
+        
+        Args:
+            message: Telegram消息对象
+        """
+        self.logger.info("执行auth命令: user_id=%s, chat_id=%s", message.from_user.id, message.chat.id)
+        
+        await self.bot.send_message(
+            self.config.env.ir_admin_chat_id,
+            self._auth_request_text(message)
+        )
+        await self.bot.reply_to(message, "your application has been submitted to the administrator")
+        self._log_auth_result(message)
+    
+    async def start(self, message) -> None:
+        """
+        处理start命令
+        
+        Args:
+            message: Telegram消息对象
+        """
+        self.logger.info("执行start命令: user_id=%s, chat_id=%s", message.from_user.id, message.chat.id)
+        
+        await self.bot.send_sticker(
+            chat_id=message.chat.id,
+            sticker=START_STICKER,
+            reply_to_message_id=message.id
+        )
+    
+    async def help(self, message) -> None:
+        """
+        处理help命令
+        
+        Args:
+            message: Telegram消息对象
+        """
+        self.logger.info("执行help命令: user_id=%s, chat_id=%s", message.from_user.id, message.chat.id)
+        
+        await self.bot.send_sticker(
+            chat_id=message.chat.id,
+            sticker=HELP_STICKER,
+            reply_to_message_id=message.id
+        )
+        await self.bot.send_message(message.chat.id, self._get_help_text(), parse_mode="Markdown")
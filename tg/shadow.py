@@ -0,0 +1,176 @@
+"""设备状态影子模块
+
+在bot端缓存每个设备最近一次的cmds、tasks、taskids回复。在有效期内的
+cmdlist、tasklist、taskidlist查询直接用缓存回复，不再经MQTT往返设备。
+
+以下情况使缓存失效：
+
+- bot发往设备的copy（cmds）、exec与terminate/terminatename（tasks、taskids），
+  批量帧按其中每条命令处理
+- 设备上报的定时任务执行通知（tasks、taskids）与录制完成通知（cmds）
+
+查询命令带--fresh参数时跳过缓存，直接查询设备。
+
+此外记录设备最近一次cmdlist回复中的命令名称（不受有效期限制，随cmds失效），
+服务端调度据此拒绝设备上不存在的命令。
+"""
+
+import logging
+import re
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+import batch
+
+
+logger = logging.getLogger(__name__)
+
+# 查询命令 -> 回复中的数据字段
+QUERY_FIELDS = {
+    "cmdlist": "cmds",
+    "tasklist": "tasks",
+    "taskidlist": "taskids",
+}
+
+# 发往设备的命令 -> 失效的数据字段
+INVALIDATED_BY = {
+    "copy": ("cmds",),
+    "exec": ("tasks", "taskids"),
+    "terminate": ("tasks", "taskids"),
+    "terminatename": ("tasks", "taskids"),
+}
+
+# 查询命令中表示跳过缓存的字段，发布前移除
+FRESH_KEY = "fresh"
+FRESH_FLAG = "--fresh"
+
+# 设备主动上报的状态变化通知，消息格式为 "<设备名>: <内容> [RunTime: ...]"
+_NOTIFICATIONS = (
+    (re.compile(r"^[^:]*: exec .* success \[RunTime"), ("tasks", "taskids")),
+    (re.compile(r"^[^:]*: copy \[.*\] success"), ("cmds",)),
+)
+
+
+class DeviceShadow:
+    """设备状态影子"""
+    
+    def __init__(self, ttl: float = 30):
+        """
+        初始化设备状态影子
+        
+        Args:
+            ttl: 缓存有效期（秒），为0时不使用缓存
+        """
+        self.ttl = ttl
+        # (设备名称, 数据字段) -> (设备回复, 接收时间)
+        self._entries: Dict[Tuple[str, str], Tuple[Dict[str, Any], float]] = {}
+        # 设备名称 -> 命令名称列表
+        self._commands: Dict[str, List[str]] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+    
+    def update(self, device_name: Optional[str], message: Dict[str, Any]) -> None:
+        """
+        记录设备回复，处理设备上报的状态变化通知
+        
+        Args:
+            device_name: 设备名称
+            message: 设备回复
+        """
+        if device_name is None:
+            return
+        if message.get("code", 200) == 200 and isinstance(message.get("cmds"), list):
+            with self._lock:
+                self._commands[device_name] = [str(name) for name in message["cmds"]]
+        if self.ttl <= 0:
+            return
+        if message.get("code", 200) == 200:
+            for field in QUERY_FIELDS.values():
+                if field in message:
+                    with self._lock:
+                        self._entries[(device_name, field)] = (message, time.monotonic())
+                    return
+        text = message.get("message", "")
+        for pattern, fields in _NOTIFICATIONS:
+            if pattern.match(text):
+                self.invalidate(device_name, fields)
+                return
+    
+    def invalidate(self, device_name: str, fields: Iterable[str]) -> None:
+        """
+        使设备的缓存失效
+        
+        Args:
+            device_name: 设备名称
+            fields: 数据字段
+        """
+        with self._lock:
+            for field in fields:
+                self._entries.pop((device_name, field), None)
+                if field == "cmds":
+                    self._commands.pop(device_name, None)
+    
+    def known_commands(self, device_name: str) -> Optional[List[str]]:
+        """
+        获取设备最近一次cmdlist回复中的命令名称
+        
+        Args:
+            device_name: 设备名称
+        
+        Returns:
+            命令名称列表，尚未查询过或已失效时返回None
+        """
+        with self._lock:
+            return self._commands.get(device_name)
+    
+    def note_publish(self, device_name: str, data: Dict[str, Any]) -> None:
+        """
+        根据bot发往设备的命令使缓存失效
+        
+        Args:
+            device_name: 设备名称
+            data: 命令数据，可以是批量帧
+        """
+        if data.get("cmd") == batch.BATCH_CMD:
+            for item in data.get("items", []):
+                self.note_publish(device_name, item)
+            return
+        fields = INVALIDATED_BY.get(data.get("cmd"))
+        if fields:
+            self.invalidate(device_name, fields)
+    
+    def lookup(self, device_name: str, data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """
+        用缓存回复查询命令
+        
+        Args:
+            device_name: 设备名称
+            data: 查询命令数据
+        
+        Returns:
+            以缓存构造的设备回复（chat_id替换为本次查询的聊天），
+            不是查询命令、带--fresh参数或缓存不可用时返回None
+        """
+        field = QUERY_FIELDS.get(data.get("cmd"))
+        if field is None or data.get(FRESH_KEY) or self.ttl <= 0:
+            return None
+        with self._lock:
+            entry = self._entries.get((device_name, field))
+        if entry is None or time.monotonic() - entry[1] > self.ttl:
+            self.misses += 1
+            return None
+        self.hits += 1
+        message, received = entry
+        reply = dict(message)
+        reply["chat_id"] = data["chat_id"]
+        reply["message"] = f'{message.get("message", "")} (cached {time.monotonic() - received:.0f}s ago)'
+        logger.debug("查询命中设备影子: device=%s, cmd=%s", device_name, data.get("cmd"))
+        return reply
+    
+    @staticmethod
+    def strip(data: Dict[str, Any]) -> Dict[str, Any]:
+        """移除仅供bot使用的字段，返回发往设备的命令数据"""
+        if FRESH_KEY not in data:
+            return data
+        return {k: v for k, v in data.items() if k != FRESH_KEY}
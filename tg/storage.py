@@ -0,0 +1,469 @@
+"""数据库存储后端模块
+
+ConfigManager通过存储后端持久化授权用户、当前设备和各设备的别名偏好；
+服务端调度模式下任务调度器也通过同一后端保存任务，bot重启后恢复。
+
+- JsonStorage: 默认后端，整份数据保存在db.json中，修改后延迟合并写入
+- SQLiteStorage: 使用WAL模式的SQLite数据库，按行更新，适合用户和别名较多的场景，
+  首次启动时自动从已有的db.json迁移数据
+"""
+
+import copy
+import json
+import logging
+import os
+import sqlite3
+import threading
+from typing import Any, Dict, List, Optional
+import util
+
+
+logger = logging.getLogger(__name__)
+
+STORAGE_JSON = "json"
+STORAGE_SQLITE = "sqlite"
+STORAGE_BACKENDS = (STORAGE_JSON, STORAGE_SQLITE)
+
+# JSON后端修改后延迟写入的秒数，期间的多次修改合并为一次写入
+FLUSH_DELAY = 1.0
+
+
+class StorageBackend:
+    """存储后端基类
+    
+    load返回与db.json相同结构的字典：
+    {"device": {...}, "user": [...], "preference": {device: {alias: [cmd, ...]}}}，
+    缺失的键由ConfigManager补充默认值。
+    """
+    
+    def load(self) -> Dict[str, Any]:
+        """加载全部数据"""
+        raise NotImplementedError
+    
+    def save_all(self, data: Dict[str, Any]) -> None:
+        """整体覆盖保存全部数据"""
+        raise NotImplementedError
+    
+    def set_device(self, device: Dict[str, Any]) -> None:
+        """保存当前设备配置，并确保该设备的偏好设置存在"""
+        raise NotImplementedError
+    
+    def add_user(self, chat_id: int) -> None:
+        """添加授权用户"""
+        raise NotImplementedError
+    
+    def remove_user(self, chat_id: int) -> None:
+        """移除授权用户"""
+        raise NotImplementedError
+    
+    def set_alias(self, device_name: str, alias: str, commands: List[str]) -> None:
+        """新增或更新别名"""
+        raise NotImplementedError
+    
+    def delete_alias(self, device_name: str, alias: str) -> None:
+        """删除别名"""
+        raise NotImplementedError
+    
+    def set_preferences(self, device_name: str, preferences: Dict[str, List[str]]) -> None:
+        """整体替换设备的别名偏好"""
+        raise NotImplementedError
+    
+    def load_tasks(self) -> Dict[str, List[Dict[str, Any]]]:
+        """加载服务端调度的任务: {设备名称: [任务, ...]}"""
+        raise NotImplementedError
+    
+    def save_task(self, device_name: str, task: Dict[str, Any]) -> None:
+        """新增或更新服务端调度的任务，按(设备, taskid)唯一"""
+        raise NotImplementedError
+    
+    def delete_task(self, device_name: str, taskid: int) -> None:
+        """删除服务端调度的任务"""
+        raise NotImplementedError
+    
+    def flush(self) -> None:
+        """写入尚未持久化的修改"""
+    
+    def close(self) -> None:
+        """写入尚未持久化的修改并释放资源"""
+        self.flush()
+
+
+class JsonStorage(StorageBackend):
+    """JSON文件存储后端（默认）"""
+    
+    def __init__(self, db_file: str = util.DBFILE, flush_delay: float = FLUSH_DELAY):
+        """
+        初始化JSON存储后端
+        
+        Args:
+            db_file: 数据库文件路径
+            flush_delay: 延迟写入的秒数
+        """
+        self.db_file = db_file
+        self.flush_delay = flush_delay
+        self.data: Dict[str, Any] = {}
+        self._lock = threading.RLock()
+        self._dirty = False
+        self._timer: Optional[threading.Timer] = None
+    
+    def load(self) -> Dict[str, Any]:
+        with self._lock:
+            self.data = util.load_dict(self.db_file)
+            # 返回副本，避免调用方的修改与后端数据互相影响
+            return copy.deepcopy(self.data)
+    
+    def save_all(self, data: Dict[str, Any]) -> None:
+        with self._lock:
+            # 任务由调度器单独保存，整体覆盖时保留
+            tasks = self.data.get("tasks")
+            self.data = copy.deepcopy(data)
+            if tasks is not None:
+                self.data.setdefault("tasks", tasks)
+            self._mark_dirty()
+    
+    def set_device(self, device: Dict[str, Any]) -> None:
+        with self._lock:
+            self.data["device"] = dict(device)
+            self.data.setdefault("preference", {}).setdefault(device["name"], {})
+            self._mark_dirty()
+    
+    def add_user(self, chat_id: int) -> None:
+        with self._lock:
+            users = self.data.setdefault("user", [])
+            if chat_id not in users:
+                users.append(chat_id)
+                self._mark_dirty()
+    
+    def remove_user(self, chat_id: int) -> None:
+        with self._lock:
+            users = self.data.setdefault("user", [])
+            if chat_id in users:
+                users.remove(chat_id)
+                self._mark_dirty()
+    
+    def set_alias(self, device_name: str, alias: str, commands: List[str]) -> None:
+        with self._lock:
+            self._preferences(device_name)[alias] = list(commands)
+            self._mark_dirty()
+    
+    def delete_alias(self, device_name: str, alias: str) -> None:
+        with self._lock:
+            if self._preferences(device_name).pop(alias, None) is not None:
+                self._mark_dirty()
+    
+    def set_preferences(self, device_name: str, preferences: Dict[str, List[str]]) -> None:
+        with self._lock:
+            self.data.setdefault("preference", {})[device_name] = copy.deepcopy(preferences)
+            self._mark_dirty()
+    
+    def load_tasks(self) -> Dict[str, List[Dict[str, Any]]]:
+        with self._lock:
+            return {
+                device_name: [copy.deepcopy(task) for task in tasks.values()]
+                for device_name, tasks in self.data.get("tasks", {}).items()
+            }
+    
+    def save_task(self, device_name: str, task: Dict[str, Any]) -> None:
+        with self._lock:
+            self.data.setdefault("tasks", {}).setdefault(device_name, {})[str(task["taskid"])] = dict(task)
+            self._mark_dirty()
+    
+    def delete_task(self, device_name: str, taskid: int) -> None:
+        with self._lock:
+            if self.data.get("tasks", {}).get(device_name, {}).pop(str(taskid), None) is not None:
+                self._mark_dirty()
+    
+    def _preferences(self, device_name: str) -> Dict[str, List[str]]:
+        return self.data.setdefault("preference", {}).setdefault(device_name, {})
+    
+    def _mark_dirty(self) -> None:
+        """标记为脏，并在flush_delay秒后合并写入"""
+        self._dirty = True
+        if self._timer is None:
+            self._timer = threading.Timer(self.flush_delay, self.flush)
+            self._timer.daemon = True
+            self._timer.start()
+    
+    def flush(self) -> None:
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if not self._dirty:
+                return
+            try:
+                util.save_dict(self.db_file, self.data)
+            except OSError as e:
+                # 保留脏标记，下次修改或退出时重试
+                logger.error("数据库配置保存失败: %s", e)
+                return
+            self._dirty = False
+        logger.debug("数据库配置已保存")
+
+
+class SQLiteStorage(StorageBackend):
+    """SQLite存储后端
+    
+    表结构：
+    - users: 授权用户
+    - devices: 有偏好设置的设备，current=1的行为当前设备
+    - aliases: 别名，按(device, alias)唯一，按插入顺序展示
+    - tasks: 服务端调度的任务，按(device, taskid)唯一
+    - meta: 模式版本与迁移记录
+    """
+    
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS users (
+            chat_id INTEGER PRIMARY KEY
+        );
+        CREATE TABLE IF NOT EXISTS devices (
+            name TEXT PRIMARY KEY,
+            config TEXT,
+            current INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE INDEX IF NOT EXISTS idx_devices_current ON devices(current);
+        CREATE TABLE IF NOT EXISTS aliases (
+            device TEXT NOT NULL,
+            alias TEXT NOT NULL,
+            commands TEXT NOT NULL,
+            PRIMARY KEY (device, alias)
+        );
+        CREATE TABLE IF NOT EXISTS tasks (
+            device TEXT NOT NULL,
+            taskid INTEGER NOT NULL,
+            task TEXT NOT NULL,
+            PRIMARY KEY (device, taskid)
+        );
+    """
+    SCHEMA_VERSION = "2"
+    
+    def __init__(self, sqlite_file: str, json_file: Optional[str] = util.DBFILE):
+        """
+        初始化SQLite存储后端
+        
+        Args:
+            sqlite_file: SQLite数据库文件路径
+            json_file: 需要迁移的db.json路径，数据库为空且该文件存在时迁移一次
+        """
+        self.sqlite_file = sqlite_file
+        self._lock = threading.RLock()
+        # 连接在多个线程（Telegram轮询、MQTT工作线程）间共享，由_lock串行化
+        self.conn = sqlite3.connect(sqlite_file, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(self.SCHEMA)
+        self._set_meta("schema_version", self.SCHEMA_VERSION)
+        
+        if json_file:
+            self._migrate(json_file)
+    
+    def _migrate(self, json_file: str) -> None:
+        """从db.json一次性迁移数据"""
+        if self._get_meta("initialized") is not None or not os.path.exists(json_file):
+            return
+        
+        data = util.load_dict(json_file)
+        tasks = data.get("tasks", {})
+        with self._lock, self._transaction():
+            self.save_all(data)
+            # 服务端调度的任务不属于save_all的数据，在同一事务中迁移
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO tasks (device, taskid, task) VALUES (?, ?, ?)",
+                [(device_name, task["taskid"], json.dumps(task))
+                 for device_name, device_tasks in tasks.items() for task in device_tasks.values()]
+            )
+            self._set_meta("migrated_from", os.path.abspath(json_file))
+        logger.info(
+            "已从 %s 迁移数据到 %s: 用户数=%s, 设备数=%s, 任务数=%s",
+            json_file, self.sqlite_file, len(data.get('user', [])), len(data.get('preference', {})),
+            sum(len(device_tasks) for device_tasks in tasks.values())
+        )
+    
+    def _get_meta(self, key: str) -> Optional[str]:
+        row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+    
+    def _set_meta(self, key: str, value: str) -> None:
+        with self._lock:
+            self.conn.execute(
+                "INSERT INTO meta (key, value) VALUES (?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                (key, value)
+            )
+    
+    def load(self) -> Dict[str, Any]:
+        with self._lock:
+            data: Dict[str, Any] = {}
+            
+            users = self.conn.execute("SELECT chat_id FROM users ORDER BY rowid").fetchall()
+            if users or self._get_meta("initialized") is not None:
+                data["user"] = [row[0] for row in users]
+            
+            preference: Dict[str, Dict[str, List[str]]] = {}
+            for name, config, current in self.conn.execute(
+                "SELECT name, config, current FROM devices ORDER BY rowid"
+            ):
+                preference[name] = {}
+                if current and config:
+                    data["device"] = json.loads(config)
+            for device, alias, commands in self.conn.execute(
+                "SELECT device, alias, commands FROM aliases ORDER BY rowid"
+            ):
+                preference.setdefault(device, {})[alias] = json.loads(commands)
+            if preference:
+                data["preference"] = preference
+            
+            return data
+    
+    def save_all(self, data: Dict[str, Any]) -> None:
+        with self._lock, self._transaction():
+            self.conn.execute("DELETE FROM users")
+            self.conn.execute("DELETE FROM devices")
+            self.conn.execute("DELETE FROM aliases")
+            
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO users (chat_id) VALUES (?)",
+                [(chat_id,) for chat_id in data.get("user", [])]
+            )
+            for name, aliases in data.get("preference", {}).items():
+                self.conn.execute("INSERT INTO devices (name) VALUES (?)", (name,))
+                self.conn.executemany(
+                    "INSERT INTO aliases (device, alias, commands) VALUES (?, ?, ?)",
+                    [(name, alias, json.dumps(cmds)) for alias, cmds in aliases.items()]
+                )
+            if "device" in data:
+                self._set_device(data["device"])
+            self._set_meta("initialized", "1")
+    
+    def set_device(self, device: Dict[str, Any]) -> None:
+        with self._lock, self._transaction():
+            self._set_device(device)
+    
+    def _set_device(self, device: Dict[str, Any]) -> None:
+        self.conn.execute("UPDATE devices SET current = 0 WHERE current = 1")
+        self.conn.execute(
+            "INSERT INTO devices (name, config, current) VALUES (?, ?, 1) "
+            "ON CONFLICT(name) DO UPDATE SET config = excluded.config, current = 1",
+            (device["name"], json.dumps(device))
+        )
+    
+    def add_user(self, chat_id: int) -> None:
+        with self._lock:
+            self.conn.execute("INSERT OR IGNORE INTO users (chat_id) VALUES (?)", (chat_id,))
+    
+    def remove_user(self, chat_id: int) -> None:
+        with self._lock:
+            self.conn.execute("DELETE FROM users WHERE chat_id = ?", (chat_id,))
+    
+    def set_alias(self, device_name: str, alias: str, commands: List[str]) -> None:
+        with self._lock, self._transaction():
+            self.conn.execute("INSERT OR IGNORE INTO devices (name) VALUES (?)", (device_name,))
+            self.conn.execute(
+                "INSERT INTO aliases (device, alias, commands) VALUES (?, ?, ?) "
+                "ON CONFLICT(device, alias) DO UPDATE SET commands = excluded.commands",
+                (device_name, alias, json.dumps(commands))
+            )
+    
+    def delete_alias(self, device_name: str, alias: str) -> None:
+        with self._lock:
+            self.conn.execute(
+                "DELETE FROM aliases WHERE device = ? AND alias = ?", (device_name, alias)
+            )
+    
+    def set_preferences(self, device_name: str, preferences: Dict[str, List[str]]) -> None:
+        """只写入与数据库中不同的别名"""
+        with self._lock, self._transaction():
+            self.conn.execute("INSERT OR IGNORE INTO devices (name) VALUES (?)", (device_name,))
+            stored = dict(self.conn.execute(
+                "SELECT alias, commands FROM aliases WHERE device = ?", (device_name,)
+            ).fetchall())
+            
+            removed = [(device_name, alias) for alias in stored if alias not in preferences]
+            changed = [
+                (device_name, alias, encoded)
+                for alias, encoded in (
+                    (alias, json.dumps(cmds)) for alias, cmds in preferences.items()
+                )
+                if stored.get(alias) != encoded
+            ]
+            self.conn.executemany("DELETE FROM aliases WHERE device = ? AND alias = ?", removed)
+            self.conn.executemany(
+                "INSERT INTO aliases (device, alias, commands) VALUES (?, ?, ?) "
+                "ON CONFLICT(device, alias) DO UPDATE SET commands = excluded.commands",
+                changed
+            )
+    
+    def load_tasks(self) -> Dict[str, List[Dict[str, Any]]]:
+        with self._lock:
+            tasks: Dict[str, List[Dict[str, Any]]] = {}
+            for device, task in self.conn.execute("SELECT device, task FROM tasks ORDER BY device, taskid"):
+                tasks.setdefault(device, []).append(json.loads(task))
+            return tasks
+    
+    def save_task(self, device_name: str, task: Dict[str, Any]) -> None:
+        with self._lock:
+            self.conn.execute(
+                "INSERT INTO tasks (device, taskid, task) VALUES (?, ?, ?) "
+                "ON CONFLICT(device, taskid) DO UPDATE SET task = excluded.task",
+                (device_name, task["taskid"], json.dumps(task))
+            )
+    
+    def delete_task(self, device_name: str, taskid: int) -> None:
+        with self._lock:
+            self.conn.execute("DELETE FROM tasks WHERE device = ? AND taskid = ?", (device_name, taskid))
+    
+    def _transaction(self) -> '_Transaction':
+        """
+        事务上下文，autocommit模式下显式BEGIN，正常结束提交、异常回滚
+        
+        需在持有_lock时使用；嵌套使用时只有最外层生效。
+        """
+        return _Transaction(self.conn)
+    
+    def close(self) -> None:
+        with self._lock:
+            self.conn.close()
+
+
+class _Transaction:
+    """SQLite事务上下文"""
+    
+    def __init__(self, conn: sqlite3.Connection):
+        self.conn = conn
+        self.outer = False
+    
+    def __enter__(self) -> sqlite3.Connection:
+        if not self.conn.in_transaction:
+            self.conn.execute("BEGIN")
+            self.outer = True
+        return self.conn
+    
+    def __exit__(self, exc_type, exc, tb) -> None:
+        if not self.outer:
+            return
+        if exc_type is None:
+            self.conn.execute("COMMIT")
+        else:
+            self.conn.execute("ROLLBACK")
+
+
+def create_storage(kind: str, db_file: str = util.DBFILE, sqlite_file: str = "db.sqlite3",
+                   flush_delay: float = FLUSH_DELAY) -> StorageBackend:
+    """
+    创建存储后端
+    
+    Args:
+        kind: 后端类型，见STORAGE_BACKENDS
+        db_file: JSON数据库文件路径，SQLite后端首次启动时从此文件迁移
+        sqlite_file: SQLite数据库文件路径
+        flush_delay: JSON后端延迟写入的秒数
+    """
+    if kind == STORAGE_JSON:
+        return JsonStorage(db_file, flush_delay)
+    if kind == STORAGE_SQLITE:
+        return SQLiteStorage(sqlite_file, db_file)
+    raise ValueError(f"未知的存储后端: {kind}")
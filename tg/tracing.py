@@ -0,0 +1,314 @@
+"""链路追踪模块
+
+一条命令从收到Telegram更新到设备回复再到发出回复消息，经过多个线程或协程。
+每一段处理记录为一个span，同一条命令的span共享trace ID：
+
+- telegram.update  分发器收到更新（根span），记录更新在Telegram端等待的秒数
+- auth.check / command.parse  权限检查与命令解析
+- mqtt.publish  发往设备，按(设备, rid)记录所属trace
+- device.reply  设备回复到达消息路由器，按回复中的rid找回所属trace；
+  找不到时（设备主动上报）作为新trace的根span
+- telegram.<方法>  出站调度器实际调用Telegram API
+
+当前span保存在contextvars中，同一线程或协程内自动继承；跨线程的出站消息在排队时
+记下当前span。没有父span的非根span不记录，不会产生孤立的trace。
+
+最近的trace保存在内存中供/trace命令查看，可选地以JSON lines或OTLP JSON格式写入文件，
+写入在后台线程中进行。
+"""
+
+import contextvars
+import json
+import logging
+import queue
+import random
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+
+logger = logging.getLogger(__name__)
+
+TRACE_FORMAT_JSON = "json"
+TRACE_FORMAT_OTLP = "otlp"
+TRACE_FORMATS = (TRACE_FORMAT_JSON, TRACE_FORMAT_OTLP)
+
+# 内存中保留的trace数与每个trace最多记录的span数
+MAX_TRACES = 256
+MAX_SPANS_PER_TRACE = 64
+# 记录的(设备, rid) -> trace数，设备回复到达后仍保留（一条命令可能有多个回复）
+MAX_LINKS = 1024
+
+SERVICE_NAME = "tg-ircs"
+
+
+@dataclass(frozen=True)
+class SpanContext:
+    """span的标识，用于关联父子span"""
+    trace_id: str
+    span_id: str
+
+
+@dataclass
+class Span:
+    """一段处理"""
+    name: str
+    context: SpanContext
+    parent_id: Optional[str]
+    start_ns: int
+    end_ns: int = 0
+    attributes: Dict[str, Any] = field(default_factory=dict)
+    error: Optional[str] = None
+    
+    @property
+    def duration(self) -> float:
+        """耗时（秒）"""
+        return (self.end_ns - self.start_ns) / 1e9
+    
+    def set(self, key: str, value: Any) -> None:
+        """设置属性"""
+        self.attributes[key] = value
+    
+    def to_dict(self) -> Dict[str, Any]:
+        """JSON lines格式"""
+        return {
+            "trace_id": self.context.trace_id,
+            "span_id": self.context.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start": self.start_ns / 1e9,
+            "duration_ms": round(self.duration * 1000, 3),
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+    
+    def to_otlp(self) -> Dict[str, Any]:
+        """OTLP JSON格式（ExportTraceServiceRequest），每个span一个请求"""
+        span = {
+            "traceId": self.context.trace_id,
+            "spanId": self.context.span_id,
+            "name": self.name,
+            "kind": 1,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns),
+            "attributes": [{"key": k, "value": _otlp_value(v)} for k, v in self.attributes.items()],
+            "status": {"code": 2, "message": self.error} if self.error else {"code": 1},
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        return {"resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": SERVICE_NAME}}]},
+            "scopeSpans": [{"scope": {"name": __name__}, "spans": [span]}],
+        }]}
+
+
+def _otlp_value(value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+_current: contextvars.ContextVar[Optional[SpanContext]] = contextvars.ContextVar("tracing_current", default=None)
+
+
+def current() -> Optional[SpanContext]:
+    """获取当前span，没有时返回None"""
+    return _current.get()
+
+
+class _FileExporter:
+    """在后台线程中把结束的span写入文件"""
+    
+    def __init__(self, path: str, trace_format: str):
+        self.path = path
+        self.trace_format = trace_format
+        self._queue: "queue.SimpleQueue[Optional[Span]]" = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._loop, name="trace-exporter", daemon=True)
+        self._thread.start()
+    
+    def export(self, span: Span) -> None:
+        self._queue.put(span)
+    
+    def _loop(self) -> None:
+        with open(self.path, "a", encoding="utf-8") as f:
+            while True:
+                span = self._queue.get()
+                if span is None:
+                    return
+                record = span.to_otlp() if self.trace_format == TRACE_FORMAT_OTLP else span.to_dict()
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+                if self._queue.empty():
+                    f.flush()
+    
+    def stop(self) -> None:
+        self._queue.put(None)
+        self._thread.join(timeout=5)
+
+
+class Tracer:
+    """记录span并保存最近的trace"""
+    
+    def __init__(self, max_traces: int = MAX_TRACES):
+        self.max_traces = max_traces
+        # trace ID -> 已结束的span，按开始顺序淘汰最早的trace
+        self._traces: "OrderedDict[str, List[Span]]" = OrderedDict()
+        # (设备名称, rid) -> 发布命令时的span
+        self._links: "OrderedDict[Tuple[str, int], SpanContext]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._exporter: Optional[_FileExporter] = None
+    
+    def configure(self, path: str = "", trace_format: str = TRACE_FORMAT_JSON) -> None:
+        """
+        设置trace导出文件
+        
+        Args:
+            path: 导出文件路径，为空时只保存在内存中
+            trace_format: json（每行一个span）或otlp（每行一个OTLP JSON请求）
+        
+        Raises:
+            ValueError: 格式不正确
+        """
+        if trace_format not in TRACE_FORMATS:
+            raise ValueError(f"未知的trace格式: {trace_format}，可选: {', '.join(TRACE_FORMATS)}")
+        if self._exporter is not None:
+            self._exporter.stop()
+            self._exporter = None
+        if path:
+            self._exporter = _FileExporter(path, trace_format)
+            logger.info("trace导出到文件: %s (%s)", path, trace_format)
+    
+    @contextmanager
+    def span(self, name: str, parent: Optional[SpanContext] = None, root: bool = False,
+             **attributes) -> Iterator[Optional[Span]]:
+        """
+        记录一个span，期间作为当前span
+        
+        Args:
+            name: span名称
+            parent: 父span，为None时使用当前span
+            root: 没有父span时是否开始新的trace；为False且没有父span时不记录
+            **attributes: span属性
+        
+        Yields:
+            span，不记录时为None
+        """
+        if parent is None:
+            parent = _current.get()
+        if parent is None and not root:
+            yield None
+            return
+        trace_id = parent.trace_id if parent is not None else f"{random.getrandbits(128):032x}"
+        span = Span(name, SpanContext(trace_id, f"{random.getrandbits(64):016x}"),
+                    parent.span_id if parent is not None else None, time.time_ns(), attributes=attributes)
+        token = _current.set(span.context)
+        try:
+            yield span
+        except BaseException as e:
+            span.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            _current.reset(token)
+            span.end_ns = time.time_ns()
+            self._finish(span)
+    
+    def _finish(self, span: Span) -> None:
+        with self._lock:
+            spans = self._traces.get(span.context.trace_id)
+            if spans is None:
+                spans = self._traces[span.context.trace_id] = []
+                while len(self._traces) > self.max_traces:
+                    self._traces.popitem(last=False)
+            if len(spans) < MAX_SPANS_PER_TRACE:
+                spans.append(span)
+        if self._exporter is not None:
+            self._exporter.export(span)
+    
+    def link(self, device_name: str, rid: int) -> None:
+        """记录发往设备的命令所属的当前span，设备回复时据此找回trace"""
+        context = _current.get()
+        if context is None or not rid:
+            return
+        with self._lock:
+            self._links[(device_name, rid)] = context
+            while len(self._links) > MAX_LINKS:
+                self._links.popitem(last=False)
+    
+    def linked(self, device_name: Optional[str], rid: Any) -> Optional[SpanContext]:
+        """获取设备回复对应命令所属的span，没有时返回None"""
+        if device_name is None or not rid:
+            return None
+        with self._lock:
+            return self._links.get((device_name, rid))
+    
+    def recent(self, count: int) -> List[List[Span]]:
+        """最近的count个trace，最新的在前"""
+        with self._lock:
+            traces = list(self._traces.values())[-count:]
+        return [list(spans) for spans in reversed(traces)]
+    
+    def find(self, prefix: str) -> Optional[List[Span]]:
+        """按trace ID前缀查找trace，最新的优先"""
+        with self._lock:
+            for trace_id in reversed(self._traces):
+                if trace_id.startswith(prefix):
+                    return list(self._traces[trace_id])
+        return None
+
+
+def _root_of(spans: List[Span]) -> Span:
+    return min(spans, key=lambda s: (s.parent_id is not None, s.start_ns))
+
+
+def format_trace_list(traces: List[List[Span]]) -> str:
+    """/trace的列表文本：每个trace一行"""
+    if not traces:
+        return "no trace recorded yet"
+    lines = ["recent traces:"]
+    for spans in traces:
+        root = _root_of(spans)
+        end = max(s.end_ns for s in spans)
+        label = root.attributes.get("route") or root.attributes.get("device") or ""
+        lines.append(
+            f"{root.context.trace_id[:12]} {time.strftime('%H:%M:%S', time.localtime(root.start_ns / 1e9))} "
+            f"{root.name} {label} {(end - root.start_ns) / 1e6:.0f}ms spans={len(spans)}"
+        )
+    return "\n".join(lines)
+
+
+def format_trace(spans: List[Span]) -> str:
+    """/trace <id>的文本：按父子关系缩进，每行为相对trace开始的偏移与耗时"""
+    return "\n".join(trace_lines(spans))
+
+
+def trace_lines(spans: List[Span]) -> List[str]:
+    """/trace <id>的文本行，第一行为trace ID，其后每个span一行"""
+    start = min(s.start_ns for s in spans)
+    children: Dict[Optional[str], List[Span]] = {}
+    ids = {s.context.span_id for s in spans}
+    for s in sorted(spans, key=lambda s: s.start_ns):
+        # 父span已被淘汰或不在本进程时挂在顶层
+        children.setdefault(s.parent_id if s.parent_id in ids else None, []).append(s)
+    
+    lines = [f"trace {spans[0].context.trace_id}"]
+    
+    def walk(parent: Optional[str], depth: int) -> None:
+        for s in children.get(parent, []):
+            attrs = " ".join(f"{k}={v}" for k, v in s.attributes.items())
+            error = f" ERROR {s.error}" if s.error else ""
+            lines.append(f"{'  ' * depth}+{(s.start_ns - start) / 1e6:.0f}ms {s.duration * 1000:.1f}ms "
+                         f"{s.name} {attrs}{error}".rstrip())
+            walk(s.context.span_id, depth + 1)
+    
+    walk(None, 0)
+    return lines
+
+
+TRACER = Tracer()
+span = TRACER.span
@@ -1,4 +1,5 @@
 import json
+import os
 from datetime import datetime, timezone, timedelta
 
 
@@ -25,8 +26,13 @@ def load_help():
         return "Help file not found."
 
 def save_dict(name, dc):
-    with open(name, 'w') as f:
+    # 先写临时文件并落盘，再原子替换，避免写入中途崩溃导致文件损坏
+    tmp = f"{name}.tmp"
+    with open(tmp, 'w') as f:
         json.dump(dc, f, indent=4)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, name)
 
 def load_dict(name):
     try: